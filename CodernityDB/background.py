@@ -0,0 +1,428 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Copyright 2011-2013 Codernity (http://codernity.com)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Builds index from documents in database while the database is used.
+
+Writes made during the build don't touch the index, ids of changed
+documents (with keys their previous versions had in the index) go to
+catch-up log instead. When all documents are scanned, logged documents
+are indexed again until the log is empty, then the index becomes ready.
+Queries can't use the index before that, so the builder is its only user.
+
+:py:class:`ShadowBuilder` builds edited version of index in its own
+directory instead, the index is used until the new version replaces it.
+
+Writes to deferred indexes are recorded the same way, :py:class:`IndexApplier`
+applies them later in batches.
+"""
+
+import threading
+import time
+import warnings
+from collections import OrderedDict
+from itertools import islice
+
+from CodernityDB.index import ElemNotFound, TryReindexException
+
+
+class WriteGate(object):
+
+    """
+    Counts writes in progress, :py:meth:`close` waits for them and holds
+    new ones until :py:meth:`open`.
+    """
+
+    def __init__(self):
+        self.cond = threading.Condition()
+        self.writers = 0
+        self.closing = False
+
+    def enter(self):
+        """
+        Called when write starts.
+        """
+        with self.cond:
+            while self.closing:
+                self.cond.wait()
+            self.writers += 1
+
+    def exit(self):
+        with self.cond:
+            self.writers -= 1
+            self.cond.notify_all()
+
+    def close(self):
+        with self.cond:
+            self.closing = True
+            while self.writers:
+                self.cond.wait()
+
+    def open(self):
+        with self.cond:
+            self.closing = False
+            self.cond.notify_all()
+
+
+class IndexBuilder(WriteGate):
+
+    """
+    Writes started before the index is ready (see :py:class:`WriteGate`)
+    are waited for when it's switched to ready.
+    """
+
+    #: documents indexed under single lock acquire
+    batch = 500
+
+    def __init__(self, db, index):
+        super(IndexBuilder, self).__init__()
+        self.db = db
+        self.index = index
+        self.log = {}
+        self.busy = False
+        self.cancelled = False
+        self.ready = False
+        self.error = None
+        self.thread = None
+
+    def start(self, threaded=True):
+        """
+        Runs the build in new thread, without ``threaded`` it's done before return.
+        """
+        if not threaded:
+            self.run()
+            return
+        self.thread = threading.Thread(target=self.run,
+                                       name='build_' + self.index.name)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def wait(self, timeout=None):
+        """
+        Waits until the index is ready, raises exception that stopped the build.
+        Returns ``False`` when timeout expired first.
+        """
+        if self.thread is not None:
+            self.thread.join(timeout)
+        if self.error is not None:
+            raise self.error
+        return self.ready
+
+    def cancel(self):
+        with self.cond:
+            self.cancelled = True
+            self.cond.notify_all()
+            while self.busy:
+                self.cond.wait()
+
+    def log_write(self, doc_id, old_data=None):
+        """
+        Records change of document, ``old_data`` is document version before the change.
+        """
+        key = self._old_key(old_data)
+        with self.cond:
+            keys = self.log.setdefault(doc_id, [])
+            if key is not None and key not in keys:
+                keys.append(key)
+
+    def _old_key(self, old_data):
+        if old_data is None:
+            return None
+        try:
+            should_index = self.index.make_key_value(old_data)
+        except Exception:
+            should_index = None
+        if should_index:
+            return should_index[0]
+        return None
+
+    def run(self):
+        try:
+            gen = self.db.id_ind.all()
+            while self._step(self._scan, gen):
+                pass
+            while self._step(self._catch_up):
+                pass
+            self._finish()
+        except Exception as ex:
+            self.error = ex
+            warnings.warn("Building of index `%s` failed, ex = `%r`"
+                          % (self.index.name, ex), RuntimeWarning)
+            if self.thread is None:
+                raise
+
+    def _step(self, work, *args):
+        """
+        Runs ``work`` (returns ``False`` when there is nothing more to do)
+        unless the build was cancelled.
+        """
+        with self.db._maintenance_lock():
+            with self.cond:
+                if self.cancelled:
+                    return False
+                self.busy = True
+            try:
+                return work(*args)
+            finally:
+                with self.cond:
+                    self.busy = False
+                    self.cond.notify_all()
+
+    def _scan(self, gen):
+        records = list(islice(gen, self.batch))
+        storage = self.db.id_ind.storage
+        for doc_id, rev, start, size, status in records:
+            if doc_id in self.log:
+                continue  # catch-up will index it
+            if size:
+                doc = storage.get(start, size, status)
+            else:
+                doc = {}
+            doc['_id'] = doc_id
+            doc['_rev'] = rev
+            self._insert(doc_id, doc)
+        return len(records) == self.batch
+
+    def _catch_up(self):
+        """
+        Indexes logged documents again, returns ``True`` while the log
+        is longer than ``batch`` and gets shorter (otherwise writes are
+        faster than the build and :py:meth:`_finish` has to stop them).
+        """
+        with self.cond:
+            log, self.log = self.log, {}
+        for doc_id, keys in log.iteritems():
+            self._reindex_doc(doc_id, keys)
+        return self.batch < len(self.log) < len(log)
+
+    def _finish(self):
+        """
+        Stops new writes, waits for the started ones, indexes documents
+        they changed and switches the index to ready.
+        """
+        with self.db._maintenance_lock():
+            with self.cond:
+                if self.cancelled:
+                    return
+                self.busy = True
+                self.closing = True
+                while self.writers:
+                    self.cond.wait()
+            try:
+                while self.log:
+                    self._catch_up()
+                self._switch()
+                with self.cond:
+                    self.ready = True
+            finally:
+                with self.cond:
+                    self.busy = False
+                    self.closing = False
+                    self.cond.notify_all()
+
+    def _switch(self):
+        self.index._save_params(dict(building=False))
+        self.db.index_builders.pop(self.index.name, None)
+
+    def _key_value(self, doc):
+        try:
+            return self.index.make_key_value(doc)
+        except Exception as ex:
+            warnings.warn("""Problem during build of `%s`, ex = `%r`, \
+you should check index code.""" % (self.index.name, ex), RuntimeWarning)
+            return None
+
+    def _insert(self, doc_id, doc):
+        should_index = self._key_value(doc)
+        if should_index:
+            key, value = should_index
+            self.index.insert_with_storage(doc_id, key, value)
+
+    def _reindex_doc(self, doc_id, keys):
+        """
+        Removes entries for all keys given document could be indexed with,
+        then indexes its current version.
+        """
+        id_ind = self.db.id_ind
+        try:
+            _id, rev, start, size, status = id_ind.get(doc_id)
+        except ElemNotFound:
+            status = 'd'
+        if status == 'd' or status == 'u' or (not start and not size):
+            doc = should_index = None
+        else:
+            if size:
+                doc = id_ind.storage.get(start, size, status)
+            else:
+                doc = {}
+            doc['_id'] = doc_id
+            doc['_rev'] = rev
+            should_index = self._key_value(doc)
+            if should_index and should_index[0] not in keys:
+                # scan could index this version already
+                keys.append(should_index[0])
+        for key in keys:
+            try:
+                self.index.delete(doc_id, key)
+            except (ElemNotFound, TryReindexException):
+                pass
+        if should_index:
+            key, value = should_index
+            self.index.insert_with_storage(doc_id, key, value)
+
+
+class ShadowBuilder(IndexBuilder):
+
+    """
+    Builds ``index`` (edited version of index with the same name, placed
+    in other directory), then swaps it with the one used by database.
+    """
+
+    def __init__(self, db, index, ind_kwargs=None):
+        super(ShadowBuilder, self).__init__(db, index)
+        self.ind_kwargs = ind_kwargs
+
+    def _switch(self):
+        # writes wait for this builder until the swap is done
+        self.db._swap_index(self.index.name, self.index, '_shadow',
+                            self.ind_kwargs)
+        self.db.shadow_indexes.pop(self.index.name, None)
+
+
+class IndexApplier(IndexBuilder):
+
+    """
+    Applies writes to deferred ``index`` in batches, writes only record
+    changed documents (like during build). In thread safe modes they are
+    applied by background thread, otherwise before the index is queried
+    or when ``batch`` documents are waiting.
+    """
+
+    def __init__(self, db, index):
+        super(IndexApplier, self).__init__(db, index)
+        self.log = OrderedDict()  # doc_id: (write number, time, keys)
+        self.logged = 0
+        self.applying = None  # (write number, time) of oldest write in batch
+
+    def start(self, threaded=True):
+        if not threaded:
+            return
+        self.thread = threading.Thread(target=self.run,
+                                       name='apply_' + self.index.name)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def log_write(self, doc_id, old_data=None):
+        key = self._old_key(old_data)
+        with self.cond:
+            self.logged += 1
+            if doc_id not in self.log:
+                self.log[doc_id] = (self.logged, time.time(), [])
+            keys = self.log[doc_id][2]
+            if key is not None and key not in keys:
+                keys.append(key)
+            self.cond.notify_all()
+            full = self.thread is None and len(self.log) >= self.batch
+        if full:
+            self.apply()
+
+    def run(self):
+        while True:
+            with self.cond:
+                while (not self.log or self.busy) and not self.cancelled:
+                    self.cond.wait()
+                if self.cancelled:
+                    return
+            with self.db._maintenance_lock():
+                with self.cond:
+                    if self.busy or self.cancelled:
+                        continue
+                    self.busy = True
+                try:
+                    self._apply()
+                except Exception as ex:
+                    self.error = ex
+                    warnings.warn("Applying writes to index `%s` failed, ex = `%r`"
+                                  % (self.index.name, ex), RuntimeWarning)
+                finally:
+                    with self.cond:
+                        self.busy = False
+                        self.cond.notify_all()
+
+    def apply(self, upto=None):
+        """
+        Applies logged writes (up to write number ``upto``) in calling thread.
+        """
+        with self.cond:
+            while self.busy:
+                self.cond.wait()
+            self.busy = True
+        try:
+            while self._apply(upto):
+                pass
+        finally:
+            with self.cond:
+                self.busy = False
+                self.cond.notify_all()
+
+    def _apply(self, upto=None):
+        """
+        Applies batch of the oldest writes, returns ``False`` when there
+        was nothing to apply.
+        """
+        with self.cond:
+            batch = []
+            while self.log and len(batch) < self.batch:
+                doc_id, entry = next(self.log.iteritems())
+                if upto is not None and entry[0] > upto:
+                    break
+                del self.log[doc_id]
+                batch.append((doc_id, entry[2]))
+                if len(batch) == 1:
+                    self.applying = entry[:2]
+        if not batch:
+            return False
+        try:
+            for doc_id, keys in batch:
+                self._reindex_doc(doc_id, keys)
+        finally:
+            with self.cond:
+                self.applying = None
+        return True
+
+    def discard(self):
+        """
+        Drops logged writes, used when the index is built from scratch.
+        """
+        with self.cond:
+            while self.busy:
+                self.cond.wait()
+            self.log.clear()
+
+    def lag(self):
+        """
+        Returns number of documents waiting and age (in seconds) of the
+        oldest write not applied yet.
+        """
+        with self.cond:
+            pending = len(self.log)
+            oldest = self.applying
+            if oldest is None and self.log:
+                oldest = next(self.log.itervalues())[:2]
+        if oldest is None:
+            return pending, 0.0
+        return pending, time.time() - oldest[1]
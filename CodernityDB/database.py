@@ -16,6 +16,8 @@
 # limitations under the License.
 import os
 import io
+import base64
+import marshal
 from inspect import getsource
 
 # for custom indexes
@@ -33,15 +35,21 @@ from CodernityDB.index import (ElemNotFound,
                                TryReindexException,
                                ReindexException,
                                IndexNotFoundException,
+                               IndexNotReadyException,
                                IndexConflict)
 
 from CodernityDB.misc import NONE
+from CodernityDB.lru_cache import DocumentCache, NoLock
+from CodernityDB.background import (IndexBuilder, ShadowBuilder, WriteGate,
+                                    IndexApplier)
 
 from CodernityDB.env import cdb_environment
 
 from random import randrange
+from itertools import islice, izip
 
 import warnings
+from collections import MutableMapping
 
 
 def header_for_indexes(index_name, index_class, db_custom="", ind_custom="", classes_code=""):
@@ -106,6 +114,56 @@ class DatabaseIsNotOpened(PreconditionsException):
     pass
 
 
+class StoredDocument(MutableMapping):
+
+    """
+    Version of document stored in database, ``_id`` and ``_rev`` come
+    from **id** index metadata, other fields are read from storage
+    (whole document at once) when first used.
+    """
+
+    def __init__(self, _id, _rev, load):
+        self._meta = {'_id': _id, '_rev': _rev}
+        self._load = load
+        self._data = None
+
+    @property
+    def loaded(self):
+        return self._data is not None
+
+    def _doc(self):
+        if self._data is None:
+            data = self._load()
+            data.update(self._meta)
+            self._data = data
+        return self._data
+
+    def __getitem__(self, key):
+        if self._data is None and key in self._meta:
+            return self._meta[key]
+        return self._doc()[key]
+
+    def __contains__(self, key):
+        if self._data is None and key in self._meta:
+            return True
+        return key in self._doc()
+
+    def __setitem__(self, key, value):
+        self._doc()[key] = value
+
+    def __delitem__(self, key):
+        del self._doc()[key]
+
+    def __iter__(self):
+        return iter(self._doc())
+
+    def __len__(self):
+        return len(self._doc())
+
+    def __repr__(self):
+        return repr(self._doc())
+
+
 class Database(object):
 
     """
@@ -114,13 +172,31 @@ class Database(object):
 
     custom_header = ""  # : use it for imports required by your database
 
-    def __init__(self, path):
+    threaded = False  # : can background work (see :py:meth:`build_index`) run in other threads
+
+    doc_batch = 256  # : records of :py:meth:`get_many` and :py:meth:`all` with documents read together (``with_doc=True``)
+
+    def __init__(self, path, doc_cache_size=0):
+        """
+        :param path: database directory
+        :param doc_cache_size: how many documents read from **id** index should be cached (0 disables the cache)
+        """
         self.path = path
         self.storage = None
         self.indexes = []
         self.id_ind = None
         self.indexes_names = {}
+        self.index_builders = {}
+        self.shadow_indexes = {}
+        self.previous_indexes = {}
+        self.deferred_indexes = {}
+        self.swap_gate = WriteGate()
         self.opened = False
+        if doc_cache_size:
+            self.doc_cache = DocumentCache(doc_cache_size,
+                                           cdb_environment.get('rlock_obj'))
+        else:
+            self.doc_cache = None
 
     def create_new_rev(self, old_rev=None):
         """
@@ -182,7 +258,7 @@ class Database(object):
             f.write(code)
         return True
 
-    def _read_index_single(self, p, ind, ind_kwargs={}):
+    def _read_index_single(self, p, ind, ind_kwargs={}, db_path=None):
         """
         It will read single index from index file (ie. generated in :py:meth:`._add_single_index`).
         Then it will perform ``exec`` on that code
@@ -191,6 +267,7 @@ class Database(object):
 
         :param p: path
         :param ind: index name (will be joined with *p*)
+        :param db_path: directory for index files (database path by default)
         :returns: new index object
         """
         with io.FileIO(os.path.join(p, ind), 'r') as f:
@@ -200,7 +277,7 @@ class Database(object):
         try:
             obj = compile(code, '<Index: %s' % os.path.join(p, ind), 'exec')
             exec obj in globals()
-            ind_obj = globals()[_class](self.path, name, **ind_kwargs)
+            ind_obj = globals()[_class](db_path or self.path, name, **ind_kwargs)
             ind_obj._order = int(ind[:2])
         except:
             ind_path = os.path.join(p, ind)
@@ -218,8 +295,7 @@ class Database(object):
 
     def __write_index(self, new_index, number=0, edit=False, ind_kwargs=None):
         # print new_index
-        if ind_kwargs is None:
-            ind_kwargs = {}
+        ind_kwargs = dict(ind_kwargs or {})
         p = os.path.join(self.path, '_indexes')
         if isinstance(new_index, basestring) and not new_index.startswith("path:"):
             if len(new_index.splitlines()) < 4 or new_index.splitlines()[3] != '# inserted automatically':
@@ -262,7 +338,7 @@ class Database(object):
             with io.FileIO(ind_path_f, 'w') as f:
                 f.write(new_index)
 
-            ind_obj = self._read_index_single(p, ind_path + '.py')
+            ind_obj = self._read_index_single(p, ind_path + '.py', ind_kwargs)
 
         elif isinstance(new_index, basestring) and new_index.startswith("path:"):
             path = new_index[5:]
@@ -282,7 +358,7 @@ class Database(object):
                 if curr not in ('args', 'kwargs'):
                     v = getattr(ind, curr, NONE())
                     if not isinstance(v, NONE):
-                        ind_kwargs[curr] = v
+                        ind_kwargs.setdefault(curr, v)
             if edit:
                 # code duplication...
                 previous_index = filter(lambda x: x.endswith(
@@ -306,13 +382,15 @@ class Database(object):
             raise PreconditionsException("Argument must be Index instance, path to index_file or valid string index format")
         return ind_obj, name
 
-    def add_index(self, new_index, create=True, ind_kwargs=None):
+    def add_index(self, new_index, create=True, ind_kwargs=None, background=False):
         """
 
         :param new_index: New index to add, can be Index object, index valid string or path to file with index code
         :type new_index: string
         :param create: Create the index after add or not
         :type create: bool
+        :param background: Index documents already in database with :py:meth:`build_index`
+        :type background: bool
 
         :returns: new index name
         """
@@ -328,7 +406,8 @@ class Database(object):
             _next = last + 1
         else:
             _next = 0
-        ind_obj, name = self.__write_index(new_index, _next, edit=False)
+        ind_obj, name = self.__write_index(new_index, _next, edit=False,
+                                           ind_kwargs=ind_kwargs)
         # add the new index to objects
         self.indexes.append(ind_obj)
         self.indexes_names[name] = ind_obj
@@ -340,26 +419,51 @@ class Database(object):
             self.__compat_things()
         for patch in getattr(ind_obj, 'patchers', ()):  # index can patch db object
             patch(self, ind_obj)
+        if ind_obj.deferred and create and self.opened:
+            self._start_applier(ind_obj)
+        if background and create and self.opened:
+            self.build_index(ind_obj)
         return name
 
-    def edit_index(self, index, reindex=False, ind_kwargs=None):
+    def edit_index(self, index, reindex=False, ind_kwargs=None, shadow=False):
         """
         Allows to edit existing index.
         Previous working version will be saved with ``_last`` suffix (see :py:meth:`.revert_index`
 
+        With ``shadow`` the edited index is built from scratch in ``_shadow``
+        directory (like in :py:meth:`build_index`, writes made meanwhile are
+        caught up), queries use the current version until the new one replaces it.
+        In thread safe modes that happens in background, builder is in ``shadow_indexes``.
+        Replaced version is kept up to date until database is closed,
+        so :py:meth:`.revert_index` can swap it back without reindex.
+
         :param bool reindex: should be the index reindexed after change
+        :param bool shadow: build the edited index aside and swap it in when ready
 
         :returns: index name
         """
         if ind_kwargs is None:
             ind_kwargs = {}
-        ind_obj, name = self.__write_index(index, -1, edit=True)
+        ind_obj, name = self.__write_index(index, -1, edit=True,
+                                           ind_kwargs=ind_kwargs)
+        if shadow:
+            self._build_shadow(name, ind_kwargs)
+            return name
+        self._drop_shadow(name)
+        if name in self.deferred_indexes:
+            self._stop_applier(name)
         old = next(x for x in self.indexes if x.name == name)
         old.close_index()
         index_of_index = self.indexes.index(old)
         ind_obj.open_index()
+        if 'cache_size' in ind_kwargs or 'cache_memory' in ind_kwargs:
+            # sizes saved in index props would win otherwise
+            ind_obj.set_cache_size(ind_kwargs.get('cache_size'),
+                                   ind_kwargs.get('cache_memory'))
         self.indexes[index_of_index] = ind_obj
         self.indexes_names[name] = ind_obj
+        if ind_obj.deferred:
+            self._start_applier(ind_obj)
         if reindex:
             self.reindex_index(name)
         return name
@@ -368,9 +472,18 @@ class Database(object):
         """
         Tries to revert index code from copy.
         It calls :py:meth:`.edit_index` with previous working.
+        Index replaced by shadow edit (in the same session) is just swapped back.
 
         :param string index_name: index name to restore
         """
+        if index_name in self.previous_indexes:
+            self.swap_gate.close()
+            try:
+                previous = self.previous_indexes[index_name]
+                self._swap_index(index_name, previous, '_last', ind_kwargs)
+            finally:
+                self.swap_gate.open()
+            return index_name
         ind_path = os.path.join(self.path, '_indexes')
         if index_name in self.indexes_names:  # then it's working index.
             ind = self.indexes_names[index_name]
@@ -564,6 +677,7 @@ for ID index. You should update that index \
         self.indexes = []
         self.id_ind = None
         self.indexes_names = {}
+        self._drop_shadows()  # left by interrupted shadow edit
         self._read_indexes()
         if not 'id' in self.indexes_names:
             raise PreconditionsException("There must be `id` index!")
@@ -573,6 +687,14 @@ for ID index. You should update that index \
         self.__set_main_storage()
         self.__compat_things()
         self.opened = True
+        for index in self.indexes:
+            rebuild = getattr(index, 'building', False)
+            if index.deferred:
+                # writes not applied before crash are lost
+                rebuild = rebuild or os.path.exists(self._pending_file(index))
+                self._start_applier(index)
+            if rebuild:
+                self.build_index(index)
         return True
 
     def close(self):
@@ -581,9 +703,17 @@ for ID index. You should update that index \
         """
         if not self.opened:
             raise DatabaseConflict("Not opened")
+        for builder in self.index_builders.values():
+            builder.cancel()  # unfinished build restarts on open
+        self.index_builders = {}
+        for name in self.deferred_indexes.keys():
+            self._stop_applier(name)
+        self._drop_shadows()
         self.id_ind = None
         self.indexes_names = {}
         self.storage = None
+        if self.doc_cache is not None:
+            self.doc_cache.clear()
         for index in self.indexes:
             index.close_index()
         self.indexes = []
@@ -625,6 +755,15 @@ for ID index. You should update that index \
         :param db_data: database data
         :param doc_id: the id of document
         """
+        if index.name in self.shadow_indexes:
+            self.shadow_indexes[index.name].log_write(doc_id, db_data)
+        self._previous_write(self._single_update_index, index,
+                             data, db_data, doc_id)
+        if index.name in self.index_builders:
+            return self.index_builders[index.name].log_write(doc_id, db_data)
+        applier = self._deferred(index)
+        if applier is not None:
+            return applier.log_write(doc_id, db_data)
         try:
             old_should_index = index.make_key_value(db_data)
         except Exception as ex:
@@ -661,14 +800,14 @@ you should check index code.""" % (index.name, ex), RuntimeWarning)
         Performs update on **id** index
         """
         _id, value = self.id_ind.make_key_value(data)
-        db_data = self.get('id', _id)
-        if db_data['_rev'] != _rev:
-            raise RevConflict()
+        db_data = self._stored_doc(_id, _rev)
         new_rev = self.create_new_rev(_rev)
         # storage = self.storage
         # start, size = storage.update(value)
         # self.id_ind.update(_id, new_rev, start, size)
         self.id_ind.update_with_storage(_id, new_rev, value)
+        if self.doc_cache is not None:
+            self.doc_cache.delete(_id)
         return _id, new_rev, db_data
 
     def _update_indexes(self, _rev, data):
@@ -676,10 +815,73 @@ you should check index code.""" % (index.name, ex), RuntimeWarning)
         Performs update operation on all indexes in order
         """
         _id, new_rev, db_data = self._update_id_index(_rev, data)
-        for index in self.indexes[1:]:
-            self._single_update_index(index, data, db_data, _id)
+        self._update_other_indexes(_id, new_rev, data, db_data)
         return _id, new_rev
 
+    def _update_other_indexes(self, _id, new_rev, data, db_data, fields=None):
+        """
+        Performs update on indexes other than **id**, indexes whose input
+        fields didn't change are skipped.
+        """
+        for index in self.indexes[1:]:
+            if self._index_changed(index, data, db_data, fields):
+                self._single_update_index(index, data, db_data, _id)
+
+    def _index_changed(self, index, data, db_data, fields=None):
+        """
+        Tells if ``index`` can change when document changes from ``db_data``
+        to ``data``, ``fields`` are names of changed fields when known.
+        """
+        input_fields = index.input_fields
+        if input_fields is None:
+            return True
+        if index.name in self.shadow_indexes or index.name in self.previous_indexes:
+            return True  # other version of index may use other fields
+        if fields is not None:
+            input_fields = fields.intersection(input_fields)
+        for field in input_fields:
+            if field == '_id':
+                continue  # can't change (and it's removed from data)
+            old = db_data.get(field, NONE)
+            new = data.get(field, NONE)
+            if type(old) is not type(new) or old != new:
+                return True
+        return False
+
+    def _patch_id_index(self, _id, _rev, changes, unset, in_place):
+        """
+        Performs patch on **id** index
+        """
+        db_data = self._stored_doc(_id, _rev)
+        data = dict(db_data)
+        data.update(changes)
+        for field in unset:
+            data.pop(field, None)
+        _id, value = self.id_ind.make_key_value(data)
+        new_rev = self.create_new_rev(_rev)
+        if not value:
+            start, size = 1, 0
+        elif in_place:
+            start, size = self.id_ind.get(_id)[2:4]
+            start, size = self.id_ind.storage.rewrite(start, size, value)
+        else:
+            start, size = self.id_ind.storage.update(value)
+        self.id_ind.update(_id, new_rev, start, size)
+        if self.doc_cache is not None:
+            self.doc_cache.delete(_id)
+        return new_rev, data, db_data
+
+    def _patch_indexes(self, _id, _rev, changes, unset, in_place):
+        """
+        Performs patch operation on all indexes in order
+        """
+        new_rev, data, db_data = self._patch_id_index(_id, _rev, changes,
+                                                      unset, in_place)
+        fields = set(changes)
+        fields.update(unset)
+        self._update_other_indexes(_id, new_rev, data, db_data, fields)
+        return new_rev
+
     def _single_insert_index(self, index, data, doc_id):
         """
         Performs insert operation on single index
@@ -688,6 +890,14 @@ you should check index code.""" % (index.name, ex), RuntimeWarning)
         :param data: new data
         :param doc_id: document id
         """
+        if index.name in self.shadow_indexes:
+            self.shadow_indexes[index.name].log_write(doc_id)
+        self._previous_write(self._single_insert_index, index, data, doc_id)
+        if index.name in self.index_builders:
+            return self.index_builders[index.name].log_write(doc_id)
+        applier = self._deferred(index)
+        if applier is not None:
+            return applier.log_write(doc_id)
         try:
             should_index = index.make_key_value(data)
         except Exception as ex:
@@ -734,6 +944,10 @@ you should check index code.""" % (index.name, ex), RuntimeWarning)
         :param doc_id: document id
         :param old_data: current data in database
         """
+        self._previous_write(self._single_delete_index, index,
+                             data, doc_id, old_data)
+        if index.name in self.index_builders or self._deferred(index):
+            return  # logged after delete from id index, see _log_delete
         index_data = index.make_key_value(old_data)
         if not index_data:
             return
@@ -751,17 +965,46 @@ you should check index code.""" % (index.name, ex), RuntimeWarning)
         # key = data['_id']
         key = self.id_ind.make_key(_id)
         self.id_ind.delete(key)
+        if self.doc_cache is not None:
+            self.doc_cache.delete(_id)
 
     def _delete_indexes(self, _id, _rev, data):
         """
         Performs delete operation on all indexes in order
         """
-        old_data = self.get('id', _id)
-        if old_data['_rev'] != _rev:
-            raise RevConflict()
+        old_data = self._stored_doc(_id, _rev)
         for index in self.indexes[1:]:
             self._single_delete_index(index, data, _id, old_data)
         self._delete_id_index(_id, _rev, data)
+        self._log_delete(_id, old_data)
+
+    def _stored_doc(self, _id, _rev):
+        """
+        Checks ``_rev`` of document against **id** index metadata and returns
+        stored version of the document, its data are read from storage
+        only when some index uses them (see :py:class:`StoredDocument`).
+        """
+        try:
+            l_key, rev, start, size, status = self.id_ind.get(_id)
+        except ElemNotFound as ex:
+            raise RecordNotFound(ex)
+        if not start and not size:
+            raise RecordNotFound("Not found")
+        elif status == 'd':
+            raise RecordDeleted("Deleted")
+        if rev != _rev:
+            raise RevConflict()
+
+        def load():
+            # storage is append only, so the data are there after update
+            if not size:
+                return {}
+            if self.doc_cache is not None:
+                data = self.doc_cache.get(l_key, rev)
+                if data is not None:
+                    return data
+            return self.id_ind.storage.get(start, size, status)
+        return StoredDocument(l_key, rev, load)
 
     def destroy_index(self, index):
         """
@@ -783,6 +1026,11 @@ you should check index code.""" % (index.name, ex), RuntimeWarning)
         full_file = "%.2d%s" % (index._order, index.name) + '.py'
         p = os.path.join(self.path, '_indexes', full_file)
         os.unlink(p)
+        if index.name in self.index_builders:
+            self.index_builders.pop(index.name).cancel()
+        if index.name in self.deferred_indexes:
+            self._stop_applier(index.name, apply=False)
+        self._drop_shadow(index.name)
         index.destroy()
         del self.indexes_names[index.name]
         self.indexes.remove(index)
@@ -806,15 +1054,35 @@ you should check index code.""" % (index.name, ex), RuntimeWarning)
         if getattr(index, 'compacting', False):
             raise ReindexException(
                 "The index=%s is still compacting" % index.name)
+        self._check_ready(index.name)
         index.compacting = True
         index.compact()
         del index.compacting
 
-    def _compact_indexes(self):
+    def _compact_indexes(self, workers=None):
         """
         Runs compact on all indexes
-        """
-        for index in self.indexes:
+
+        :param workers: number of processes to use, by default all indexes are compacted in current one
+        """
+        # indexes being built are compact already
+        indexes = [index for index in self.indexes
+                   if index.name not in self.index_builders]
+        if workers and workers > 1:
+            from CodernityDB.parallel import compact_indexes
+            for index in indexes:
+                if getattr(index, 'compacting', False):
+                    raise ReindexException(
+                        "The index=%s is still compacting" % index.name)
+            for index in indexes:
+                index.compacting = True
+            try:
+                compact_indexes(self, indexes, workers)
+            finally:
+                for index in indexes:
+                    del index.compacting
+            return
+        for index in indexes:
             self.compact_index(index)
 
     def _single_reindex_index(self, index, data):
@@ -823,14 +1091,9 @@ you should check index code.""" % (index.name, ex), RuntimeWarning)
         if status != 'd' and status != 'u':
             self._single_insert_index(index, data, doc_id)
 
-    def reindex_index(self, index):
+    def _reindex_target(self, index):
         """
-        Performs reindex on index. Optimizes metadata and storage informations for given index.
-
-        You can't reindex **id** index.
-
-        :param index: the index to reindex
-        :type index: :py:class:`CodernityDB.index.Index`` instance, or string
+        Returns index instance for ``index`` (instance or name) that can be reindexed
         """
         if isinstance(index, basestring):
             if not index in self.indexes_names:
@@ -842,27 +1105,341 @@ you should check index code.""" % (index.name, ex), RuntimeWarning)
         if index.name == 'id':
             self.__not_opened()
             raise PreconditionsException("Id index cannot be reindexed")
-        if getattr(index, 'reindexing', False):
+        if index.name in self.index_builders:
             raise ReindexException(
-                "The index=%s is still reindexing" % index.name)
+                "The index=%s is still building" % index.name)
+        return index
 
-        all_iter = self.all('id')
-        index.reindexing = True
+    def build_index(self, index):
+        """
+        Builds index from scratch like :py:meth:`reindex_index`, but without
+        stopping writes. In thread safe modes documents are indexed by
+        background thread, writes made meanwhile are caught up before the
+        index is switched to ready (see :py:mod:`CodernityDB.background`).
+        Until then queries on the index raise
+        :py:class:`CodernityDB.index.IndexNotReadyException`.
+        Build interrupted by :py:meth:`close` starts again on :py:meth:`open`.
+
+        :param index: the index to build
+        :type index: :py:class:`CodernityDB.index.Index`` instance, or string
+        :returns: :py:class:`CodernityDB.background.IndexBuilder` object, use its ``wait`` method to wait for the index
+        """
+        index = self._reindex_target(index)
+        builder = IndexBuilder(self, index)
+        self.index_builders[index.name] = builder
+        if index.name in self.deferred_indexes:
+            self.deferred_indexes[index.name].discard()
         index.destroy()
         index.create_index()
+        index._save_params(dict(building=True))
+        builder.start(self.threaded)
+        return builder
 
-        while True:
+    def _build_shadow(self, name, ind_kwargs):
+        """
+        Starts build of index ``name`` edited by :py:meth:`edit_index`.
+        Until it's swapped in, new code is kept in file with ``_shadow``
+        suffix and the current one stays in place.
+        """
+        p = os.path.join(self.path, '_indexes')
+        code = '%.2d%s.py' % (self.indexes_names[name]._order, name)
+        try:
+            self._reindex_target(name)
+        except:
+            os.rename(os.path.join(p, code + '_last'), os.path.join(p, code))
+            raise
+        self._drop_shadow(name)
+        os.rename(os.path.join(p, code), os.path.join(p, code + '_shadow'))
+        os.rename(os.path.join(p, code + '_last'), os.path.join(p, code))
+        target = os.path.join(self.path, '_shadow', name)
+        os.makedirs(target)
+        index = self._read_index_single(p, code + '_shadow', ind_kwargs,
+                                        db_path=target)
+        index.create_index()
+        builder = ShadowBuilder(self, index, ind_kwargs)
+        self.shadow_indexes[name] = builder
+        builder.start(self.threaded)
+        return builder
+
+    def _swap_index(self, name, other, suffix, ind_kwargs=None):
+        """
+        Replaces index ``name`` with ``other`` (version of it placed in
+        ``_shadow`` directory, with code in file with ``suffix``).
+        Files of replaced index go to that directory, its code to ``_last``
+        file and the index to ``previous_indexes``.
+        """
+        if ind_kwargs is None:
+            ind_kwargs = {}
+        current = self.indexes_names[name]
+        p = os.path.join(self.path, '_indexes')
+        code = os.path.join(p, '%.2d%s.py' % (current._order, name))
+        target = other.db_path
+        if name in self.deferred_indexes:
+            self._drop_applier(name)
+        current.close_index()
+        other.close_index()
+        swap = target + '_swap'
+        os.mkdir(swap)
+        for f in self._index_files(name):
+            os.rename(os.path.join(self.path, f), os.path.join(swap, f))
+        for f in os.listdir(target):
+            os.rename(os.path.join(target, f), os.path.join(self.path, f))
+        os.rmdir(target)
+        os.rename(swap, target)
+        os.rename(code, code + '_swap')
+        os.rename(code + suffix, code)
+        os.rename(code + '_swap', code + '_last')
+        new = self._read_index_single(p, os.path.basename(code), ind_kwargs)
+        new.open_index()
+        if 'cache_size' in ind_kwargs or 'cache_memory' in ind_kwargs:
+            new.set_cache_size(ind_kwargs.get('cache_size'),
+                               ind_kwargs.get('cache_memory'))
+        previous = self._read_index_single(p, os.path.basename(code) + '_last',
+                                           db_path=target)
+        previous.open_index()
+        self.indexes[self.indexes.index(current)] = new
+        self.indexes_names[name] = new
+        self.previous_indexes[name] = previous
+        if new.deferred:
+            self._start_applier(new)
+        return new
+
+    def _index_files(self, name):
+        """
+        Files of index ``name`` in database directory (without files of
+        indexes which names start with ``name``).
+        """
+        others = [other + '_' for other in self.indexes_names
+                  if other != name and other.startswith(name + '_')]
+        return [f for f in os.listdir(self.path)
+                if f.startswith(name + '_')
+                and os.path.isfile(os.path.join(self.path, f))
+                and not any(f.startswith(other) for other in others)]
+
+    def _drop_shadow(self, name):
+        """
+        Cancels shadow edit of index ``name`` and drops version replaced
+        by previous one.
+        """
+        builder = self.shadow_indexes.pop(name, None)
+        if builder is not None:
+            builder.cancel()
+            builder.index.close_index()
+        previous = self.previous_indexes.pop(name, None)
+        if previous is not None:
+            previous.close_index()
+        target = os.path.join(self.path, '_shadow', name)
+        if os.path.exists(target):
+            shutil.rmtree(target)
+        p = os.path.join(self.path, '_indexes')
+        if os.path.exists(p):
+            for code in os.listdir(p):
+                if code[2:] == name + '.py_shadow':
+                    os.unlink(os.path.join(p, code))
+
+    def _drop_shadows(self):
+        for name in set(self.shadow_indexes) | set(self.previous_indexes):
+            self._drop_shadow(name)
+        target = os.path.join(self.path, '_shadow')
+        if os.path.exists(target):
+            shutil.rmtree(target)
+        p = os.path.join(self.path, '_indexes')
+        if os.path.exists(p):
+            for code in os.listdir(p):
+                if code.endswith('.py_shadow'):
+                    os.unlink(os.path.join(p, code))
+
+    def _check_ready(self, index_name):
+        if index_name in self.index_builders:
+            raise IndexNotReadyException(
+                "Index `%s` is still building" % index_name)
+        applier = self.deferred_indexes.get(index_name)
+        if applier is not None and applier.thread is None:
+            applier.apply()  # nothing applies writes in background
+
+    def _deferred(self, index):
+        """
+        Returns applier of ``index`` when writes to it are deferred.
+        """
+        applier = self.deferred_indexes.get(index.name)
+        if applier is not None and applier.index is index:
+            return applier
+        return None
+
+    def _pending_file(self, index):
+        return os.path.join(self.path, '_indexes', index.name + '.pending')
+
+    def _start_applier(self, index):
+        """
+        Starts deferring writes to ``index``. Until they are applied on
+        close, index is marked with ``.pending`` file, so it's rebuilt
+        when database wasn't closed.
+        """
+        with io.FileIO(self._pending_file(index), 'w'):
+            pass
+        applier = IndexApplier(self, index)
+        self.deferred_indexes[index.name] = applier
+        applier.start(self.threaded)
+        return applier
+
+    def _stop_applier(self, name, apply=True):
+        applier = self.deferred_indexes[name]
+        applier.close()
+        try:
+            self._drop_applier(name, apply)
+        finally:
+            applier.open()
+
+    def _drop_applier(self, name, apply=True):
+        """
+        Stops applier of index ``name``, writes have to be held by caller.
+        """
+        applier = self.deferred_indexes.pop(name)
+        applier.cancel()
+        if apply:
+            applier.apply()
+        else:
+            applier.discard()
+        if os.path.exists(self._pending_file(applier.index)):
+            os.unlink(self._pending_file(applier.index))
+
+    def wait_for_index(self, index_name):
+        """
+        Applies writes made so far to deferred index (in calling thread),
+        so they are visible in queries. Does nothing for other indexes.
+
+        :param index_name: index name
+        """
+        if not index_name in self.indexes_names:
+            raise IndexNotFoundException(
+                "Index `%s` doesn't exists" % index_name)
+        applier = self.deferred_indexes.get(index_name)
+        if applier is not None:
+            applier.apply(applier.logged)
+
+    def get_index_lag(self, index_name):
+        """
+        Returns how far deferred index is behind the database: ``pending``
+        is number of changed documents waiting and ``lag`` age (in seconds)
+        of the oldest write not applied yet. Both are 0 for other indexes.
+
+        :param index_name: index name
+        """
+        if not index_name in self.indexes_names:
+            raise IndexNotFoundException(
+                "Index `%s` doesn't exists" % index_name)
+        applier = self.deferred_indexes.get(index_name)
+        if applier is None:
+            return dict(pending=0, lag=0.0)
+        pending, lag = applier.lag()
+        return dict(pending=pending, lag=lag)
+
+    def _write_op(self, method, *args):
+        """
+        Runs write ``method``, indexes being built wait for started writes
+        before they switch to ready.
+        """
+        builders = (self.index_builders.values() +
+                    self.shadow_indexes.values() +
+                    self.deferred_indexes.values())
+        if self.previous_indexes:  # can be swapped back by revert_index
+            builders.append(self.swap_gate)
+        if not builders:
+            return method(*args)
+        for builder in builders:
+            builder.enter()
+        try:
+            return method(*args)
+        finally:
+            for builder in builders:
+                builder.exit()
+
+    def _log_delete(self, doc_id, old_data):
+        """
+        Logs delete for indexes being built. It's done after delete from
+        **id** index, so catch-up can't index the document again.
+        """
+        for builder in (self.index_builders.values() +
+                        self.shadow_indexes.values() +
+                        self.deferred_indexes.values()):
+            builder.log_write(doc_id, old_data)
+
+    def _previous_write(self, method, index, *args):
+        """
+        Repeats write on version of ``index`` replaced by shadow edit.
+        """
+        previous = self.previous_indexes.get(index.name)
+        if previous is not None and previous is not index:
+            method(previous, *args)
+
+    def _maintenance_lock(self):
+        """
+        Lock held by background maintenance while it works on database
+        (see :py:mod:`CodernityDB.background`).
+        """
+        return NoLock()
+
+    def reindex_index(self, index):
+        """
+        Performs reindex on index. Optimizes metadata and storage informations for given index.
+
+        You can't reindex **id** index.
+
+        :param index: the index to reindex
+        :type index: :py:class:`CodernityDB.index.Index`` instance, or string
+        """
+        self._reindex_many([self._reindex_target(index)])
+
+    def _reindex_many(self, indexes, workers=None):
+        """
+        Reindexes all given indexes in single pass through **id** index,
+        so every document is read and decoded only once.
+
+        :param workers: number of processes to use, see :py:mod:`CodernityDB.parallel`
+        """
+        for index in indexes:
+            if getattr(index, 'reindexing', False):
+                raise ReindexException(
+                    "The index=%s is still reindexing" % index.name)
+        for index in indexes:
+            if index.name in self.deferred_indexes:
+                self.deferred_indexes[index.name].discard()
+
+        if workers and workers > 1:
+            from CodernityDB.parallel import reindex_indexes
+            for index in indexes:
+                index.reindexing = True
             try:
-                curr = all_iter.next()
-            except StopIteration:
-                break
-            else:
-                self._single_reindex_index(index, curr)
-        del index.reindexing
+                reindex_indexes(self, indexes, workers)
+            finally:
+                for index in indexes:
+                    del index.reindexing
+            return
 
-    def _reindex_indexes(self):
-        for index in self.indexes[1:]:
-            self.reindex_index(index)
+        all_iter = self.all('id')
+        for index in indexes:
+            index.reindexing = True
+            index.destroy()
+            index.create_index()
+        try:
+            for curr in all_iter:
+                doc_id, rev, start, size, status = self.id_ind.get(
+                    curr['_id'])  # it's cached so it's ok
+                if status == 'd' or status == 'u':
+                    continue
+                for index in indexes:
+                    self._single_insert_index(index, curr, doc_id)
+        finally:
+            for index in indexes:
+                del index.reindexing
+
+    def _reindex_indexes(self, indexes=None, workers=None):
+        if indexes is None:
+            indexes = self.indexes[1:]
+        else:
+            indexes = [self._reindex_target(index) for index in indexes]
+        if indexes:
+            self._reindex_many(indexes, workers)
 
     def insert(self, data):
         """
@@ -890,7 +1467,7 @@ you should check index code.""" % (index.name, ex), RuntimeWarning)
         assert _id is not None
         data['_rev'] = _rev  # for make_key_value compat with update / delete
         data['_id'] = _id
-        self._insert_indexes(_rev, data)
+        self._write_op(self._insert_indexes, _rev, data)
         ret = {'_id': _id, '_rev': _rev}
         data.update(ret)
         return ret
@@ -914,12 +1491,41 @@ you should check index code.""" % (index.name, ex), RuntimeWarning)
             self.__not_opened()
             raise PreconditionsException(
                 "`_rev` must be valid bytes object")
-        _id, new_rev = self._update_indexes(_rev, data)
+        _id, new_rev = self._write_op(self._update_indexes, _rev, data)
         ret = {'_id': _id, '_rev': new_rev}
         data.update(ret)
         return ret
 
-    def get(self, index_name, key, with_doc=False, with_storage=True):
+    def patch(self, _id, _rev, changes, unset=(), in_place=False):
+        """
+        Changes some fields of document, without sending whole document back.
+        Only indexes that use changed fields (see ``input_fields`` of
+        :py:class:`CodernityDB.index.Index`) are updated, indexes without
+        ``input_fields`` are always updated.
+
+        :param _id: id of document to change
+        :param _rev: current revision of the document
+        :param changes: dict of fields to set
+        :param unset: names of fields to remove
+        :param in_place: write new version over the old one when it fits
+            (saves space, but previous version is lost when write fails)
+        :returns: dict with ``_id`` and new ``_rev`` (like :py:meth:`update`)
+        """
+        for field in ('_id', '_rev'):
+            if field in changes or field in unset:
+                self.__not_opened()
+                raise PreconditionsException("Can't patch %s" % field)
+        try:
+            _rev = bytes(_rev)
+        except:
+            self.__not_opened()
+            raise PreconditionsException(
+                "`_rev` must be valid bytes object")
+        new_rev = self._write_op(self._patch_indexes, _id, _rev,
+                                 changes, unset, in_place)
+        return {'_id': _id, '_rev': new_rev}
+
+    def get(self, index_name, key, with_doc=False, with_storage=True, fields=None):
         """
         Get single data from Database by ``key``.
 
@@ -927,6 +1533,7 @@ you should check index code.""" % (index.name, ex), RuntimeWarning)
         :param key: key to get
         :param with_doc: if ``True`` data from **id** index will be included in output
         :param with_storage: if ``True`` data from index storage will be included, otherwise just metadata.
+        :param fields: names of document fields to return (``_id`` and ``_rev`` are always returned), applies to **id** index records and to ``doc`` of other indexes. With :py:class:`~CodernityDB.storage.FieldStorage` in **id** index other fields are not decoded at all.
         """
         # if not self.indexes_names.has_key(index_name):
         #     raise DatabaseException, "Invalid index name"
@@ -936,6 +1543,7 @@ you should check index code.""" % (index.name, ex), RuntimeWarning)
             self.__not_opened()
             raise IndexNotFoundException(
                 "Index `%s` doesn't exists" % index_name)
+        self._check_ready(index_name)
         try:
             l_key, _unk, start, size, status = ind.get(key)
         except ElemNotFound as ex:
@@ -945,14 +1553,19 @@ you should check index code.""" % (index.name, ex), RuntimeWarning)
         elif status == 'd':
             raise RecordDeleted("Deleted")
         if with_storage and size:
-            storage = ind.storage
-            data = storage.get(start, size, status)
+            if index_name == 'id' and fields is not None:
+                data = ind.storage.get(start, size, status, fields)
+            elif index_name == 'id' and self.doc_cache is not None:
+                data = self._get_cached_doc(l_key, _unk, start, size, status)
+            else:
+                storage = ind.storage
+                data = storage.get(start, size, status)
         else:
 
             data = {}
         if with_doc and index_name != 'id':
             storage = ind.storage
-            doc = self.get('id', l_key, False)
+            doc = self.get('id', l_key, False, fields=fields)
             if data:
                 data['doc'] = doc
             else:
@@ -964,7 +1577,136 @@ you should check index code.""" % (index.name, ex), RuntimeWarning)
             data['key'] = _unk
         return data
 
-    def get_many(self, index_name, key=None, limit=-1, offset=0, with_doc=False, with_storage=True, start=None, end=None, **kwargs):
+    def _get_cached_doc(self, doc_id, rev, start, size, status):
+        """
+        Reads document from **id** index storage through document cache.
+        """
+        data = self.doc_cache.get(doc_id, rev)
+        if data is None:
+            data = self.id_ind.storage.get(start, size, status)
+            self.doc_cache.put(doc_id, rev, data)
+        return data
+
+    def _get_docs(self, doc_ids, fields=None):
+        """
+        Reads documents for many ``doc_ids`` (like ``get('id', doc_id)`` for
+        every id), storage is read in file order. Returns list of documents
+        in ``doc_ids`` order, with exception for every document that
+        :py:meth:`get` would raise for.
+        """
+        found = {}
+        for l_key, rev, start, size, status in self.id_ind.get_multi(doc_ids):
+            found[l_key] = (rev, start, size, status)
+        docs = [None] * len(doc_ids)
+        reads = []
+        for i, doc_id in enumerate(doc_ids):
+            if doc_id not in found:
+                docs[i] = RecordNotFound("Not found")
+                continue
+            rev, start, size, status = found[doc_id]
+            if not start and not size:
+                docs[i] = RecordNotFound("Not found")
+            elif status == 'd':
+                docs[i] = RecordDeleted("Deleted")
+            elif not size:
+                docs[i] = {}
+            elif self.doc_cache is not None and fields is None:
+                docs[i] = self.doc_cache.get(doc_id, rev)
+            if docs[i] is None:
+                reads.append(i)
+        datas = self.id_ind.storage.get_multi(
+            [found[doc_ids[i]][1:] for i in reads], fields)
+        for i, data in izip(reads, datas):
+            if self.doc_cache is not None and fields is None:
+                self.doc_cache.put(doc_ids[i], found[doc_ids[i]][0], data)
+            docs[i] = data
+        for doc_id, doc in izip(doc_ids, docs):
+            if not isinstance(doc, Exception):
+                doc['_id'] = doc_id
+                doc['_rev'] = found[doc_id][0]
+        return docs
+
+    def _with_docs(self, records, fields=None):
+        """
+        Adds ``doc`` to every record from ``records``, documents for
+        ``doc_batch`` records are read at once (see :py:meth:`_get_docs`).
+        """
+        while True:
+            batch = list(islice(records, self.doc_batch))
+            if not batch:
+                return
+            docs = self._get_docs([data['_id'] for data in batch], fields)
+            for data, doc in izip(batch, docs):
+                if isinstance(doc, Exception):
+                    raise doc
+                data['doc'] = doc
+                yield data
+
+    def get_multi(self, index_name, keys, with_doc=False, with_storage=True, fields=None):
+        """
+        Get data for many ``keys`` at once (like :py:meth:`get` for every key).
+        *Tree based indexes* sort the keys and find all of them in single
+        pass through the tree, instead of separate search for every key.
+
+        :param index_name: index to get data from
+        :param keys: iterable with keys to get
+        :param with_doc: if ``True`` data from **id** index will be included in output
+        :param with_storage: if ``True`` data from index storage will be included, otherwise just metadata.
+        :param fields: works as in :py:meth:`get`
+
+        :returns: list of found records (for *Tree based indexes* in key order), missing keys are skipped
+        """
+        try:
+            ind = self.indexes_names[index_name]
+        except KeyError:
+            self.__not_opened()
+            raise IndexNotFoundException(
+                "Index `%s` doesn't exists" % index_name)
+        self._check_ready(index_name)
+        result = []
+        for l_key, _unk, start, size, status in ind.get_multi(keys):
+            if (not start and not size) or status == 'd':
+                continue
+            if with_storage and size:
+                if index_name == 'id':
+                    data = ind.storage.get(start, size, status, fields)
+                else:
+                    data = ind.storage.get(start, size, status)
+            else:
+                data = {}
+            data['_id'] = l_key
+            if index_name == 'id':
+                data['_rev'] = _unk
+            else:
+                data['key'] = _unk
+            result.append(data)
+        if with_doc and index_name != 'id':
+            result = list(self._with_docs(iter(result), fields))
+        return result
+
+    def _cursor_state(self, index_name, cursor):
+        """
+        Decodes ``cursor`` given to :py:meth:`get_many` or :py:meth:`all`
+        into dict that is passed to index.
+        """
+        if cursor is None:
+            return None
+        if cursor is True:
+            return {}
+        try:
+            cursor_index, state = marshal.loads(
+                base64.urlsafe_b64decode(str(cursor)))
+        except (TypeError, ValueError, EOFError):
+            raise PreconditionsException("Invalid cursor")
+        if cursor_index != index_name:
+            raise PreconditionsException(
+                "Cursor is for index `%s`" % cursor_index)
+        return state
+
+    def _cursor_token(self, index_name, state):
+        return base64.urlsafe_b64encode(marshal.dumps((index_name, state)))
+
+    def get_many(self, index_name, key=None, limit=-1, offset=0, with_doc=False, with_storage=True, start=None, end=None, cursor=None, fields=None, **kwargs):
         """
         Allows to get **multiple** data for given ``key`` for *Hash based indexes*.
         Also allows get **range** queries for *Tree based indexes* with ``start`` and ``end`` arguments.
@@ -977,6 +1719,9 @@ you should check index code.""" % (index.name, ex), RuntimeWarning)
         :param with_storage: if ``True`` data from index storage will be included, otherwise just metadata.
         :param start: ``start`` parameter for range queries
         :param end: ``end`` parameter for range queries
+        :param cursor: if ``True`` every record will have ``_cursor`` field, passing it back (with the same query arguments) continues the query after that record
+        :param fields: fields of ``doc`` to return, works as in :py:meth:`get`
+        :param \*\*kwargs: passed to index, for *Tree based indexes* ``inclusive_start``, ``inclusive_end`` and ``reverse`` (records in descending key order)
 
         :returns: iterator over records
         """
@@ -989,35 +1734,50 @@ you should check index code.""" % (index.name, ex), RuntimeWarning)
             self.__not_opened()
             raise IndexNotFoundException(
                 "Index `%s` doesn't exists" % index_name)
+        self._check_ready(index_name)
         storage = ind.storage
+        state = self._cursor_state(index_name, cursor)
+        if state is not None:
+            kwargs['cursor'] = state
         if start is None and end is None:
-            gen = ind.get_many(key, limit, offset)
+            # other arguments are for range queries, they were always ignored here
+            key_kwargs = {}
+            if kwargs.get('reverse'):
+                key_kwargs['reverse'] = True
+            if state is not None:
+                key_kwargs['cursor'] = state
+            gen = ind.get_many(key, limit, offset, **key_kwargs)
         else:
             gen = ind.get_between(start, end, limit, offset, **kwargs)
-        while True:
-            try:
-#                l_key, start, size, status = gen.next()
-                ind_data = gen.next()
-            except StopIteration:
-                break
-            else:
-                if with_storage and ind_data[-2]:
-                    data = storage.get(*ind_data[-3:])
+
+        def records():
+            while True:
+                try:
+#                    l_key, start, size, status = gen.next()
+                    ind_data = gen.next()
+                except StopIteration:
+                    break
                 else:
-                    data = {}
-                doc_id = ind_data[0]
-                if with_doc:
-                    doc = self.get('id', doc_id, False)
-                    if data:
-                        data['doc'] = doc
+                    if state is not None:
+                        token = self._cursor_token(index_name, state)
+                    if with_storage and ind_data[-2]:
+                        data = storage.get(*ind_data[-3:])
                     else:
-                        data = {'doc': doc}
-                data['_id'] = doc_id
-                if key is None:
-                    data['key'] = ind_data[1]
-                yield data
+                        data = {}
+                    data['_id'] = ind_data[0]
+                    if key is None:
+                        data['key'] = ind_data[1]
+                    if state is not None:
+                        data['_cursor'] = token
+                    yield data
+        if with_doc:
+            gen_data = self._with_docs(records(), fields)
+        else:
+            gen_data = records()
+        for data in gen_data:
+            yield data
 
-    def all(self, index_name, limit=-1, offset=0, with_doc=False, with_storage=True):
+    def all(self, index_name, limit=-1, offset=0, with_doc=False, with_storage=True, cursor=None, fields=None, **kwargs):
         """
         Alows to get all records for given index
 
@@ -1026,6 +1786,9 @@ you should check index code.""" % (index.name, ex), RuntimeWarning)
         :param offset: defines offset (how many records from start it will ignore)
         :param with_doc: if ``True`` data from **id** index will be included in output
         :param with_storage: if ``True`` data from index storage will be included, otherwise just metadata
+        :param cursor: works as in :py:meth:`get_many`
+        :param fields: works as in :py:meth:`get`
+        :param \*\*kwargs: passed to index, for *Tree based indexes* ``reverse`` (records in descending key order)
         """
         try:
             ind = self.indexes_names[index_name]
@@ -1033,31 +1796,44 @@ you should check index code.""" % (index.name, ex), RuntimeWarning)
             self.__not_opened()
             raise IndexNotFoundException(
                 "Index `%s` doesn't exists" % index_name)
+        self._check_ready(index_name)
         storage = ind.storage
-        gen = ind.all(limit, offset)
-        while True:
-            try:
-                doc_id, unk, start, size, status = gen.next()
-            except StopIteration:
-                break
-            else:
-                if index_name == 'id':
-                    if with_storage and size:
-                        data = storage.get(start, size, status)
+        state = self._cursor_state(index_name, cursor)
+        if state is not None:
+            kwargs['cursor'] = state
+        gen = ind.all(limit, offset, **kwargs)
+
+        def records():
+            while True:
+                try:
+                    doc_id, unk, start, size, status = gen.next()
+                except StopIteration:
+                    break
+                else:
+                    if state is not None:
+                        token = self._cursor_token(index_name, state)
+                    if index_name == 'id':
+                        if with_storage and size:
+                            data = storage.get(start, size, status, fields)
+                        else:
+                            data = {}
+                        data['_id'] = doc_id
+                        data['_rev'] = unk
                     else:
                         data = {}
-                    data['_id'] = doc_id
-                    data['_rev'] = unk
-                else:
-                    data = {}
-                    if with_storage and size:
-                        data['value'] = storage.get(start, size, status)
-                    data['key'] = unk
-                    data['_id'] = doc_id
-                    if with_doc:
-                        doc = self.get('id', doc_id, False)
-                        data['doc'] = doc
-                yield data
+                        if with_storage and size:
+                            data['value'] = storage.get(start, size, status)
+                        data['key'] = unk
+                        data['_id'] = doc_id
+                    if state is not None:
+                        data['_cursor'] = token
+                    yield data
+        if with_doc and index_name != 'id':
+            gen_data = self._with_docs(records(), fields)
+        else:
+            gen_data = records()
+        for data in gen_data:
+            yield data
 
     def run(self, index_name, target_funct, *args, **kwargs):
         """
@@ -1078,6 +1854,7 @@ you should check index code.""" % (index.name, ex), RuntimeWarning)
             self.__not_opened()
             raise IndexNotFoundException(
                 "Index `%s` doesn't exists" % index_name)
+        self._check_ready(index_name)
         try:
             funct = getattr(ind, "run_" + target_funct)
         except AttributeError:
@@ -1130,22 +1907,30 @@ you should check index code.""" % (index.name, ex), RuntimeWarning)
             raise PreconditionsException(
                 "`_id` and `_rev` must be valid bytes object")
         data['_deleted'] = True
-        self._delete_indexes(_id, _rev, data)
+        self._write_op(self._delete_indexes, _id, _rev, data)
         return True
 
-    def compact(self):
+    def compact(self, workers=None):
         """
         Compact all indexes. Runs :py:meth:`._compact_indexes` behind.
+
+        :param workers: when given, indexes are compacted in parallel by that many processes
         """
         self.__not_opened()
-        self._compact_indexes()
+        self._compact_indexes(workers)
 
-    def reindex(self):
+    def reindex(self, indexes=None, workers=None):
         """
         Reindex all indexes. Runs :py:meth:`._reindex_indexes` behind.
+        All indexes are rebuilt in single pass through **id** index.
+
+        :param indexes: names (or instances) of indexes to reindex, all but **id** when ``None``
+        :param workers: when given, indexes are rebuilt by that many processes
+                        (each one scans documents for its part of indexes),
+                        and then moved in place of the old ones
         """
         self.__not_opened()
-        self._reindex_indexes()
+        self._reindex_indexes(indexes, workers)
 
     def flush_indexes(self):
         """
@@ -1197,9 +1982,72 @@ you should check index code.""" % (index.name, ex), RuntimeWarning)
         for key, value in db_index.__dict__.iteritems():
             if not callable(value):  # not using inspect etc...
                 props[key] = value
+        props['cache_stats'] = db_index.get_cache_stats()
+        if name == 'id' and self.doc_cache is not None:
+            props['cache_stats']['documents'] = self.doc_cache.get_stats()
 
         return props
 
+    def set_cache_budget(self, memory):
+        """
+        Splits ``memory`` (in bytes) between caches of all indexes, proportionally
+        to cache hits observed so far (see :py:meth:`get_cache_stats`),
+        so indexes that benefit from caching get more.
+        New sizes are saved in index props.
+
+        :returns: ``{index name: bytes}``
+        """
+        self.__not_opened()
+        weights = {}
+        for index in self.indexes:
+            caches = index.get_cache_stats()
+            if caches:
+                weights[index.name] = sum(curr['hits']
+                                          for curr in caches.itervalues()) + 1
+        total = float(sum(weights.itervalues()))
+        budget = {}
+        for name, weight in weights.iteritems():
+            budget[name] = int(memory * weight / total)
+            self.indexes_names[name].set_cache_size(cache_memory=budget[name])
+        return budget
+
+    def get_cache_stats(self, index_name=None):
+        """
+        Returns statistics of index caches (hits, misses, evictions, invalidations and size
+        of every cache), see :py:meth:`CodernityDB.index.Index.get_cache_stats`.
+
+        :param index_name: index to check, all indexes when ``None``
+        :returns: ``{index name: {cached function: stats}}``
+        """
+        self.__not_opened()
+        if index_name is None:
+            names = self.indexes_names.keys()
+        elif index_name in self.indexes_names:
+            names = [index_name]
+        else:
+            raise IndexNotFoundException("Index doesn't exist")
+        stats = dict((name, self.indexes_names[name].get_cache_stats())
+                     for name in names)
+        if 'id' in stats and self.doc_cache is not None:
+            stats['id']['documents'] = self.doc_cache.get_stats()
+        return stats
+
+    def reset_cache_stats(self, index_name=None):
+        """
+        Zeroes cache counters of given index (or all indexes when ``None``).
+        """
+        self.__not_opened()
+        if index_name is None:
+            indexes = self.indexes
+        elif index_name in self.indexes_names:
+            indexes = [self.indexes_names[index_name]]
+        else:
+            raise IndexNotFoundException("Index doesn't exist")
+        for index in indexes:
+            index.reset_cache_stats()
+        if index_name in (None, 'id') and self.doc_cache is not None:
+            self.doc_cache.stats.reset()
+
     def get_db_details(self):
         """
         Get's database details, size, indexes, environment etc.
@@ -28,4 +28,5 @@ from CodernityDB.database_safe_shared import SafeDatabase
 
 
 class GeventDatabase(SafeDatabase):
-    pass
+
+    threaded = False  # gevent locks can't be shared with real threads
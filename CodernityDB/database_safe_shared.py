@@ -16,7 +16,7 @@
 # limitations under the License.
 
 from CodernityDB.env import cdb_environment
-from CodernityDB.database import PreconditionsException, RevConflict, Database
+from CodernityDB.database import PreconditionsException, Database
 # from database import Database
 
 from collections import defaultdict
@@ -57,6 +57,8 @@ def safe_wrapper(method, lock):
 
 class SafeDatabase(Database):
 
+    threaded = True
+
     def __init__(self, path, *args, **kwargs):
         super(SafeDatabase, self).__init__(path, *args, **kwargs)
         self.indexes_locks = defaultdict(cdb_environment['rlock_obj'])
@@ -74,8 +76,9 @@ class SafeDatabase(Database):
             setattr(ind, c, m_fixed)
             setattr(ind, c + '_orig', m)
 
-    def __patch_index_methods(self, name):
-        ind = self.indexes_names[name]
+    def __patch_index_methods(self, name, ind=None):
+        if ind is None:
+            ind = self.indexes_names[name]
         lock = self.indexes_locks[name]
         for curr in dir(ind):
             meth = getattr(ind, curr)
@@ -140,14 +143,22 @@ class SafeDatabase(Database):
             super(SafeDatabase, self)._single_delete_index(
                 index, data, doc_id, old_data)
 
-    def edit_index(self, *args, **kwargs):
+    def edit_index(self, index, reindex=False, ind_kwargs=None, shadow=False):
         with self.main_lock:
-            res = super(SafeDatabase, self).edit_index(*args, **kwargs)
-            if self.opened:
+            res = super(SafeDatabase, self).edit_index(
+                index, reindex, ind_kwargs, shadow)
+            if self.opened and not shadow:  # shadow is patched in _swap_index
                 self.indexes_locks[res] = cdb_environment['rlock_obj']()
                 self.__patch_index(res)
             return res
 
+    def _swap_index(self, name, *args, **kwargs):
+        with self.indexes_locks[name]:
+            res = super(SafeDatabase, self)._swap_index(name, *args, **kwargs)
+            self.__patch_index(name)
+            self.__patch_index_methods(name, self.previous_indexes[name])
+            return res
+
     def set_indexes(self, *args, **kwargs):
         try:
             self.main_lock.acquire()
@@ -155,26 +166,21 @@ class SafeDatabase(Database):
         finally:
             self.main_lock.release()
 
-    def reindex_index(self, index, *args, **kwargs):
-        if isinstance(index, basestring):
-            if not index in self.indexes_names:
-                raise PreconditionsException("No index named %s" % index)
-            index = self.indexes_names[index]
-        key = index.name + "reind"
-        self.main_lock.acquire()
-        if key in self.indexes_locks:
-            lock = self.indexes_locks[index.name + "reind"]
-        else:
-            self.indexes_locks[index.name +
-                               "reind"] = cdb_environment['rlock_obj']()
-            lock = self.indexes_locks[index.name + "reind"]
-        self.main_lock.release()
-        try:
+    def _reindex_many(self, indexes, workers=None):
+        with self.main_lock:
+            locks = []
+            for index in sorted(indexes, key=lambda index: index.name):
+                key = index.name + "reind"
+                if key not in self.indexes_locks:
+                    self.indexes_locks[key] = cdb_environment['rlock_obj']()
+                locks.append(self.indexes_locks[key])
+        for lock in locks:
             lock.acquire()
-            super(SafeDatabase, self).reindex_index(
-                index, *args, **kwargs)
+        try:
+            super(SafeDatabase, self)._reindex_many(indexes, workers)
         finally:
-            lock.release()
+            for lock in reversed(locks):
+                lock.release()
 
     def flush(self):
         try:
@@ -198,8 +204,12 @@ class SafeDatabase(Database):
         with self.indexes_locks['id']:
             return super(SafeDatabase, self)._delete_id_index(_id, _rev, data)
 
-    def _update_indexes(self, _rev, data):
-        _id, new_rev, db_data = self._update_id_index(_rev, data)
+    def _patch_id_index(self, _id, _rev, changes, unset, in_place):
+        with self.indexes_locks['id']:
+            return super(SafeDatabase, self)._patch_id_index(
+                _id, _rev, changes, unset, in_place)
+
+    def _update_other_indexes(self, _id, new_rev, data, db_data, fields=None):
         with self.main_lock:
             self.id_revs[_id] = new_rev
         for index in self.indexes[1:]:
@@ -207,21 +217,20 @@ class SafeDatabase(Database):
                 curr_rev = self.id_revs.get(_id)  # get last _id, _rev
                 if curr_rev != new_rev:
                     break  # new update on the way stop current
-            self._single_update_index(index, data, db_data, _id)
+            if self._index_changed(index, data, db_data, fields):
+                self._single_update_index(index, data, db_data, _id)
         with self.main_lock:
             if self.id_revs[_id] == new_rev:
                 del self.id_revs[_id]
-        return _id, new_rev
 
     def _delete_indexes(self, _id, _rev, data):
-        old_data = self.get('id', _id)
-        if old_data['_rev'] != _rev:
-            raise RevConflict()
+        old_data = self._stored_doc(_id, _rev)
         with self.main_lock:
             self.id_revs[_id] = _rev
         for index in self.indexes[1:]:
             self._single_delete_index(index, data, _id, old_data)
         self._delete_id_index(_id, _rev, data)
+        self._log_delete(_id, old_data)
         with self.main_lock:
             if self.id_revs[_id] == _rev:
                 del self.id_revs[_id]
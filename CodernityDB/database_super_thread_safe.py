@@ -77,9 +77,14 @@ class SuperThreadSafeDatabase(Database):
 
     __metaclass__ = SuperLock
 
+    threaded = True
+
     def __init__(self, *args, **kwargs):
         super(SuperThreadSafeDatabase, self).__init__(*args, **kwargs)
 
+    def _maintenance_lock(self):
+        return self.super_lock
+
     def __patch_index_gens(self, name):
         ind = self.indexes_names[name]
         for c in ('all', 'get_many'):
@@ -111,3 +116,15 @@ class SuperThreadSafeDatabase(Database):
         res = super(SuperThreadSafeDatabase, self).edit_index(*args, **kwargs)
         self.__patch_index_gens(res)
         return res
+
+    def _swap_index(self, name, *args, **kwargs):
+        res = super(SuperThreadSafeDatabase, self)._swap_index(
+            name, *args, **kwargs)
+        self.__patch_index_gens(name)
+        return res
+
+    def _get_docs(self, doc_ids, fields=None):
+        # called by query generators, outside of public method lock
+        with self.super_lock:
+            return super(SuperThreadSafeDatabase, self)._get_docs(doc_ids,
+                                                                  fields)
@@ -29,15 +29,14 @@ import io
 import struct
 import shutil
 
-from CodernityDB.storage import IU_Storage, DummyStorage
+from CodernityDB.storage import IU_Storage, DummyStorage, FieldStorage
 
 from CodernityDB.env import cdb_environment
 
 if cdb_environment.get('rlock_obj'):
     from CodernityDB import patch
     patch.patch_cache_rr(cdb_environment['rlock_obj'])
-
-from CodernityDB.rr_cache import cache1lvl
+    patch.patch_cache_lru(cdb_environment['rlock_obj'])
 
 
 from CodernityDB.misc import random_hex_32
@@ -56,7 +55,9 @@ class IU_HashIndex(Index):
     That design is because main index logic should be always in database not in custom user indexes.
     """
 
-    def __init__(self, db_path, name, entry_line_format='<32s{key}IIcI', hash_lim=0xfffff, storage_class=None, key_format='c'):
+    _cached_1lvl = ('_find_key', '_locate_doc_id')
+
+    def __init__(self, db_path, name, entry_line_format='<32s{key}IIcI', hash_lim=0xfffff, storage_class=None, key_format='c', cache_type='lru', cache_size=100, cache_memory=None):
         """
         The index is capable to solve conflicts by `Separate chaining`
         :param db_path: database path
@@ -70,6 +71,9 @@ class IU_HashIndex(Index):
         :param storage_class: Storage class by default it will open standard :py:class:`CodernityDB.storage.Storage` (if string has to be accesible by globals()[storage_class])
         :type storage_class: class name which will be instance of CodernityDB.storage.Storage instance or None
         :param key_format: a index key format
+        :param cache_type: replacement policy of index caches (``lru``, ``2q`` or ``rr``)
+        :param cache_size: maximum number of entries in every index cache
+        :param cache_memory: memory (in bytes) for all index caches, overrides `cache_size`
         """
         if key_format and '{key}' in entry_line_format:
             entry_line_format = entry_line_format.replace('{key}', key_format)
@@ -87,9 +91,10 @@ class IU_HashIndex(Index):
         self.entry_line_format = entry_line_format
         self.entry_line_size = struct.calcsize(self.entry_line_format)
 
-        cache = cache1lvl(100)
-        self._find_key = cache(self._find_key)
-        self._locate_doc_id = cache(self._locate_doc_id)
+        self.cache_type = cache_type
+        self.cache_size = cache_size
+        self.cache_memory = cache_memory
+        self._setup_caches()
         self.bucket_struct = struct.Struct(self.bucket_line_format)
         self.entry_struct = struct.Struct(self.entry_line_format)
         self.data_start = (
@@ -121,7 +126,9 @@ class IU_HashIndex(Index):
                          entry_line_format=self.entry_line_format,
                          hash_lim=self.hash_lim,
                          version=self.__version__,
-                         storage_class=self.storage_class)
+                         storage_class=self.storage_class,
+                         cache_size=self.cache_size,
+                         cache_memory=self.cache_memory)
             f.write(marshal.dumps(props))
         self.buckets = io.open(
             os.path.join(self.db_path, self.name + "_buck"), 'r+b', buffering=0)
@@ -173,13 +180,16 @@ class IU_HashIndex(Index):
         else:
             return None, None, 0, 0, 'u'
 
-    def _find_key_many(self, key, limit=1, offset=0):
+    def _find_key_many(self, key, limit=1, offset=0, cursor=None):
         location = None
-        start_position = self._calculate_position(key)
-        self.buckets.seek(start_position)
-        curr_data = self.buckets.read(self.bucket_line_size)
-        if curr_data:
-            location = self.bucket_struct.unpack(curr_data)[0]
+        if cursor:
+            location = self._cursor_entry(cursor, key)[-1]
+        else:
+            start_position = self._calculate_position(key)
+            self.buckets.seek(start_position)
+            curr_data = self.buckets.read(self.bucket_line_size)
+            if curr_data:
+                location = self.bucket_struct.unpack(curr_data)[0]
         while offset:
             if not location:
                 break
@@ -204,10 +214,30 @@ class IU_HashIndex(Index):
             else:
                 if status != 'd':
                     if l_key == key:  # in case of hash function conflicts
+                        if cursor is not None:
+                            cursor.update(pos=found_at, doc_id=doc_id)
                         yield doc_id, start, size, status
                         limit -= 1
                 location = _next
 
+    def _cursor_entry(self, cursor, key=None):
+        """
+        Reads entry stored in ``cursor`` by ``get_many`` or ``all``.
+        Raises IndexException when the entry was changed since (reused, compacted...)
+
+        :param cursor: dict with entry position and doc_id
+        :param key: key that entry should have (``None`` to not check it)
+        """
+        self.buckets.seek(cursor['pos'])
+        data = self.buckets.read(self.entry_line_size)
+        try:
+            entry = self.entry_struct.unpack(data)
+        except struct.error:
+            raise IndexException("Cursor is no longer valid")
+        if entry[0] != cursor['doc_id'] or (key is not None and entry[1] != key):
+            raise IndexException("Cursor is no longer valid")
+        return entry
+
     def _calculate_position(self, key):
         return abs(hash(key) & self.hash_lim) * self.bucket_line_size + self._start_ind
 
@@ -382,15 +412,27 @@ class IU_HashIndex(Index):
     def get(self, key):
         return self._find_key(self.make_key(key))
 
-    def get_many(self, key, limit=1, offset=0):
-        return self._find_key_many(self.make_key(key), limit, offset)
+    def get_many(self, key, limit=1, offset=0, cursor=None):
+        """
+        ``cursor`` dict is updated with position of every returned entry,
+        passing it again continues from the next entry.
+        """
+        return self._find_key_many(self.make_key(key), limit, offset, cursor)
+
+    def _all_start(self, cursor):
+        if cursor:
+            self._cursor_entry(cursor)
+            return cursor['pos'] + self.entry_line_size
+        return self.data_start
 
-    def all(self, limit=-1, offset=0):
-        self.buckets.seek(self.data_start)
+    def all(self, limit=-1, offset=0, cursor=None):
+        location = self._all_start(cursor)
+        self.buckets.seek(location)
         while offset:
             curr_data = self.buckets.read(self.entry_line_size)
             if not curr_data:
                 break
+            location += self.entry_line_size
             try:
                 doc_id, key, start, size, status, _next = self.entry_struct.unpack(curr_data)
             except IndexException:
@@ -399,15 +441,19 @@ class IU_HashIndex(Index):
                 if status != 'd':
                     offset -= 1
         while limit:
+            self.buckets.seek(location)
             curr_data = self.buckets.read(self.entry_line_size)
             if not curr_data:
                 break
+            location += self.entry_line_size
             try:
                 doc_id, key, start, size, status, _next = self.entry_struct.unpack(curr_data)
             except IndexException:
                 break
             else:
                 if status != 'd':
+                    if cursor is not None:
+                        cursor.update(pos=location - self.entry_line_size, doc_id=doc_id)
                     yield doc_id, key, start, size, status
                     limit -= 1
 
@@ -697,12 +743,14 @@ class IU_UniqueHashIndex(IU_HashIndex):
             self._find_key.delete(key)
             return True
 
-    def all(self, limit=-1, offset=0):
-        self.buckets.seek(self.data_start)
+    def all(self, limit=-1, offset=0, cursor=None):
+        location = self._all_start(cursor)
+        self.buckets.seek(location)
         while offset:
             curr_data = self.buckets.read(self.entry_line_size)
             if not curr_data:
                 break
+            location += self.entry_line_size
             try:
                 doc_id, rev, start, size, status, next = self.entry_struct.unpack(curr_data)
             except IndexException:
@@ -712,15 +760,19 @@ class IU_UniqueHashIndex(IU_HashIndex):
                     offset -= 1
 
         while limit:
+            self.buckets.seek(location)
             curr_data = self.buckets.read(self.entry_line_size)
             if not curr_data:
                 break
+            location += self.entry_line_size
             try:
                 doc_id, rev, start, size, status, next = self.entry_struct.unpack(curr_data)
             except IndexException:
                 break
             else:
                 if status != 'd':
+                    if cursor is not None:
+                        cursor.update(pos=location - self.entry_line_size, doc_id=doc_id)
                     yield doc_id, rev, start, size, status
                     limit -= 1
 
@@ -18,6 +18,7 @@
 
 import os
 import marshal
+import functools
 
 import struct
 import shutil
@@ -41,6 +42,10 @@ class IndexNotFoundException(IndexException):
     pass
 
 
+class IndexNotReadyException(IndexException):
+    pass
+
+
 class ReindexException(IndexException):
     pass
 
@@ -65,12 +70,43 @@ class IndexPreconditionsException(IndexException):
     pass
 
 
+def cache_functions(cache_type='lru'):
+    """
+    Returns ``(cache1lvl, cache2lvl)`` decorators used by index for given ``cache_type``:
+    ``lru`` (least recently used), ``2q`` (like lru but resistant to scans)
+    or ``rr`` (random replacement).
+    """
+    # modules are looked up on call, they are patched in thread safe modes
+    if cache_type == 'rr':
+        from CodernityDB import rr_cache
+        return rr_cache.cache1lvl, rr_cache.cache2lvl
+    from CodernityDB import lru_cache
+    if cache_type == 'lru':
+        return lru_cache.cache1lvl, lru_cache.cache2lvl
+    if cache_type == '2q':
+        return (functools.partial(lru_cache.cache1lvl, policy=lru_cache.TwoQ),
+                functools.partial(lru_cache.cache2lvl, policy=lru_cache.TwoQ))
+    raise IndexPreconditionsException("Unknown cache type: %r" % cache_type)
+
+
+#: estimated memory (in bytes) taken by single cache entry, used for ``cache_memory``
+CACHE_ENTRY_SIZE = 400
+
+
 class Index(object):
 
     __version__ = __version__
 
     custom_header = ""  # : use it for imports required by your index
 
+    deferred = False  # : writes are applied in batches, after they return (see :py:class:`CodernityDB.background.IndexApplier`)
+
+    input_fields = None  # : names of document fields used by ``make_key_value``, ``None`` when unknown
+
+    #: names of methods cached by ``cache1lvl`` and ``cache2lvl`` (bigger ones)
+    _cached_1lvl = ()
+    _cached_2lvl = ()
+
     def __init__(self,
                  db_path,
                  name):
@@ -104,6 +140,58 @@ class Index(object):
         for k, v in props.iteritems():
             self.__dict__[k] = v
         self.buckets.seek(0, 2)
+        self._resize_caches()
+
+    def _cache_entries(self):
+        """
+        Returns maximum number of entries for ``(cache1lvl, cache2lvl)`` caches,
+        from ``cache_memory`` (split between all caches) or ``cache_size``.
+        """
+        if self.cache_memory:
+            units = len(self._cached_1lvl) + 1.5 * len(self._cached_2lvl)
+            size = int(self.cache_memory / (CACHE_ENTRY_SIZE * units))
+        else:
+            size = self.cache_size
+        size = max(size, 1)
+        return size, size * 3 // 2
+
+    def _setup_caches(self):
+        cache1lvl, cache2lvl = cache_functions(self.cache_type)
+        size1, size2 = self._cache_entries()
+        for names, cache in ((self._cached_1lvl, cache1lvl(size1)),
+                             (self._cached_2lvl, cache2lvl(size2))):
+            for name in names:
+                # drop already cached version, class method is left
+                self.__dict__.pop(name, None)
+                setattr(self, name, cache(getattr(self, name)))
+
+    def _resize_caches(self):
+        if not (self._cached_1lvl or self._cached_2lvl):
+            return
+        sizes = self._cache_entries()
+        for names, size in zip((self._cached_1lvl, self._cached_2lvl), sizes):
+            for name in names:
+                wrapper = getattr(self, name)
+                if not hasattr(wrapper, 'resize'):
+                    # rr and lfu caches can't be resized, build new ones
+                    self._setup_caches()
+                    return
+                wrapper.resize(size)
+
+    def set_cache_size(self, cache_size=None, cache_memory=None):
+        """
+        Changes size of index caches, given either in entries (per cache)
+        or in bytes for all caches. New sizes are saved in index props.
+        """
+        if cache_memory is None and cache_size is None:
+            raise IndexPreconditionsException(
+                "cache_size or cache_memory required")
+        if cache_size is not None:
+            self.cache_size = cache_size
+        self.cache_memory = cache_memory
+        self._save_params(dict(cache_size=self.cache_size,
+                               cache_memory=self.cache_memory))
+        self._resize_caches()
 
     def _save_params(self, in_params={}):
         self.buckets.seek(0)
@@ -139,6 +227,19 @@ class Index(object):
     def get(self, key):
         raise NotImplementedError()
 
+    def get_multi(self, keys):
+        """
+        Returns list of records for many keys (like :py:meth:`get` for every key),
+        missing keys are skipped.
+        """
+        found = []
+        for key in keys:
+            try:
+                found.append(self.get(key))
+            except ElemNotFound:
+                continue
+        return found
+
     def get_many(self, key, start_from=None, limit=0):
         raise NotImplementedError()
 
@@ -164,6 +265,26 @@ class Index(object):
         self._destroy_storage()
         self._find_key.clear()
 
+    def get_cache_stats(self):
+        """
+        Returns statistics of index caches as ``{cached function name: stats}``,
+        stats have ``hits``, ``misses``, ``evictions``, ``invalidations``,
+        ``size`` and ``maxsize`` fields.
+        """
+        stats = {}
+        for name, value in self.__dict__.iteritems():
+            if hasattr(value, 'get_stats'):
+                stats[name] = value.get_stats()
+        return stats
+
+    def reset_cache_stats(self):
+        """
+        Zeroes counters of index caches (cached entries are kept).
+        """
+        for value in self.__dict__.itervalues():
+            if hasattr(value, 'get_stats'):
+                value.stats.reset()
+
     def flush(self):
         try:
             self.buckets.flush()
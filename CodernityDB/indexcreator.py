@@ -57,10 +57,13 @@ class Parser(object):
         self.stage = 0
         self.logic = ['and', 'or', 'in']
         self.logic2 = ['&', '|']
-        self.allowed_props = {'TreeBasedIndex': ['type', 'name', 'key_format', 'node_capacity', 'pointer_format', 'meta_format'],
-                              'HashIndex': ['type', 'name', 'key_format', 'hash_lim', 'entry_line_format'],
-                              'MultiHashIndex': ['type', 'name', 'key_format', 'hash_lim', 'entry_line_format'],
-                              'MultiTreeBasedIndex': ['type', 'name', 'key_format', 'node_capacity', 'pointer_format', 'meta_format']
+        self.allowed_props = {'TreeBasedIndex': ['type', 'name', 'key_format', 'node_capacity', 'pointer_format', 'meta_format', 'cache_type', 'cache_size', 'cache_memory'],
+                              'HashIndex': ['type', 'name', 'key_format', 'hash_lim', 'entry_line_format', 'cache_type', 'cache_size', 'cache_memory'],
+                              'MultiHashIndex': ['type', 'name', 'key_format', 'hash_lim', 'entry_line_format', 'cache_type', 'cache_size', 'cache_memory'],
+                              'MultiTreeBasedIndex': ['type', 'name', 'key_format', 'node_capacity', 'pointer_format', 'meta_format', 'cache_type', 'cache_size', 'cache_memory'],
+                              'CountedTreeBasedIndex': ['type', 'name', 'key_format', 'node_capacity', 'pointer_format', 'meta_format', 'cache_type', 'cache_size', 'cache_memory'],
+                              'AggregatedTreeBasedIndex': ['type', 'name', 'key_format', 'value_field', 'node_capacity', 'pointer_format', 'meta_format', 'cache_type', 'cache_size', 'cache_memory'],
+                              'CompositeTreeBasedIndex': ['type', 'name', 'key_parts', 'key_codec', 'node_capacity', 'pointer_format', 'meta_format', 'cache_type', 'cache_size', 'cache_memory']
                               }
         self.funcs = {'md5': (['md5'], ['.digest()']),
                       'len': (['len'], []),
@@ -273,6 +276,7 @@ class Parser(object):
         self.last_line = [-1, -1, -1]
         self.props_set = []
         self.custom_header = set()
+        self.input_fields = []  # None when make_key_value uses whole data
 
         self.tokens = []
         self.tokens_head = ['# %s\n' % self.name, 'class %s(' % self.name, '):\n', '    def __init__(self, *args, **kwargs):        ']
@@ -329,6 +333,9 @@ class Parser(object):
             if self.funcs_with_body[i][1]:
                 self.tokens_head.insert(4, self.funcs_with_body[i][0])
 
+        if self.input_fields is not None:
+            self.tokens_head.insert(4, '    input_fields = %r\n' % (tuple(self.input_fields), ))
+
         if None in self.custom_header:
             self.custom_header.remove(None)
         if self.custom_header:
@@ -554,6 +561,12 @@ class Parser(object):
                         self.custom_header.add("from CodernityDB.tree_index import TreeBasedIndex\n")
                     elif d[2][1] == "MultiTreeBasedIndex":
                         self.custom_header.add("from CodernityDB.tree_index import MultiTreeBasedIndex\n")
+                    elif d[2][1] == "CountedTreeBasedIndex":
+                        self.custom_header.add("from CodernityDB.tree_index import CountedTreeBasedIndex\n")
+                    elif d[2][1] == "AggregatedTreeBasedIndex":
+                        self.custom_header.add("from CodernityDB.tree_index import AggregatedTreeBasedIndex\n")
+                    elif d[2][1] == "CompositeTreeBasedIndex":
+                        self.custom_header.add("from CodernityDB.tree_index import CompositeTreeBasedIndex\n")
                     elif d[2][1] == "MultiHashIndex":
                         self.custom_header.add("from CodernityDB.hash_index import MultiHashIndex\n")
                     self.tokens_head.insert(2, tk)
@@ -630,6 +643,8 @@ class Parser(object):
         if t == token.NAME and tk not in self.logic and tk != hdata:
             if tk not in self.funcs:
                 self.tokens += [hdata + '["' + tk + '"]']
+                if stage == 1 and self.input_fields is not None and tk not in self.input_fields:
+                    self.input_fields.append(tk)
             else:
                 self.tokens += self.funcs[tk][0]
                 if tk in self.funcs_with_body:
@@ -638,6 +653,8 @@ class Parser(object):
                 self.custom_header.add(self.handle_int_imports.get(tk))
                 self.funcs_stack += [(tk, self.cur_brackets)]
         else:
+            if stage == 1 and tk == hdata:
+                self.input_fields = None
             self.tokens += [tk]
 
     def handle_make_value(self, t, tk, pos_start, pos_end, line):
@@ -0,0 +1,274 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Copyright 2011-2013 Codernity (http://codernity.com)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Order preserving binary encoding of index keys.
+
+Encoded keys compare (as byte strings) in the same order as the values
+they were made from, so they can be stored in tree indexes.
+"""
+
+import re
+import struct
+from datetime import datetime, date, timedelta
+
+from CodernityDB.index import IndexPreconditionsException
+
+
+_INVERT = ''.join(chr(255 - x) for x in xrange(256))
+
+
+class KeyCodecException(IndexPreconditionsException):
+    pass
+
+
+class IntCodec(object):
+
+    """
+    Integers, signed ones (``bhilq``) are shifted to be non negative.
+    """
+
+    def __init__(self, fmt):
+        self.fmt = '>' + fmt.upper()
+        self.size = struct.calcsize(self.fmt)
+        self.shift = 1 << (self.size * 8 - 1) if fmt.islower() else 0
+
+    def encode(self, value):
+        if not isinstance(value, (int, long)):
+            raise KeyCodecException("Not an integer: %r" % (value, ))
+        try:
+            return struct.pack(self.fmt, value + self.shift)
+        except struct.error as ex:
+            raise KeyCodecException(str(ex))
+
+    def decode(self, data):
+        return int(struct.unpack(self.fmt, data)[0] - self.shift)
+
+
+class FloatCodec(object):
+
+    """
+    IEEE 754 floats (``f`` and ``d``), sign bit is flipped for positive
+    numbers and all bits are flipped for negative ones.
+    """
+
+    def __init__(self, fmt):
+        self.fmt = '>' + fmt
+        self.size = struct.calcsize(self.fmt)
+        self.int_fmt = '>I' if self.size == 4 else '>Q'
+        self.sign = 1 << (self.size * 8 - 1)
+        self.mask = (1 << (self.size * 8)) - 1
+
+    def encode(self, value):
+        try:
+            bits = struct.unpack(self.int_fmt, struct.pack(self.fmt, value))[0]
+        except struct.error as ex:
+            raise KeyCodecException(str(ex))
+        if bits & self.sign:
+            bits = ~bits & self.mask
+        else:
+            bits |= self.sign
+        return struct.pack(self.int_fmt, bits)
+
+    def decode(self, data):
+        bits = struct.unpack(self.int_fmt, data)[0]
+        if bits & self.sign:
+            bits &= ~self.sign
+        else:
+            bits = ~bits & self.mask
+        return struct.unpack(self.fmt, struct.pack(self.int_fmt, bits))[0]
+
+
+class StringCodec(object):
+
+    """
+    Strings with fixed width (``16s``), unicode is stored as utf-8,
+    shorter values are padded with ``\\x00``. Decoded values are byte strings.
+    """
+
+    def __init__(self, fmt):
+        self.size = struct.calcsize(fmt)
+
+    def encode(self, value):
+        if isinstance(value, unicode):
+            value = value.encode('utf8')
+        if len(value) > self.size:
+            raise KeyCodecException(
+                "Value longer than %d bytes: %r" % (self.size, value))
+        return value + '\x00' * (self.size - len(value))
+
+    def decode(self, data):
+        return data.rstrip('\x00')
+
+
+class DescendingCodec(object):
+
+    """
+    Reverses order of other codec by inverting its bytes.
+    """
+
+    def __init__(self, codec):
+        self.codec = codec
+        self.size = codec.size
+
+    def encode(self, value):
+        return self.codec.encode(value).translate(_INVERT)
+
+    def decode(self, data):
+        return self.codec.decode(data.translate(_INVERT))
+
+
+class DateTimeCodec(object):
+
+    """
+    Datetimes stored as microseconds since epoch, timezone aware values
+    are converted to UTC. Decoded values are naive (UTC) datetimes.
+    """
+
+    epoch = datetime(1970, 1, 1)
+
+    def __init__(self, fmt):
+        self.codec = IntCodec('q')
+        self.size = self.codec.size
+
+    def encode(self, value):
+        if not isinstance(value, datetime):
+            raise KeyCodecException("Not a datetime: %r" % (value, ))
+        if value.tzinfo is not None:
+            value = value.replace(tzinfo=None) - value.utcoffset()
+        delta = value - self.epoch
+        return self.codec.encode(
+            (delta.days * 86400 + delta.seconds) * 1000000 + delta.microseconds)
+
+    def decode(self, data):
+        return self.epoch + timedelta(microseconds=self.codec.decode(data))
+
+
+class DateCodec(object):
+
+    """
+    Dates stored as proleptic Gregorian ordinal.
+    """
+
+    def __init__(self, fmt):
+        self.codec = IntCodec('i')
+        self.size = self.codec.size
+
+    def encode(self, value):
+        if not isinstance(value, date):
+            raise KeyCodecException("Not a date: %r" % (value, ))
+        return self.codec.encode(value.toordinal())
+
+    def decode(self, data):
+        return date.fromordinal(self.codec.decode(data))
+
+
+#: named key part formats, see :py:func:`register_key_codec`
+key_codecs = {}
+
+
+def register_key_codec(name, codec_class):
+    """
+    Makes ``codec_class`` available as key part format ``name``.
+    Codec is created with the format as only argument, it has to provide
+    ``size`` and ``encode`` / ``decode`` methods, encoded values must
+    compare like the values.
+    """
+    key_codecs[name] = codec_class
+
+
+register_key_codec('int', lambda fmt: IntCodec('q'))
+register_key_codec('uint', lambda fmt: IntCodec('Q'))
+register_key_codec('float', lambda fmt: FloatCodec('d'))
+register_key_codec('datetime', DateTimeCodec)
+register_key_codec('date', DateCodec)
+
+
+def part_codec(part):
+    """
+    Returns codec for single key part described by struct like format
+    or registered name, ``-`` in front of it means descending order
+    (``-q``, ``-16s``, ``-datetime``).
+    """
+    if part.startswith('-'):
+        return DescendingCodec(part_codec(part[1:]))
+    if part in key_codecs:
+        return key_codecs[part](part)
+    if part in ('f', 'd'):
+        return FloatCodec(part)
+    if len(part) == 1 and part in 'bhilqBHILQ':
+        return IntCodec(part)
+    if part.endswith('s') and part[:-1].isdigit():
+        return StringCodec(part)
+    raise KeyCodecException("Unsupported key part format: %r" % part)
+
+
+class CompositeKey(object):
+
+    """
+    Encodes tuples of values into byte strings that compare like the tuples.
+
+    :param parts: list of key parts formats, for example ``['16s', 'q', '-d']``
+        (or string with formats separated by commas)
+    :param single: if ``True`` keys are single values instead of tuples (only one part allowed)
+    """
+
+    def __init__(self, parts, single=False):
+        if isinstance(parts, basestring):
+            parts = re.split('[\s,]+', parts.strip())
+        self.parts = list(parts)
+        self.single = single
+        if single and len(self.parts) != 1:
+            raise KeyCodecException("Single value key must have one part")
+        self.codecs = [part_codec(part) for part in self.parts]
+        self.size = sum(codec.size for codec in self.codecs)
+        self.key_format = '%ds' % self.size
+
+    def _encode_parts(self, values):
+        if self.single or not isinstance(values, (tuple, list)):
+            values = (values, )
+        if len(values) > len(self.codecs):
+            raise KeyCodecException("Too many key parts: %r" % (values, ))
+        return ''.join(codec.encode(value)
+                       for codec, value in zip(self.codecs, values))
+
+    def encode(self, values):
+        """
+        Encodes full key, all parts are required.
+        """
+        data = self._encode_parts(values)
+        if len(data) != self.size:
+            raise KeyCodecException("Not enough key parts: %r" % (values, ))
+        return data
+
+    def encode_prefix(self, values, high=False):
+        """
+        Encodes first parts of key, the rest is filled so the result is
+        smaller (or bigger with ``high``) than every key with that prefix.
+        """
+        data = self._encode_parts(values)
+        return data + ('\xff' if high else '\x00') * (self.size - len(data))
+
+    def decode(self, data):
+        values = []
+        pos = 0
+        for codec in self.codecs:
+            values.append(codec.decode(data[pos:pos + codec.size]))
+            pos += codec.size
+        if self.single:
+            return values[0]
+        return tuple(values)
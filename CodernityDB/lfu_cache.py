@@ -21,6 +21,8 @@ from heapq import nsmallest
 from operator import itemgetter
 from collections import defaultdict
 
+from CodernityDB.misc import CacheStats
+
 try:
     from collections import Counter
 except ImportError:
@@ -39,25 +41,31 @@ def cache1lvl(maxsize=100):
     def decorating_function(user_function):
         cache = {}
         use_count = Counter()
+        stats = CacheStats()
 
         @functools.wraps(user_function)
         def wrapper(key, *args, **kwargs):
             try:
                 result = cache[key]
             except KeyError:
+                stats.misses += 1
                 if len(cache) == maxsize:
                     for k, _ in nsmallest(maxsize // 10 or 1,
                                           use_count.iteritems(),
                                           key=itemgetter(1)):
                         del cache[k], use_count[k]
+                        stats.evictions += 1
                 cache[key] = user_function(key, *args, **kwargs)
                 result = cache[key]
                 # result = user_function(obj, key, *args, **kwargs)
+            else:
+                stats.hits += 1
             finally:
                 use_count[key] += 1
             return result
 
         def clear():
+            stats.invalidations += len(cache)
             cache.clear()
             use_count.clear()
 
@@ -68,11 +76,17 @@ def cache1lvl(maxsize=100):
             except KeyError:
                 return False
             else:
+                stats.invalidations += 1
                 return True
 
+        def get_stats():
+            return stats.as_dict(len(cache), maxsize)
+
         wrapper.clear = clear
         wrapper.cache = cache
         wrapper.delete = delete
+        wrapper.stats = stats
+        wrapper.get_stats = get_stats
         return wrapper
     return decorating_function
 
@@ -90,6 +104,7 @@ def cache2lvl(maxsize=100):
     def decorating_function(user_function):
         cache = {}
         use_count = defaultdict(Counter)
+        stats = CacheStats()
 
         @functools.wraps(user_function)
         def wrapper(*args, **kwargs):
@@ -97,6 +112,7 @@ def cache2lvl(maxsize=100):
             try:
                 result = cache[args[0]][args[1]]
             except KeyError:
+                stats.misses += 1
                 if wrapper.cache_size == maxsize:
                     to_delete = maxsize // 10 or 1
                     for k1, k2, v in nsmallest(to_delete,
@@ -107,19 +123,24 @@ def cache2lvl(maxsize=100):
                             del cache[k1]
                             del use_count[k1]
                     wrapper.cache_size -= to_delete
+                    stats.evictions += to_delete
                 result = user_function(*args, **kwargs)
                 try:
                     cache[args[0]][args[1]] = result
                 except KeyError:
                     cache[args[0]] = {args[1]: result}
                 wrapper.cache_size += 1
+            else:
+                stats.hits += 1
             finally:
                 use_count[args[0]][args[1]] += 1
             return result
 
         def clear():
+            stats.invalidations += wrapper.cache_size
             cache.clear()
             use_count.clear()
+            wrapper.cache_size = 0
 
         def delete(key, inner_key=None):
             if inner_key is not None:
@@ -133,10 +154,12 @@ def cache2lvl(maxsize=100):
                 except KeyError:
                     return False
                 else:
+                    stats.invalidations += 1
                     return True
             else:
                 try:
                     wrapper.cache_size -= len(cache[key])
+                    stats.invalidations += len(cache[key])
                     del cache[key]
                     del use_count[key]
                 except KeyError:
@@ -144,9 +167,14 @@ def cache2lvl(maxsize=100):
                 else:
                     return True
 
+        def get_stats():
+            return stats.as_dict(wrapper.cache_size, maxsize)
+
         wrapper.clear = clear
         wrapper.cache = cache
         wrapper.delete = delete
+        wrapper.stats = stats
+        wrapper.get_stats = get_stats
         wrapper.cache_size = 0
         return wrapper
     return decorating_function
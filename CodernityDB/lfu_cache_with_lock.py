@@ -21,6 +21,8 @@ from heapq import nsmallest
 from operator import itemgetter
 from collections import defaultdict
 
+from CodernityDB.misc import CacheStats
+
 
 try:
     from collections import Counter
@@ -47,6 +49,7 @@ def create_cache1lvl(lock_obj):
         def decorating_function(user_function):
             cache = {}
             use_count = Counter()
+            stats = CacheStats()
             lock = lock_obj()
 
             @functools.wraps(user_function)
@@ -55,20 +58,24 @@ def create_cache1lvl(lock_obj):
                     result = cache[key]
                 except KeyError:
                     with lock:
+                        stats.misses += 1
                         if len(cache) == maxsize:
                             for k, _ in nsmallest(maxsize // 10 or 1,
                                                   use_count.iteritems(),
                                                   key=itemgetter(1)):
                                 del cache[k], use_count[k]
+                                stats.evictions += 1
                         cache[key] = user_function(key, *args, **kwargs)
                         result = cache[key]
                         use_count[key] += 1
                 else:
                     with lock:
                         use_count[key] += 1
+                        stats.hits += 1
                 return result
 
             def clear():
+                stats.invalidations += len(cache)
                 cache.clear()
                 use_count.clear()
 
@@ -76,13 +83,19 @@ def create_cache1lvl(lock_obj):
                 try:
                     del cache[key]
                     del use_count[key]
+                    stats.invalidations += 1
                     return True
                 except KeyError:
                     return False
 
+            def get_stats():
+                return stats.as_dict(len(cache), maxsize)
+
             wrapper.clear = clear
             wrapper.cache = cache
             wrapper.delete = delete
+            wrapper.stats = stats
+            wrapper.get_stats = get_stats
             return wrapper
         return decorating_function
     return cache1lvl
@@ -96,6 +109,7 @@ def create_cache2lvl(lock_obj):
         def decorating_function(user_function):
             cache = {}
             use_count = defaultdict(Counter)
+            stats = CacheStats()
             lock = lock_obj()
 
             @functools.wraps(user_function)
@@ -104,6 +118,7 @@ def create_cache2lvl(lock_obj):
                     result = cache[args[0]][args[1]]
                 except KeyError:
                     with lock:
+                        stats.misses += 1
                         if wrapper.cache_size == maxsize:
                             to_delete = maxsize / 10 or 1
                             for k1, k2, v in nsmallest(to_delete,
@@ -115,6 +130,7 @@ def create_cache2lvl(lock_obj):
                                     del cache[k1]
                                     del use_count[k1]
                             wrapper.cache_size -= to_delete
+                            stats.evictions += to_delete
                         result = user_function(*args, **kwargs)
                         try:
                             cache[args[0]][args[1]] = result
@@ -124,11 +140,14 @@ def create_cache2lvl(lock_obj):
                         wrapper.cache_size += 1
                 else:
                     use_count[args[0]][args[1]] += 1
+                    stats.hits += 1
                 return result
 
             def clear():
+                stats.invalidations += wrapper.cache_size
                 cache.clear()
                 use_count.clear()
+                wrapper.cache_size = 0
 
             def delete(key, *args):
                 if args:
@@ -139,21 +158,28 @@ def create_cache2lvl(lock_obj):
                             del cache[key]
                             del use_count[key]
                         wrapper.cache_size -= 1
+                        stats.invalidations += 1
                         return True
                     except KeyError:
                         return False
                 else:
                     try:
                         wrapper.cache_size -= len(cache[key])
+                        stats.invalidations += len(cache[key])
                         del cache[key]
                         del use_count[key]
                         return True
                     except KeyError:
                         return False
 
+            def get_stats():
+                return stats.as_dict(wrapper.cache_size, maxsize)
+
             wrapper.clear = clear
             wrapper.cache = cache
             wrapper.delete = delete
+            wrapper.stats = stats
+            wrapper.get_stats = get_stats
             wrapper.cache_size = 0
             return wrapper
         return decorating_function
@@ -0,0 +1,510 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Copyright 2011-2013 Codernity (http://codernity.com)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import functools
+import marshal
+from itertools import count
+
+from CodernityDB.misc import CacheStats
+
+
+#: returned by ``put`` when nothing was evicted
+NOTHING = object()
+
+PREV, NEXT, KEY, VALUE = 0, 1, 2, 3
+
+
+class LinkedMap(object):
+
+    """
+    Dict with entries kept in circular doubly linked list from the oldest
+    to the newest one, all operations are O(1).
+    """
+
+    def __init__(self):
+        self.map = {}
+        self.root = root = []
+        root[:] = [root, root, None, None]
+
+    def __len__(self):
+        return len(self.map)
+
+    def __contains__(self, key):
+        return key in self.map
+
+    def peek(self, key):
+        return self.map[key][3]  # VALUE
+
+    def touch(self, key):
+        """
+        Marks entry as the newest one and returns its value.
+        """
+        link = self.map[key]
+        link_prev, link_next = link[PREV], link[NEXT]
+        link_prev[NEXT] = link_next
+        link_next[PREV] = link_prev
+        root = self.root
+        last = root[PREV]
+        last[NEXT] = root[PREV] = link
+        link[PREV] = last
+        link[NEXT] = root
+        return link[VALUE]
+
+    def push(self, key, value):
+        root = self.root
+        last = root[PREV]
+        last[NEXT] = root[PREV] = self.map[key] = [last, root, key, value]
+
+    def pop_oldest(self):
+        root = self.root
+        link = root[NEXT]
+        del self.map[link[KEY]]
+        root[NEXT] = link[NEXT]
+        link[NEXT][PREV] = root
+        return link[KEY], link[VALUE]
+
+    def discard(self, key):
+        try:
+            link = self.map.pop(key)
+        except KeyError:
+            return False
+        link[PREV][NEXT] = link[NEXT]
+        link[NEXT][PREV] = link[PREV]
+        return True
+
+    def clear(self):
+        self.map.clear()
+        self.root[:] = [self.root, self.root, None, None]
+
+
+class LRU(object):
+
+    """
+    Evicts the least recently used entry.
+    """
+
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self.entries = LinkedMap()
+        # bound directly, saves a call on every hit
+        self.get = self.entries.touch
+        self.peek = self.entries.peek
+
+    def __len__(self):
+        return len(self.entries)
+
+    def put(self, key, value):
+        """
+        Stores value, returns key of evicted entry or :py:data:`NOTHING`.
+        """
+        evicted = NOTHING
+        entries = self.entries
+        if not entries.discard(key) and len(entries) >= self.maxsize:
+            evicted = entries.pop_oldest()[0]
+        entries.push(key, value)
+        return evicted
+
+    def discard(self, key):
+        return self.entries.discard(key)
+
+    def resize(self, maxsize):
+        """
+        Changes maximum size, returns keys of evicted entries.
+        """
+        self.maxsize = maxsize
+        evicted = []
+        while len(self.entries) > maxsize:
+            evicted.append(self.entries.pop_oldest()[0])
+        return evicted
+
+    def clear(self):
+        self.entries.clear()
+
+
+class TwoQ(object):
+
+    """
+    2Q replacement. New entries go to FIFO queue (quarter of the cache),
+    keys pushed out of it are remembered for a while (without values).
+    Entry requested again in that time goes to the main LRU queue, so
+    entries used once (for example by a scan) don't evict the hot ones.
+    """
+
+    def __init__(self, maxsize):
+        self.main = LinkedMap()
+        self.new = LinkedMap()
+        self.ghosts = LinkedMap()
+        self.resize(maxsize)
+
+    def __len__(self):
+        return len(self.main) + len(self.new)
+
+    def get(self, key):
+        try:
+            return self.main.touch(key)
+        except KeyError:
+            return self.new.peek(key)
+
+    def peek(self, key):
+        try:
+            return self.main.peek(key)
+        except KeyError:
+            return self.new.peek(key)
+
+    def _reclaim(self):
+        if len(self.new) > self.in_size or not self.main:
+            key = self.new.pop_oldest()[0]
+            self.ghosts.push(key, None)
+            if len(self.ghosts) > self.out_size:
+                self.ghosts.pop_oldest()
+            return key
+        return self.main.pop_oldest()[0]
+
+    def put(self, key, value):
+        """
+        Stores value, returns key of evicted entry or :py:data:`NOTHING`.
+        """
+        evicted = NOTHING
+        if not self.discard(key) and len(self) >= self.maxsize:
+            evicted = self._reclaim()
+        if self.ghosts.discard(key):
+            self.main.push(key, value)
+        else:
+            self.new.push(key, value)
+        return evicted
+
+    def discard(self, key):
+        return self.main.discard(key) or self.new.discard(key)
+
+    def resize(self, maxsize):
+        """
+        Changes maximum size, returns keys of evicted entries.
+        """
+        self.maxsize = maxsize
+        self.in_size = max(maxsize // 4, 1)
+        self.out_size = max(maxsize // 2, 1)
+        evicted = []
+        while len(self) > maxsize:
+            evicted.append(self._reclaim())
+        while len(self.ghosts) > self.out_size:
+            self.ghosts.pop_oldest()
+        return evicted
+
+    def clear(self):
+        self.main.clear()
+        self.new.clear()
+        self.ghosts.clear()
+
+
+def cache1lvl(maxsize=100, policy=LRU):
+    def decorating_function(user_function):
+        cache = policy(maxsize)
+        stats = CacheStats()
+
+        @functools.wraps(user_function)
+        def wrapper(key, *args, **kwargs):
+            try:
+                result = cache.get(key)
+            except KeyError:
+                pass
+            else:
+                stats.hits += 1
+                return result
+            stats.misses += 1
+            result = user_function(key, *args, **kwargs)
+            if cache.put(key, result) is not NOTHING:
+                stats.evictions += 1
+            return result
+
+        def clear():
+            stats.invalidations += len(cache)
+            cache.clear()
+
+        def delete(key):
+            if cache.discard(key):
+                stats.invalidations += 1
+                return True
+            return False
+
+        def resize(maxsize):
+            stats.evictions += len(cache.resize(maxsize))
+
+        def get_stats():
+            return stats.as_dict(len(cache), cache.maxsize)
+
+        wrapper.clear = clear
+        wrapper.cache = cache
+        wrapper.delete = delete
+        wrapper.resize = resize
+        wrapper.stats = stats
+        wrapper.get_stats = get_stats
+        return wrapper
+    return decorating_function
+
+
+def cache2lvl(maxsize=100, policy=LRU):
+    def decorating_function(user_function):
+        cache = policy(maxsize)
+        inner_keys = {}
+        stats = CacheStats()
+
+        @functools.wraps(user_function)
+        def wrapper(*args, **kwargs):
+            key = args[0], args[1]
+            try:
+                result = cache.get(key)
+            except KeyError:
+                pass
+            else:
+                stats.hits += 1
+                return result
+            stats.misses += 1
+            result = user_function(*args, **kwargs)
+            evicted = cache.put(key, result)
+            if evicted is not NOTHING:
+                stats.evictions += 1
+                keys = inner_keys[evicted[0]]
+                keys.discard(evicted[1])
+                if not keys:
+                    del inner_keys[evicted[0]]
+            try:
+                inner_keys[args[0]].add(args[1])
+            except KeyError:
+                inner_keys[args[0]] = set([args[1]])
+            return result
+
+        def clear():
+            stats.invalidations += len(cache)
+            cache.clear()
+            inner_keys.clear()
+
+        def delete(key, *args):
+            if args:
+                if not cache.discard((key, args[0])):
+                    return False
+                stats.invalidations += 1
+                keys = inner_keys[key]
+                keys.discard(args[0])
+                if not keys:
+                    del inner_keys[key]
+                return True
+            try:
+                keys = inner_keys.pop(key)
+            except KeyError:
+                return False
+            for inner_key in keys:
+                cache.discard((key, inner_key))
+            stats.invalidations += len(keys)
+            return True
+
+        def resize(maxsize):
+            for key1, key2 in cache.resize(maxsize):
+                stats.evictions += 1
+                keys = inner_keys[key1]
+                keys.discard(key2)
+                if not keys:
+                    del inner_keys[key1]
+
+        def get_stats():
+            return stats.as_dict(len(cache), cache.maxsize)
+
+        wrapper.clear = clear
+        wrapper.cache = cache
+        wrapper.delete = delete
+        wrapper.resize = resize
+        wrapper.stats = stats
+        wrapper.get_stats = get_stats
+        return wrapper
+    return decorating_function
+
+
+class NoLock(object):
+
+    def __enter__(self):
+        pass
+
+    def __exit__(self, *args):
+        pass
+
+    def acquire(self, blocking=True):
+        return True
+
+    def release(self):
+        pass
+
+
+#: maximum number of independently locked segments of single cache
+SEGMENTS = 8
+#: segments are not made smaller than that (in entries)
+SEGMENT_MIN_SIZE = 32
+#: hits are applied to segment policy in batches of that size
+READ_BUFFER_SIZE = 16
+
+
+class Segment(object):
+
+    __slots__ = ('policy', 'lock', 'stats', 'inner_keys', 'unlocked_hits',
+                 'read_buffer')
+
+    def __init__(self, policy, lock):
+        self.policy = policy
+        self.lock = lock
+        self.stats = CacheStats()
+        self.inner_keys = {}
+        # hits served without lock, next() on count is atomic
+        self.unlocked_hits = count()
+        self.read_buffer = []
+
+    def peek(self, key):
+        """
+        Returns value without taking the lock (dict reads and list appends
+        are atomic), hit is recorded in read buffer and applied to policy
+        later, when the lock is free.
+        """
+        result = self.policy.peek(key)
+        buff = self.read_buffer
+        buff.append(key)
+        if len(buff) >= READ_BUFFER_SIZE and self.lock.acquire(False):
+            try:
+                self.read_buffer = []
+                get = self.policy.get
+                for key in buff:
+                    try:
+                        get(key)
+                    except KeyError:
+                        pass
+            finally:
+                self.lock.release()
+        next(self.unlocked_hits)
+        return result
+
+
+class SegmentedCache(object):
+
+    """
+    Cache split into segments selected by key hash. Every segment has its own
+    policy, lock and counters, so threads using different keys don't wait
+    for each other.
+    """
+
+    def __init__(self, maxsize, policy=LRU, lock_obj=None, segments=None):
+        if segments is None:
+            segments = min(SEGMENTS, maxsize // SEGMENT_MIN_SIZE) or 1
+        self.policy = policy
+        self.segments = [Segment(policy(size), lock_obj() if lock_obj else NoLock())
+                         for size in self._split(maxsize, segments)]
+
+    @staticmethod
+    def _split(maxsize, parts):
+        return [max(maxsize // parts + (i < maxsize % parts), 1)
+                for i in xrange(parts)]
+
+    def __len__(self):
+        return sum(len(segment.policy) for segment in self.segments)
+
+    @property
+    def maxsize(self):
+        return sum(segment.policy.maxsize for segment in self.segments)
+
+    def segment(self, key):
+        return self.segments[hash(key) % len(self.segments)]
+
+    def resize(self, maxsize, on_evict=None):
+        """
+        Changes maximum size, ``on_evict(segment, key)`` is called (with
+        segment locked) for every evicted entry.
+        """
+        sizes = self._split(maxsize, len(self.segments))
+        for segment, size in zip(self.segments, sizes):
+            with segment.lock:
+                keys = segment.policy.resize(size)
+                segment.stats.evictions += len(keys)
+                if on_evict:
+                    for key in keys:
+                        on_evict(segment, key)
+
+    def reset(self):
+        for segment in self.segments:
+            with segment.lock:
+                segment.stats.reset()
+                segment.unlocked_hits = count()
+
+    def get_stats(self):
+        stats = dict.fromkeys(CacheStats.__slots__, 0)
+        for segment in self.segments:
+            for name in CacheStats.__slots__:
+                stats[name] += getattr(segment.stats, name)
+            stats['hits'] += segment.unlocked_hits.__reduce__()[1][0]
+        stats['size'] = len(self)
+        stats['maxsize'] = self.maxsize
+        return stats
+
+
+class DocumentCache(object):
+
+    """
+    LRU cache of documents by ``_id``. Documents are kept marshalled with
+    their revision, so every hit returns new copy and documents with other
+    revision than requested are never returned.
+    """
+
+    def __init__(self, maxsize, lock_obj=None):
+        self.cache = SegmentedCache(maxsize, LRU, lock_obj)
+        self.stats = self.cache
+
+    def get(self, doc_id, rev):
+        """
+        Returns copy of document or ``None`` when not cached.
+        """
+        segment = self.cache.segment(doc_id)
+        with segment.lock:
+            try:
+                cached_rev, data = segment.policy.get(doc_id)
+            except KeyError:
+                cached_rev = None
+            if cached_rev != rev:
+                segment.stats.misses += 1
+                return None
+            segment.stats.hits += 1
+        return marshal.loads(data)
+
+    def put(self, doc_id, rev, doc):
+        try:
+            data = marshal.dumps(doc)
+        except ValueError:  # custom storage, not marshallable
+            return
+        segment = self.cache.segment(doc_id)
+        with segment.lock:
+            if segment.policy.put(doc_id, (rev, data)) is not NOTHING:
+                segment.stats.evictions += 1
+
+    def delete(self, doc_id):
+        segment = self.cache.segment(doc_id)
+        with segment.lock:
+            if segment.policy.discard(doc_id):
+                segment.stats.invalidations += 1
+                return True
+            return False
+
+    def clear(self):
+        for segment in self.cache.segments:
+            with segment.lock:
+                segment.stats.invalidations += len(segment.policy)
+                segment.policy.clear()
+
+    def get_stats(self):
+        return self.cache.get_stats()
@@ -0,0 +1,160 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Copyright 2011-2013 Codernity (http://codernity.com)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import functools
+
+from CodernityDB.lru_cache import LRU, NOTHING, SegmentedCache
+
+
+def create_cache1lvl(lock_obj):
+    def cache1lvl(maxsize=100, policy=LRU, segments=None):
+        def decorating_function(user_function):
+            cache = SegmentedCache(maxsize, policy, lock_obj, segments)
+            all_segments = cache.segments
+            nr_of_segments = len(all_segments)
+
+            @functools.wraps(user_function)
+            def wrapper(key, *args, **kwargs):
+                segment = all_segments[hash(key) % nr_of_segments]
+                try:
+                    return segment.peek(key)
+                except KeyError:
+                    pass
+                with segment.lock:
+                    try:
+                        # could be added while waiting for the lock
+                        result = segment.policy.get(key)
+                    except KeyError:
+                        pass
+                    else:
+                        segment.stats.hits += 1
+                        return result
+                    segment.stats.misses += 1
+                    result = user_function(key, *args, **kwargs)
+                    if segment.policy.put(key, result) is not NOTHING:
+                        segment.stats.evictions += 1
+                    return result
+
+            def clear():
+                for segment in all_segments:
+                    with segment.lock:
+                        segment.stats.invalidations += len(segment.policy)
+                        segment.policy.clear()
+
+            def delete(key):
+                segment = all_segments[hash(key) % nr_of_segments]
+                with segment.lock:
+                    if segment.policy.discard(key):
+                        segment.stats.invalidations += 1
+                        return True
+                    return False
+
+            def resize(maxsize):
+                cache.resize(maxsize)
+
+            wrapper.clear = clear
+            wrapper.cache = cache
+            wrapper.delete = delete
+            wrapper.resize = resize
+            wrapper.stats = cache
+            wrapper.get_stats = cache.get_stats
+            return wrapper
+        return decorating_function
+    return cache1lvl
+
+
+def create_cache2lvl(lock_obj):
+    def cache2lvl(maxsize=100, policy=LRU, segments=None):
+        def decorating_function(user_function):
+            cache = SegmentedCache(maxsize, policy, lock_obj, segments)
+            all_segments = cache.segments
+            nr_of_segments = len(all_segments)
+
+            def forget(segment, key):
+                key1, key2 = key
+                keys = segment.inner_keys[key1]
+                keys.discard(key2)
+                if not keys:
+                    del segment.inner_keys[key1]
+
+            @functools.wraps(user_function)
+            def wrapper(*args, **kwargs):
+                key = args[0], args[1]
+                # by first key, so delete(key1) needs single segment
+                segment = all_segments[hash(args[0]) % nr_of_segments]
+                try:
+                    return segment.peek(key)
+                except KeyError:
+                    pass
+                with segment.lock:
+                    try:
+                        # could be added while waiting for the lock
+                        result = segment.policy.get(key)
+                    except KeyError:
+                        pass
+                    else:
+                        segment.stats.hits += 1
+                        return result
+                    segment.stats.misses += 1
+                    result = user_function(*args, **kwargs)
+                    evicted = segment.policy.put(key, result)
+                    if evicted is not NOTHING:
+                        segment.stats.evictions += 1
+                        forget(segment, evicted)
+                    try:
+                        segment.inner_keys[args[0]].add(args[1])
+                    except KeyError:
+                        segment.inner_keys[args[0]] = set([args[1]])
+                    return result
+
+            def clear():
+                for segment in all_segments:
+                    with segment.lock:
+                        segment.stats.invalidations += len(segment.policy)
+                        segment.policy.clear()
+                        segment.inner_keys.clear()
+
+            def delete(key, *args):
+                segment = all_segments[hash(key) % nr_of_segments]
+                with segment.lock:
+                    if args:
+                        if not segment.policy.discard((key, args[0])):
+                            return False
+                        segment.stats.invalidations += 1
+                        forget(segment, (key, args[0]))
+                        return True
+                    try:
+                        keys = segment.inner_keys.pop(key)
+                    except KeyError:
+                        return False
+                    for inner_key in keys:
+                        segment.policy.discard((key, inner_key))
+                    segment.stats.invalidations += len(keys)
+                    return True
+
+            def resize(maxsize):
+                cache.resize(maxsize, forget)
+
+            wrapper.clear = clear
+            wrapper.cache = cache
+            wrapper.delete = delete
+            wrapper.resize = resize
+            wrapper.stats = cache
+            wrapper.get_stats = cache.get_stats
+            return wrapper
+        return decorating_function
+    return cache2lvl
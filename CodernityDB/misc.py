@@ -34,3 +34,24 @@ def random_hex_32():
 
 def random_hex_4(*args, **kwargs):
     return '%04x' % randrange(256 ** 2)
+
+
+class CacheStats(object):
+
+    """
+    Counters of single cache (see :py:mod:`CodernityDB.lru_cache`)
+    """
+
+    __slots__ = ('hits', 'misses', 'evictions', 'invalidations')
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.hits = self.misses = self.evictions = self.invalidations = 0
+
+    def as_dict(self, size, maxsize):
+        return dict(hits=self.hits, misses=self.misses,
+                    evictions=self.evictions,
+                    invalidations=self.invalidations,
+                    size=size, maxsize=maxsize)
@@ -0,0 +1,130 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Copyright 2011-2013 Codernity (http://codernity.com)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Runs reindex and compact of many indexes on a pool of worker processes.
+
+Every index has its own ``_buck`` / ``_stor`` files, so jobs don't share
+anything but (read only) **id** index. Workers load indexes from their
+code in ``_indexes`` directory, database object itself is never pickled.
+"""
+
+import os
+import shutil
+from multiprocessing import Pool
+
+
+def _index_file(index):
+    return "%.2d%s.py" % (index._order, index.name)
+
+
+def _load_index(path, index_file, db_path):
+    from CodernityDB.database import Database
+    return Database(db_path)._read_index_single(
+        os.path.join(path, '_indexes'), index_file)
+
+
+def _reindex_job(args):
+    """
+    Builds given indexes from scratch in ``target`` directory
+    (every index in subdirectory named as the index), in single pass
+    through **id** index.
+    """
+    path, target, index_files = args
+    from CodernityDB.database import Database
+    db = Database(path)
+    db.open()
+    try:
+        indexes = []
+        for index_file in index_files:
+            db_path = os.path.join(target, index_file[2:-3])
+            os.mkdir(db_path)
+            index = _load_index(path, index_file, db_path)
+            index.create_index()
+            indexes.append(index)
+        for curr in db.all('id'):
+            for index in indexes:
+                db._single_insert_index(index, curr, curr['_id'])
+        for index in indexes:
+            index.close_index()
+    finally:
+        db.close()
+
+
+def _compact_job(args):
+    path, index_file = args
+    index = _load_index(path, index_file, path)
+    index.open_index()
+    index.compact()
+    index.close_index()
+
+
+def _run(job, jobs, workers):
+    pool = Pool(min(workers, len(jobs)))
+    try:
+        pool.map(job, jobs, chunksize=1)
+    except:
+        pool.terminate()
+        raise
+    else:
+        pool.close()
+    finally:
+        pool.join()
+
+
+def reindex_indexes(db, indexes, workers):
+    """
+    Reindexes ``indexes`` of opened ``db`` using ``workers`` processes.
+    Indexes are split between workers, every worker makes one scan
+    of documents for its part. Old indexes are usable until new files
+    are moved in place of them.
+    """
+    target = os.path.join(db.path, '_reindex')
+    if os.path.exists(target):
+        shutil.rmtree(target)
+    os.mkdir(target)
+    try:
+        db.id_ind.flush()
+        jobs = []
+        for i in xrange(min(workers, len(indexes))):
+            jobs.append((db.path, target,
+                         [_index_file(index) for index in indexes[i::workers]]))
+        _run(_reindex_job, jobs, workers)
+        for index in indexes:
+            built = os.path.join(target, index.name)
+            index.close_index()
+            for name in os.listdir(built):
+                os.rename(os.path.join(built, name),
+                          os.path.join(db.path, name))
+            index.open_index()
+    finally:
+        shutil.rmtree(target)
+
+
+def compact_indexes(db, indexes, workers):
+    """
+    Compacts ``indexes`` of opened ``db`` using ``workers`` processes,
+    one job per index. Indexes are closed until all jobs are done.
+    """
+    for index in indexes:
+        index.close_index()
+    try:
+        _run(_compact_job,
+             [(db.path, _index_file(index)) for index in indexes], workers)
+    finally:
+        for index in indexes:
+            index.open_index()
@@ -63,6 +63,23 @@ def patch_cache_rr(lock_obj):
     __patch(rr_cache, 'cache2lvl', rr_lock2lvl)
 
 
+def patch_cache_lru(lock_obj):
+    """
+    Patches cache mechanizm to be thread safe (gevent ones also)
+
+    .. note::
+
+       It's internal CodernityDB mechanizm, it will be called when needed
+
+    """
+    import lru_cache
+    import lru_cache_with_lock
+    lru_lock1lvl = lru_cache_with_lock.create_cache1lvl(lock_obj)
+    lru_lock2lvl = lru_cache_with_lock.create_cache2lvl(lock_obj)
+    __patch(lru_cache, 'cache1lvl', lru_lock1lvl)
+    __patch(lru_cache, 'cache2lvl', lru_lock2lvl)
+
+
 def patch_flush_fsync(db_obj):
     """
     Will always execute index.fsync after index.flush.
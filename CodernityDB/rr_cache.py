@@ -18,37 +18,52 @@
 import functools
 from random import choice
 
+from CodernityDB.misc import CacheStats
+
 
 def cache1lvl(maxsize=100):
     def decorating_function(user_function):
         cache1lvl = {}
+        stats = CacheStats()
 
         @functools.wraps(user_function)
         def wrapper(key, *args, **kwargs):
             try:
                 result = cache1lvl[key]
             except KeyError:
+                stats.misses += 1
                 if len(cache1lvl) == maxsize:
-                    for i in xrange(maxsize // 10 or 1):
+                    to_delete = maxsize // 10 or 1
+                    for i in xrange(to_delete):
                         del cache1lvl[choice(cache1lvl.keys())]
+                    stats.evictions += to_delete
                 cache1lvl[key] = user_function(key, *args, **kwargs)
                 result = cache1lvl[key]
 #                result = user_function(obj, key, *args, **kwargs)
+            else:
+                stats.hits += 1
             return result
 
         def clear():
+            stats.invalidations += len(cache1lvl)
             cache1lvl.clear()
 
         def delete(key):
             try:
                 del cache1lvl[key]
+                stats.invalidations += 1
                 return True
             except KeyError:
                 return False
 
+        def get_stats():
+            return stats.as_dict(len(cache1lvl), maxsize)
+
         wrapper.clear = clear
         wrapper.cache = cache1lvl
         wrapper.delete = delete
+        wrapper.stats = stats
+        wrapper.get_stats = get_stats
         return wrapper
     return decorating_function
 
@@ -56,6 +71,7 @@ def cache1lvl(maxsize=100):
 def cache2lvl(maxsize=100):
     def decorating_function(user_function):
         cache = {}
+        stats = CacheStats()
 
         @functools.wraps(user_function)
         def wrapper(*args, **kwargs):
@@ -63,6 +79,7 @@ def cache2lvl(maxsize=100):
             try:
                 result = cache[args[0]][args[1]]
             except KeyError:
+                stats.misses += 1
 #                print wrapper.cache_size
                 if wrapper.cache_size == maxsize:
                     to_delete = maxsize // 10 or 1
@@ -73,6 +90,7 @@ def cache2lvl(maxsize=100):
                         if not cache[key1]:
                             del cache[key1]
                     wrapper.cache_size -= to_delete
+                    stats.evictions += to_delete
 #                print wrapper.cache_size
                 result = user_function(*args, **kwargs)
                 try:
@@ -80,9 +98,12 @@ def cache2lvl(maxsize=100):
                 except KeyError:
                     cache[args[0]] = {args[1]: result}
                 wrapper.cache_size += 1
+            else:
+                stats.hits += 1
             return result
 
         def clear():
+            stats.invalidations += wrapper.cache_size
             cache.clear()
             wrapper.cache_size = 0
 
@@ -93,20 +114,27 @@ def cache2lvl(maxsize=100):
                     if not cache[key]:
                         del cache[key]
                     wrapper.cache_size -= 1
+                    stats.invalidations += 1
                     return True
                 except KeyError:
                     return False
             else:
                 try:
                     wrapper.cache_size -= len(cache[key])
+                    stats.invalidations += len(cache[key])
                     del cache[key]
                     return True
                 except KeyError:
                     return False
 
+        def get_stats():
+            return stats.as_dict(wrapper.cache_size, maxsize)
+
         wrapper.clear = clear
         wrapper.cache = cache
         wrapper.delete = delete
+        wrapper.stats = stats
+        wrapper.get_stats = get_stats
         wrapper.cache_size = 0
         return wrapper
     return decorating_function
@@ -19,11 +19,14 @@
 import functools
 from random import choice
 
+from CodernityDB.misc import CacheStats
+
 
 def create_cache1lvl(lock_obj):
     def cache1lvl(maxsize=100):
         def decorating_function(user_function):
             cache = {}
+            stats = CacheStats()
             lock = lock_obj()
 
             @functools.wraps(user_function)
@@ -32,26 +35,38 @@ def create_cache1lvl(lock_obj):
                     result = cache[key]
                 except KeyError:
                     with lock:
+                        stats.misses += 1
                         if len(cache) == maxsize:
-                            for i in xrange(maxsize // 10 or 1):
+                            to_delete = maxsize // 10 or 1
+                            for i in xrange(to_delete):
                                 del cache[choice(cache.keys())]
+                            stats.evictions += to_delete
                         cache[key] = user_function(key, *args, **kwargs)
                         result = cache[key]
+                else:
+                    stats.hits += 1
                 return result
 
             def clear():
+                stats.invalidations += len(cache)
                 cache.clear()
 
             def delete(key):
                 try:
                     del cache[key]
+                    stats.invalidations += 1
                     return True
                 except KeyError:
                     return False
 
+            def get_stats():
+                return stats.as_dict(len(cache), maxsize)
+
             wrapper.clear = clear
             wrapper.cache = cache
             wrapper.delete = delete
+            wrapper.stats = stats
+            wrapper.get_stats = get_stats
             return wrapper
         return decorating_function
     return cache1lvl
@@ -61,6 +76,7 @@ def create_cache2lvl(lock_obj):
     def cache2lvl(maxsize=100):
         def decorating_function(user_function):
             cache = {}
+            stats = CacheStats()
             lock = lock_obj()
 
             @functools.wraps(user_function)
@@ -69,6 +85,7 @@ def create_cache2lvl(lock_obj):
                     result = cache[args[0]][args[1]]
                 except KeyError:
                     with lock:
+                        stats.misses += 1
                         if wrapper.cache_size == maxsize:
                             to_delete = maxsize // 10 or 1
                             for i in xrange(to_delete):
@@ -78,15 +95,19 @@ def create_cache2lvl(lock_obj):
                                 if not cache[key1]:
                                     del cache[key1]
                             wrapper.cache_size -= to_delete
+                            stats.evictions += to_delete
                         result = user_function(*args, **kwargs)
                         try:
                             cache[args[0]][args[1]] = result
                         except KeyError:
                             cache[args[0]] = {args[1]: result}
                         wrapper.cache_size += 1
+                else:
+                    stats.hits += 1
                 return result
 
             def clear():
+                stats.invalidations += wrapper.cache_size
                 cache.clear()
                 wrapper.cache_size = 0
 
@@ -97,20 +118,27 @@ def create_cache2lvl(lock_obj):
                         if not cache[key]:
                             del cache[key]
                         wrapper.cache_size -= 1
+                        stats.invalidations += 1
                         return True
                     except KeyError:
                         return False
                 else:
                     try:
                         wrapper.cache_size -= len(cache[key])
+                        stats.invalidations += len(cache[key])
                         del cache[key]
                         return True
                     except KeyError:
                         return False
 
+            def get_stats():
+                return stats.as_dict(wrapper.cache_size, maxsize)
+
             wrapper.clear = clear
             wrapper.cache = cache
             wrapper.delete = delete
+            wrapper.stats = stats
+            wrapper.get_stats = get_stats
             wrapper.cache_size = 0
             return wrapper
         return decorating_function
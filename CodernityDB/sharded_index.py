@@ -16,7 +16,7 @@
 # limitations under the License.
 
 
-from CodernityDB.index import Index
+from CodernityDB.index import Index, IndexException
 # from CodernityDB.env import cdb_environment
 # import warnings
 
@@ -101,12 +101,40 @@ class ShardedIndex(Index):
         for curr in self.shards.itervalues():
             curr.reindex()
 
+    def get_cache_stats(self):
+        """
+        Returns cache statistics summed over all shards.
+        """
+        stats = {}
+        for curr in self.shards.itervalues():
+            for name, shard_stats in curr.get_cache_stats().iteritems():
+                if name in stats:
+                    for k, v in shard_stats.iteritems():
+                        stats[name][k] += v
+                else:
+                    stats[name] = shard_stats
+        return stats
+
+    def reset_cache_stats(self):
+        for curr in self.shards.itervalues():
+            curr.reset_cache_stats()
+
+    def set_cache_size(self, cache_size=None, cache_memory=None):
+        if cache_memory is not None:
+            cache_memory //= self.sh_nums
+        for curr in self.shards.itervalues():
+            curr.set_cache_size(cache_size, cache_memory)
+
     def all(self, *args, **kwargs):
+        if kwargs.get('cursor') is not None:
+            raise IndexException("Cursors are not supported by sharded index")
         for curr in self.shards.itervalues():
             for now in curr.all(*args, **kwargs):
                 yield now
 
     def get_many(self, *args, **kwargs):
+        if kwargs.get('cursor') is not None:
+            raise IndexException("Cursors are not supported by sharded index")
         for curr in self.shards.itervalues():
             for now in curr.get_many(*args, **kwargs):
                 yield now
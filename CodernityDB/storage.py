@@ -20,6 +20,7 @@ import struct
 import shutil
 import marshal
 import io
+from hashlib import md5
 
 
 try:
@@ -62,9 +63,15 @@ class DummyStorage(object):
     def update(self, *args, **kwargs):
         return 0, 0
 
+    def rewrite(self, *args, **kwargs):
+        return 0, 0
+
     def get(self, *args, **kwargs):
         return None
 
+    def get_multi(self, records, fields=None):
+        return [None] * len(records)
+
     # def compact(self, *args, **kwargs):
     #     pass
 
@@ -79,6 +86,11 @@ class IU_Storage(object):
 
     __version__ = __version__
 
+    #: records closer than that (in bytes) are read by :py:meth:`get_multi` with single read
+    read_gap = 4096
+    #: maximum size of single read done by :py:meth:`get_multi`
+    read_span = 1024 * 1024
+
     def __init__(self, db_path, name='main'):
         self.db_path = db_path
         self.name = name
@@ -117,6 +129,14 @@ class IU_Storage(object):
     def data_to(self, data):
         return marshal.dumps(data)
 
+    def data_from_fields(self, data, fields):
+        """
+        Returns only ``fields`` of stored dict, here it's decoded whole
+        and filtered (see :py:class:`FieldStorage`).
+        """
+        data = self.data_from(data)
+        return dict((field, data[field]) for field in fields if field in data)
+
     def save(self, data):
         s_data = self.data_to(data)
         self._f.seek(0, 2)
@@ -132,14 +152,73 @@ class IU_Storage(object):
     def update(self, data):
         return self.save(data)
 
-    def get(self, start, size, status='c'):
+    def rewrite(self, start, size, data):
+        """
+        Writes ``data`` in place of record at ``start`` when it fits
+        in its ``size``, otherwise appends it.
+        """
+        s_data = self.data_to(data)
+        if len(s_data) > size:
+            self._f.seek(0, 2)
+            start = self._f.tell()
+        else:
+            self._f.seek(start)
+        self._f.write(s_data)
+        self.flush()
+        return start, len(s_data)
+
+    def get(self, start, size, status='c', fields=None):
         if status == 'd':
             return None
         else:
             print locals()
             self._f.seek(start)
+            if fields is not None:
+                return self.data_from_fields(self._f.read(size), fields)
             return self.data_from(self._f.read(size))
 
+    def get_multi(self, records, fields=None):
+        """
+        Reads many records (``(start, size, status)`` tuples) at once, returns
+        list of their data in the same order. File is read in order of
+        ``start``, records close to each other are read together.
+        With ``fields`` only these fields of stored dicts are returned.
+        """
+        result = [None] * len(records)
+        order = sorted((start, i)
+                       for i, (start, size, status) in enumerate(records)
+                       if status != 'd')
+        group = []
+        group_start = group_end = 0
+        for start, i in order:
+            end = start + records[i][1]
+            if group and (start - group_end > self.read_gap or
+                          end - group_start > self.read_span):
+                self._read_group(records, group, group_start, group_end,
+                                 result, fields)
+                group = []
+            if not group:
+                group_start = group_end = start
+            group.append(i)
+            group_end = max(group_end, end)
+        if group:
+            self._read_group(records, group, group_start, group_end,
+                             result, fields)
+        return result
+
+    def _read_group(self, records, group, group_start, group_end, result,
+                    fields=None):
+        self._f.seek(group_start)
+        buf = self._f.read(group_end - group_start)
+        for i in group:
+            start, size = records[i][:2]
+            start -= group_start
+            if fields is not None:
+                result[i] = self.data_from_fields(buf[start:start + size],
+                                                  fields)
+            else:
+                result[i] = self.data_from(buf[start:start + size])
+
     def flush(self):
         self._f.flush()
 
@@ -153,3 +232,85 @@ class IU_Storage(object):
 
 class Storage(IU_Storage):
     pass
+
+
+class FieldStorage(IU_Storage):
+
+    """
+    Storage for documents (dicts) that can decode some of their fields
+    without decoding the rest. Document is stored as marshalled dict built
+    from separately marshalled fields (so it's still decoded by single
+    ``marshal.loads``), with offsets of every value before it::
+
+        'f' | md5 of names | names size, fields (II) | names | offsets | dict
+
+    Names are decoded once for all documents with the same fields.
+    Other values are stored as ``'m'`` and marshalled data. Writes are
+    slower than in :py:class:`IU_Storage`.
+    """
+
+    #: how many different sets of fields are remembered
+    names_cache_size = 1024
+
+    def __init__(self, *args, **kwargs):
+        super(FieldStorage, self).__init__(*args, **kwargs)
+        self._names = {}
+
+    def data_to(self, data):
+        if not isinstance(data, dict):
+            return 'm' + marshal.dumps(data)
+        # version 0 has no references between strings,
+        # so separately marshalled parts can be joined
+        dumps = marshal.dumps
+        names = tuple(data)
+        parts = ['{']
+        offsets = []
+        pos = 1
+        for name in names:
+            key = dumps(name, 0)
+            value = dumps(data[name], 0)
+            pos += len(key)
+            offsets.append(pos)
+            pos += len(value)
+            offsets.append(pos)
+            parts += (key, value)
+        parts.append('0')
+        s_names = dumps(names)
+        return ''.join(['f', md5(s_names).digest(),
+                        struct.pack('<II', len(s_names), len(names)), s_names,
+                        struct.pack('<%dI' % len(offsets), *offsets)] + parts)
+
+    def data_from(self, data):
+        if data[0] != 'f':
+            return marshal.loads(data[1:])
+        names_size, fields = struct.unpack_from('<II', data, 17)
+        return marshal.loads(data[25 + names_size + 8 * fields:])
+
+    def _positions(self, data):
+        """
+        Returns ``({name: number}, offsets start, dict start)`` for record.
+        """
+        key = data[1:17]
+        try:
+            return self._names[key]
+        except KeyError:
+            names_size = struct.unpack_from('<I', data, 17)[0]
+            names = marshal.loads(data[25:25 + names_size])
+            res = (dict((name, i) for i, name in enumerate(names)),
+                   25 + names_size, 25 + names_size + 8 * len(names))
+            if len(self._names) >= self.names_cache_size:
+                self._names.clear()
+            self._names[key] = res
+            return res
+
+    def data_from_fields(self, data, fields):
+        if data[0] != 'f':
+            return super(FieldStorage, self).data_from_fields(data, fields)
+        positions, table, base = self._positions(data)
+        res = {}
+        for field in fields:
+            i = positions.get(field)
+            if i is not None:
+                start, end = struct.unpack_from('<II', data, table + 8 * i)
+                res[field] = marshal.loads(data[base + start:base + end])
+        return res
@@ -22,17 +22,19 @@ import marshal
 import os
 import io
 import shutil
-from storage import IU_Storage
+from bisect import bisect_left, bisect_right
+from hashlib import md5
+from storage import IU_Storage, FieldStorage
 # from ipdb import set_trace
 
 from CodernityDB.env import cdb_environment
-from CodernityDB.index import TryReindexException
+from CodernityDB.index import TryReindexException, IndexPreconditionsException
+from CodernityDB.key_codecs import CompositeKey
 
 if cdb_environment.get('rlock_obj'):
     from CodernityDB import patch
     patch.patch_cache_rr(cdb_environment['rlock_obj'])
-
-from CodernityDB.rr_cache import cache1lvl, cache2lvl
+    patch.patch_cache_lru(cdb_environment['rlock_obj'])
 
 tree_buffer_size = io.DEFAULT_BUFFER_SIZE
 
@@ -54,8 +56,17 @@ class IU_TreeBasedIndex(Index):
 
     custom_header = 'from CodernityDB.tree_index import TreeBasedIndex'
 
+    _cached_1lvl = ('_find_key', '_match_doc_id',
+                    '_read_leaf_nr_of_elements', '_read_leaf_neighbours',
+                    '_read_leaf_nr_of_elements_and_neighbours',
+                    '_read_node_nr_of_elements_and_children_flag')
+    _cached_2lvl = ('_find_key_in_leaf', '_read_single_node_key',
+                    '_find_first_key_occurence_in_node',
+                    '_find_last_key_occurence_in_node')
+
     def __init__(self, db_path, name, key_format='32s', pointer_format='I',
-                 meta_format='32sIIc', node_capacity=10, storage_class=None):
+                 meta_format='32sIIc', node_capacity=10, storage_class=None,
+                 cache_type='lru', cache_size=100, cache_memory=None):
         if node_capacity < 3:
             raise NodeCapacityException
         super(IU_TreeBasedIndex, self).__init__(db_path, name)
@@ -73,24 +84,11 @@ class IU_TreeBasedIndex(Index):
             storage_class = storage_class.__name__
         self.storage_class = storage_class
         self.storage = None
-        cache = cache1lvl(100)
-        twolvl_cache = cache2lvl(150)
-        self._find_key = cache(self._find_key)
-        self._match_doc_id = cache(self._match_doc_id)
-# self._read_single_leaf_record =
-# twolvl_cache(self._read_single_leaf_record)
-        self._find_key_in_leaf = twolvl_cache(self._find_key_in_leaf)
-        self._read_single_node_key = twolvl_cache(self._read_single_node_key)
-        self._find_first_key_occurence_in_node = twolvl_cache(
-            self._find_first_key_occurence_in_node)
-        self._find_last_key_occurence_in_node = twolvl_cache(
-            self._find_last_key_occurence_in_node)
-        self._read_leaf_nr_of_elements = cache(self._read_leaf_nr_of_elements)
-        self._read_leaf_neighbours = cache(self._read_leaf_neighbours)
-        self._read_leaf_nr_of_elements_and_neighbours = cache(
-            self._read_leaf_nr_of_elements_and_neighbours)
-        self._read_node_nr_of_elements_and_children_flag = cache(
-            self._read_node_nr_of_elements_and_children_flag)
+        self._right_path = None
+        self.cache_type = cache_type
+        self.cache_size = cache_size
+        self.cache_memory = cache_memory
+        self._setup_caches()
 
     def _count_props(self):
         """
@@ -137,7 +135,9 @@ class IU_TreeBasedIndex(Index):
                          key_format=self.key_format,
                          meta_format=self.meta_format,
                          version=self.__version__,
-                         storage_class=self.storage_class)
+                         storage_class=self.storage_class,
+                         cache_size=self.cache_size,
+                         cache_memory=self.cache_memory)
             f.write(marshal.dumps(props))
         self.buckets = io.open(os.path.join(self.db_path, self.name +
                                             "_buck"), 'r+b', buffering=0)
@@ -297,6 +297,234 @@ class IU_TreeBasedIndex(Index):
 
 #        self._read_single_leaf_record.delete(leaf_start_position, key_index)
 
+    def _read_whole_leaf(self, leaf_start):
+        """
+        Reads leaf heading and all it's records, records are returned as flat list
+        """
+        self.buckets.seek(leaf_start)
+        data = self.buckets.read(self.leaf_size)
+        nr_of_elements, prev_l, next_l = struct.unpack(
+            '<' + self.leaf_heading_format, data[:self.leaf_heading_size])
+        records = struct.unpack(
+            '<' + nr_of_elements * self.single_leaf_record_format,
+            data[self.leaf_heading_size:self.leaf_heading_size + nr_of_elements * self.single_leaf_record_size])
+        return nr_of_elements, prev_l, next_l, list(records)
+
+    def _write_whole_leaf(self, leaf_start, prev_l, next_l, records):
+        nr_of_elements = len(records) / 5
+        data = struct.pack('<' + self.leaf_heading_format +
+                           nr_of_elements * self.single_leaf_record_format,
+                           nr_of_elements,
+                           prev_l,
+                           next_l,
+                           *records)
+        data += (self.node_capacity - nr_of_elements) * \
+            self.single_leaf_record_size * '\x00'
+        self.buckets.seek(leaf_start)
+        self.buckets.write(data)
+        self._invalidate_leaf_cache(leaf_start)
+        # positions of records written to leaf could change
+        for doc_id in records[1::5]:
+            self._match_doc_id.delete(doc_id)
+
+    def _read_whole_node(self, node_start):
+        """
+        Reads node heading and all it's keys, returns them as flat list
+        (pointer, key, pointer, ..., key, pointer)
+        """
+        self.buckets.seek(node_start)
+        data = self.buckets.read(self.node_size)
+        nr_of_elements, children_flag = struct.unpack(
+            '<' + self.node_heading_format, data[:self.node_heading_size])
+        node_data = struct.unpack(
+            '<' + self.pointer_format + nr_of_elements *
+            (self.key_format + self.pointer_format),
+            data[self.node_heading_size:self.node_heading_size + self.pointer_size +
+                 nr_of_elements * (self.key_size + self.pointer_size)])
+        return nr_of_elements, children_flag, list(node_data)
+
+    def _write_whole_node(self, node_start, children_flag, node_data):
+        nr_of_elements = len(node_data) / 2
+        data = struct.pack('<' + self.node_heading_format + self.pointer_format +
+                           nr_of_elements * (self.key_format + self.pointer_format),
+                           nr_of_elements,
+                           children_flag,
+                           *node_data)
+        data += (self.node_capacity - nr_of_elements) * \
+            (self.key_size + self.pointer_size) * '\x00'
+        self.buckets.seek(node_start)
+        self.buckets.write(data)
+        self._invalidate_node_cache(node_start)
+
+    def _invalidate_leaf_cache(self, leaf_start):
+        self._find_key_in_leaf.delete(leaf_start)
+        self._read_leaf_nr_of_elements.delete(leaf_start)
+        self._read_leaf_neighbours.delete(leaf_start)
+        self._read_leaf_nr_of_elements_and_neighbours.delete(leaf_start)
+
+    def _invalidate_node_cache(self, node_start):
+        self._right_path = None
+        self._read_single_node_key.delete(node_start)
+        self._find_first_key_occurence_in_node.delete(node_start)
+        self._find_last_key_occurence_in_node.delete(node_start)
+        self._read_node_nr_of_elements_and_children_flag.delete(node_start)
+
+    def _find_path_to_leaf(self, key, leaf_start):
+        """
+        Returns list of [node_start, child_index] pairs that leads from root to given leaf.
+        Starts in leaf with first key occurence and moves to next leaves (equal keys
+        may be spread over many of them). Returns None if leaf can't be reached.
+        """
+        path = []
+        curr_pointer = self.data_start
+        children_flag = 'n'
+        while children_flag == 'n':
+            nr_of_elements, children_flag, node_data = self._read_whole_node(
+                curr_pointer)
+            child_index = bisect_left(node_data[1::2], key)
+            path.append([curr_pointer, child_index])
+            curr_pointer = node_data[child_index * 2]
+        depth = len(path)  # all leaves are on the same level
+        while curr_pointer != leaf_start:
+            # go up until there is a node with not visited child
+            while path:
+                node_start, child_index = path[-1]
+                if child_index < self._read_node_nr_of_elements_and_children_flag(node_start)[0]:
+                    break
+                path.pop()
+            if not path:
+                return None
+            path[-1][1] += 1
+            curr_pointer = self._read_whole_node(
+                path[-1][0])[2][path[-1][1] * 2]
+            # and down by the most left children
+            while len(path) < depth:
+                path.append([curr_pointer, 0])
+                curr_pointer = self._read_whole_node(curr_pointer)[2][0]
+        return path
+
+    def _remove_element(self, leaf_start, key_index, key):
+        """
+        Removes record from leaf. When leaf has less than half of records
+        it's refilled from sibling or merged with it.
+        Deleted records left by previous versions are removed from leaf too.
+        """
+        nr_of_elements, prev_l, next_l, records = self._read_whole_leaf(
+            leaf_start)
+        del records[key_index * 5:key_index * 5 + 5]
+        curr_index = 0
+        for status in records[4::5]:
+            if status != 'o':
+                del records[curr_index * 5:curr_index * 5 + 5]
+            else:
+                curr_index += 1
+        path = None
+        # the same lower limit that leaf split gives
+        if self.root_flag == 'n' and len(records) / 5 < (self.node_capacity + 1) / 2:
+            path = self._find_path_to_leaf(key, leaf_start)
+            if path is None:  # should't happen, falls back to marking record as deleted
+                self._delete_element(leaf_start, key_index)
+                return
+        self._write_whole_leaf(leaf_start, prev_l, next_l, records)
+        if path:
+            self._rebalance_leaf(leaf_start, path)
+
+    def _rebalance_leaf(self, leaf_start, path):
+        parent_start, child_index = path.pop()
+        nr_of_elements, children_flag, parent_data = self._read_whole_node(
+            parent_start)
+        if child_index > 0:
+            separator_index = child_index - 1
+            left_start, right_start = parent_data[separator_index * 2], leaf_start
+        else:
+            separator_index = 0
+            left_start, right_start = leaf_start, parent_data[2]
+        left_nr, left_prev, left_next, left_records = self._read_whole_leaf(
+            left_start)
+        right_nr, right_prev, right_next, right_records = self._read_whole_leaf(right_start)
+        if left_nr + right_nr <= self.node_capacity:
+            # merge right leaf into left one, right one is abandoned
+            # (it's not reused, space is reclaimed by compact)
+            self._write_whole_leaf(left_start,
+                                   left_prev,
+                                   right_next,
+                                   left_records + right_records)
+            if right_next:
+                self._update_leaf_prev_pointer(right_next, left_start)
+            # empty abandoned leaf, so cursors pointing to it are recognized as stale
+            self._update_size(right_start, 0)
+            self._invalidate_leaf_cache(right_start)
+            del parent_data[separator_index * 2 + 1:separator_index * 2 + 3]
+            self._remove_key_from_node(parent_start, children_flag, parent_data, path)
+        else:
+            records = left_records + right_records
+            half = (left_nr + right_nr) / 2 * 5
+            self._write_whole_leaf(left_start, left_prev, left_next, records[:half])
+            self._write_whole_leaf(right_start, right_prev, right_next, records[half:])
+            parent_data[separator_index * 2 + 1] = records[half]
+            self._write_whole_node(parent_start, children_flag, parent_data)
+
+    def _remove_key_from_node(self, node_start, children_flag, node_data, path):
+        """
+        Writes node which lost one key, when node has less than half of keys
+        it's refilled from sibling or merged with it. Root without keys is replaced
+        by it's only child.
+        """
+        nr_of_elements = len(node_data) / 2
+        if not path:  # node is a root
+            if nr_of_elements:
+                self._write_whole_node(node_start, children_flag, node_data)
+            else:
+                self._collapse_root(children_flag, node_data[0])
+            return
+        self._write_whole_node(node_start, children_flag, node_data)
+        if nr_of_elements >= self.node_capacity / 2:
+            return
+        parent_start, child_index = path.pop()
+        parent_nr, parent_flag, parent_data = self._read_whole_node(
+            parent_start)
+        if child_index > 0:
+            separator_index = child_index - 1
+            left_start, right_start = parent_data[separator_index * 2], node_start
+        else:
+            separator_index = 0
+            left_start, right_start = node_start, parent_data[2]
+        left_nr, left_flag, left_data = self._read_whole_node(left_start)
+        right_nr, right_flag, right_data = self._read_whole_node(right_start)
+        # separator goes down between keys of both nodes
+        merged = left_data + [parent_data[separator_index * 2 + 1]] + right_data
+        if left_nr + right_nr + 1 <= self.node_capacity:
+            self._write_whole_node(left_start, children_flag, merged)
+            self._invalidate_node_cache(right_start)
+            del parent_data[separator_index * 2 + 1:separator_index * 2 + 3]
+            self._remove_key_from_node(parent_start, parent_flag, parent_data, path)
+        else:
+            new_left_nr = (left_nr + right_nr) / 2
+            self._write_whole_node(left_start, children_flag, merged[:new_left_nr * 2 + 1])
+            self._write_whole_node(right_start, children_flag, merged[new_left_nr * 2 + 2:])
+            parent_data[separator_index * 2 + 1] = merged[new_left_nr * 2 + 1]
+            self._write_whole_node(parent_start, parent_flag, parent_data)
+
+    def _collapse_root(self, children_flag, child_start):
+        """
+        Copies only child of root in the root place, tree height decreases by one.
+        """
+        if children_flag == 'l':
+            nr_of_elements, prev_l, next_l, records = self._read_whole_leaf(
+                child_start)
+            self._write_whole_leaf(self.data_start, 0, 0, records)
+            if child_start >= self.data_start + self.leaf_size:
+                # not overlapped by root leaf, empty it as in _rebalance_leaf
+                self._update_size(child_start, 0)
+            self.buckets.seek(self._start_ind)
+            self.buckets.write(struct.pack('<c', 'l'))
+            self.root_flag = 'l'
+        else:
+            nr_of_elements, flag, node_data = self._read_whole_node(
+                child_start)
+            self._write_whole_node(self.data_start, flag, node_data)
+        self._clear_cache()
+
     def _leaf_linear_key_search(self, key, start, start_index, end_index):
         self.buckets.seek(start)
         data = self.buckets.read(
@@ -403,6 +631,10 @@ class IU_TreeBasedIndex(Index):
         """
         Binary search implementation used in all get functions
         """
+        if nr_of_elements == 0:  # root leaf after all records were deleted
+            if return_closest:
+                return leaf_start, -1
+            raise ElemNotFound
         imin, imax = 0, nr_of_elements - 1
         buffer_start, buffer_end = self._set_buffer_limits()
         candidate_start, candidate_index, move_buffer = self._choose_next_candidate_index_in_leaf(leaf_start,
@@ -474,8 +706,9 @@ class IU_TreeBasedIndex(Index):
             chosen_key_position = candidate_index
         else:
             chosen_key_position = imax
+        # imax is -1 when key is smaller than all keys in leaf
         curr_key, curr_doc_id, curr_start, curr_size, curr_status = self._read_single_leaf_record(leaf_start,
-                                                                                                  chosen_key_position)
+                                                                                                  max(chosen_key_position, 0))
         if key != curr_key:
             if return_closest:  # useful for find all bigger/smaller methods
                 return leaf_start, chosen_key_position
@@ -938,6 +1171,12 @@ class IU_TreeBasedIndex(Index):
             new_leaf_size = half_size + 1
         else:
             old_leaf_size = new_leaf_size = half_size + 1
+        if not create_new_root and not nr_of_records_to_rewrite\
+                and not self._read_leaf_neighbours(leaf_start)[1]:  # appending to the last leaf
+            new_leaf_start = self._start_new_last_leaf(
+                leaf_start, [new_key, new_doc_id, new_start, new_size, 'o'])
+            if new_leaf_start is not None:
+                return new_leaf_start, new_key
         if create_new_root:  # leaf is a root
             new_data = [new_key, new_doc_id, new_start, new_size, new_status]
             self._create_new_root_from_leaf(leaf_start, nr_of_records_to_rewrite, new_leaf_size, old_leaf_size, half_size, new_data)
@@ -1067,6 +1306,26 @@ class IU_TreeBasedIndex(Index):
 
                 return new_leaf_start, key_moved_to_parent_node
 
+    def _start_new_last_leaf(self, leaf_start, new_record_data):
+        """
+        Record appended to full last leaf is written to new leaf at the end of file,
+        old one stays full, so ascending inserts leave all leaves packed.
+        Returns ``None`` when leaf has deleted records (split removes them instead).
+        """
+        nr_of_elements, prev_l, next_l, records = self._read_whole_leaf(
+            leaf_start)
+        if 'd' in records[4::5]:
+            return None
+        self.buckets.seek(0, 2)  # end of file
+        new_leaf_start = self.buckets.tell()
+        self._write_whole_leaf(new_leaf_start, leaf_start, 0, new_record_data)
+        self._update_leaf_size_and_pointers(leaf_start,
+                                            nr_of_elements,
+                                            prev_l,
+                                            new_leaf_start)
+        self._find_key_in_leaf.delete(leaf_start)
+        return new_leaf_start
+
     def _update_if_has_deleted(self, leaf_start, records_to_rewrite, start_position, new_record_data):
         """
         Checks if there are any deleted elements in data to rewrite and prevent from writing then back.
@@ -1379,6 +1638,7 @@ class IU_TreeBasedIndex(Index):
         leaf_start, new_record_position, nr_of_records_to_rewrite, full_leaf, on_deleted\
             = self._find_place_in_leaf(key, leaf_start, nr_of_elements)
         if full_leaf:
+            self._right_path = None
             try:  # check if leaf has parent node
                 leaf_parent_pointer = nodes_stack.pop()
             except IndexError:  # leaf is a root
@@ -1474,11 +1734,39 @@ class IU_TreeBasedIndex(Index):
             self._read_single_node_key.delete(node_start)
             self._read_node_nr_of_elements_and_children_flag.delete(node_start)
 
+    def _find_right_path(self):
+        """
+        Returns path to the last leaf (like :py:meth:`_find_leaf_to_insert`)
+        and the biggest key in nodes on that path, all keys not smaller
+        than it are inserted into the last leaf.
+        """
+        nodes_stack = [self.data_start]
+        indexes = []
+        right_bound = None
+        children_flag = self.root_flag
+        curr_pointer = self.data_start
+        while children_flag == 'n':
+            nr_of_elements, children_flag = self._read_node_nr_of_elements_and_children_flag(curr_pointer)
+            l_pointer, curr_key, curr_pointer = self._read_single_node_key(
+                curr_pointer, nr_of_elements - 1)
+            nodes_stack.append(curr_pointer)
+            indexes.append(nr_of_elements - 1)
+            if right_bound is None or curr_key > right_bound:
+                right_bound = curr_key
+        return right_bound, nodes_stack, indexes
+
     def _find_leaf_to_insert(self, key):
         """
         Traverses tree in search for leaf for insert, remembering parent nodes in path,
         looks for last occurence of key if already in tree.
+        Path to the last leaf is remembered, so appending keys in ascending
+        order doesn't traverse the tree.
         """
+        if self._right_path is None:
+            self._right_path = self._find_right_path()
+        right_bound, nodes_stack, indexes = self._right_path
+        if right_bound is None or key >= right_bound:
+            return list(nodes_stack), list(indexes)
         nodes_stack = [self.data_start]
         if self.root_flag == 'l':
             return nodes_stack, []
@@ -1538,6 +1826,77 @@ class IU_TreeBasedIndex(Index):
                 next_leaf, key, nr_of_elements)
         return doc_id, l_key, start, size, status
 
+    def _find_leaves_with_keys(self, keys):
+        """
+        Splits sorted ``keys`` between leaves where their first occurences
+        should be. Every node on the way is read once for all keys that
+        go through it. Returns list of ``(leaf_start, keys)`` in tree order.
+        """
+        if self.root_flag == 'l':
+            return [(self.data_start, keys)]
+        leaves = []
+        stack = [(self.data_start, keys)]
+        while stack:
+            node_start, node_keys = stack.pop()
+            nr_of_elements, children_flag, node_data = self._read_whole_node(
+                node_start)
+            separators = node_data[1::2]
+            children = []
+            first = 0
+            while first < len(node_keys):
+                child_index = bisect_left(separators, node_keys[first])
+                if child_index < nr_of_elements:
+                    last = bisect_right(node_keys, separators[child_index], first)
+                else:
+                    last = len(node_keys)
+                children.append((node_data[child_index * 2], node_keys[first:last]))
+                first = last
+            if children_flag == 'l':
+                leaves.extend(children)
+            else:
+                # reversed, so children are taken from stack in tree order
+                stack.extend(reversed(children))
+        return leaves
+
+    def _find_keys(self, keys):
+        """
+        Like :py:meth:`_find_key` for many sorted ``keys`` at once, returns
+        list of found records, every leaf is read at most once.
+        """
+        found = []
+        leaves = {}
+
+        def read_leaf(leaf_start):
+            if leaf_start not in leaves:
+                if len(leaves) > 2:
+                    leaves.clear()
+                nr_of_elements, prev_l, next_l, records = self._read_whole_leaf(leaf_start)
+                leaves[leaf_start] = next_l, records[0::5], records
+            return leaves[leaf_start]
+
+        for leaf_start, leaf_keys in self._find_leaves_with_keys(keys):
+            for key in leaf_keys:
+                curr_leaf = leaf_start
+                next_l, curr_keys, records = read_leaf(curr_leaf)
+                index = bisect_left(curr_keys, key)
+                while True:
+                    if index == len(curr_keys):
+                        # deleted records or equal keys can continue in next leaf
+                        if not next_l:
+                            break
+                        curr_leaf = next_l
+                        next_l, curr_keys, records = read_leaf(curr_leaf)
+                        index = 0
+                        continue
+                    if curr_keys[index] != key:
+                        break
+                    l_key, doc_id, start, size, status = records[index * 5:index * 5 + 5]
+                    if status != 'd':
+                        found.append((doc_id, l_key, start, size, status))
+                        break
+                    index += 1
+        return found
+
     def _find_key_to_update(self, key, doc_id):
         """
         Search tree for key that matches not only given key but also doc_id.
@@ -1582,7 +1941,7 @@ class IU_TreeBasedIndex(Index):
     def delete(self, doc_id, key, start=0, size=0):
         containing_leaf_start, element_index = self._find_key_to_update(
             key, doc_id)[:2]
-        self._delete_element(containing_leaf_start, element_index)
+        self._remove_element(containing_leaf_start, element_index, key)
 
         self._find_key.delete(key)
         self._match_doc_id.delete(doc_id)
@@ -1641,9 +2000,10 @@ class IU_TreeBasedIndex(Index):
         nr_of_elements, prev_leaf, next_leaf = self._read_leaf_nr_of_elements_and_neighbours(leaf_with_key)
         leaf_with_key, key_index = self._find_index_of_first_key_equal_or_smaller_key(key, leaf_with_key, nr_of_elements)
         nr_of_elements, prev_leaf, next_leaf = self._read_leaf_nr_of_elements_and_neighbours(leaf_with_key)
-        curr_key = self._read_single_leaf_record(leaf_with_key, key_index)[0]
-        if curr_key >= key:
-            key_index -= 1
+        if key_index >= 0:  # -1 when all keys in leaf are bigger
+            curr_key = self._read_single_leaf_record(leaf_with_key, key_index)[0]
+            if curr_key >= key:
+                key_index -= 1
         while offset:
             if key_index >= 0:
                 key, doc_id, start, size, status = self._read_single_leaf_record(
@@ -1684,9 +2044,10 @@ class IU_TreeBasedIndex(Index):
             leaf_with_key = prev_leaf
             key_index = self._read_leaf_nr_of_elements_and_neighbours(
                 leaf_with_key)[0]
-        curr_key = self._read_single_leaf_record(leaf_with_key, key_index)[0]
-        if curr_key > key:
-            key_index -= 1
+        if key_index >= 0:  # -1 when all keys in leaf are bigger
+            curr_key = self._read_single_leaf_record(leaf_with_key, key_index)[0]
+            if curr_key > key:
+                key_index -= 1
         while offset:
             if key_index >= 0:
                 key, doc_id, start, size, status = self._read_single_leaf_record(
@@ -1725,6 +2086,7 @@ class IU_TreeBasedIndex(Index):
             nr_of_elements, prev_leaf, next_leaf = self._read_leaf_nr_of_elements_and_neighbours(leaf_with_key)
         except ElemNotFound:
             key_index = 0
+        key_index = max(key_index, 0)  # -1 when all keys in leaf are bigger
         curr_key = self._read_single_leaf_record(leaf_with_key, key_index)[0]
         if curr_key <= key:
             key_index += 1
@@ -1763,6 +2125,7 @@ class IU_TreeBasedIndex(Index):
         nr_of_elements, prev_leaf, next_leaf = self._read_leaf_nr_of_elements_and_neighbours(leaf_with_key)
         leaf_with_key, key_index = self._find_index_of_first_key_equal_or_smaller_key(key, leaf_with_key, nr_of_elements)
         nr_of_elements, prev_leaf, next_leaf = self._read_leaf_nr_of_elements_and_neighbours(leaf_with_key)
+        key_index = max(key_index, 0)  # -1 when all keys in leaf are bigger
         curr_key = self._read_single_leaf_record(leaf_with_key, key_index)[0]
         if curr_key < key:
             key_index += 1
@@ -1805,6 +2168,7 @@ class IU_TreeBasedIndex(Index):
             nr_of_elements, prev_leaf, next_leaf = self._read_leaf_nr_of_elements_and_neighbours(leaf_with_key)
             leaf_with_key, key_index = self._find_index_of_first_key_equal_or_smaller_key(start, leaf_with_key, nr_of_elements)
             nr_of_elements, prev_leaf, next_leaf = self._read_leaf_nr_of_elements_and_neighbours(leaf_with_key)
+            key_index = max(key_index, 0)  # -1 when all keys in leaf are bigger
             curr_key = self._read_single_leaf_record(
                 leaf_with_key, key_index)[0]
             if curr_key < start:
@@ -1813,6 +2177,7 @@ class IU_TreeBasedIndex(Index):
             leaf_with_key = self._find_leaf_with_last_key_occurence(start)
             nr_of_elements, prev_leaf, next_leaf = self._read_leaf_nr_of_elements_and_neighbours(leaf_with_key)
             leaf_with_key, key_index = self._find_index_of_last_key_equal_or_smaller_key(start, leaf_with_key, nr_of_elements)
+            key_index = max(key_index, 0)  # -1 when all keys in leaf are bigger
             curr_key, curr_doc_id, curr_start, curr_size, curr_status = self._read_single_leaf_record(leaf_with_key, key_index)
             if curr_key <= start:
                 key_index += 1
@@ -1846,13 +2211,244 @@ class IU_TreeBasedIndex(Index):
                 else:
                     return
 
+    def _find_last_leaf(self):
+        if self.root_flag == 'l':
+            return self.data_start
+        nr_of_elements, curr_child_flag = self._read_node_nr_of_elements_and_children_flag(self.data_start)
+        curr_position = self._read_single_node_key(
+            self.data_start, nr_of_elements - 1)[2]
+        while(curr_child_flag == 'n'):
+            nr_of_elements, curr_child_flag = self._read_node_nr_of_elements_and_children_flag(curr_position)
+            curr_position = self._read_single_node_key(
+                curr_position, nr_of_elements - 1)[2]
+        return curr_position
+
+    def _find_last_position_before(self, key, inclusive):
+        """
+        Returns leaf and index of last record with key smaller (or equal when inclusive)
+        than given one. Index -1 means that the record is at the end of previous leaf.
+        """
+        if inclusive:
+            # all records in next leaves are bigger
+            leaf_start = self._find_leaf_with_last_key_occurence(key)
+        else:
+            # all records in previous leaves are smaller
+            leaf_start = self._find_leaf_with_first_key_occurence(key)
+        nr_of_elements, prev_leaf, next_leaf, records = self._read_whole_leaf(
+            leaf_start)
+        if inclusive:
+            key_index = bisect_right(records[0::5], key) - 1
+        else:
+            key_index = bisect_left(records[0::5], key) - 1
+        return leaf_start, key_index
+
+    def _walk_backward(self, leaf_start, key_index, limit, offset, stop_key=None, inclusive_stop=True, cursor=None):
+        """
+        Traverses leaves linked list backward starting from given record,
+        stops on key smaller than ``stop_key`` (or equal when not ``inclusive_stop``).
+        Position of every returned record is stored in ``cursor`` (if given).
+        """
+        nr_of_elements, prev_leaf, next_leaf = self._read_leaf_nr_of_elements_and_neighbours(leaf_start)
+        while limit:
+            if key_index >= 0:
+                curr_key, doc_id, start, size, status = self._read_single_leaf_record(
+                    leaf_start, key_index)
+                if stop_key is not None and (curr_key < stop_key or (curr_key == stop_key and not inclusive_stop)):
+                    return
+                if status != 'd':
+                    if offset:
+                        offset -= 1
+                    else:
+                        if cursor is not None:
+                            cursor.update(key=curr_key, doc_id=doc_id,
+                                          leaf=leaf_start, index=key_index)
+                        yield doc_id, curr_key, start, size, status
+                        limit -= 1
+                key_index -= 1
+            else:
+                if prev_leaf:
+                    leaf_start = prev_leaf
+                    nr_of_elements, prev_leaf, next_leaf = self._read_leaf_nr_of_elements_and_neighbours(prev_leaf)
+                    key_index = nr_of_elements - 1
+                else:
+                    return
+
+    def _walk_forward(self, leaf_start, key_index, limit, offset, stop_key=None, inclusive_stop=True, cursor=None):
+        """
+        Traverses leaves linked list starting from given record,
+        stops on key bigger than ``stop_key`` (or equal when not ``inclusive_stop``).
+        Position of every returned record is stored in ``cursor`` (if given).
+        """
+        nr_of_elements, prev_leaf, next_leaf = self._read_leaf_nr_of_elements_and_neighbours(leaf_start)
+        while limit:
+            if key_index < nr_of_elements:
+                curr_key, doc_id, start, size, status = self._read_single_leaf_record(
+                    leaf_start, key_index)
+                if stop_key is not None and (curr_key > stop_key or (curr_key == stop_key and not inclusive_stop)):
+                    return
+                if status != 'd':
+                    if offset:
+                        offset -= 1
+                    else:
+                        if cursor is not None:
+                            cursor.update(key=curr_key, doc_id=doc_id,
+                                          leaf=leaf_start, index=key_index)
+                        yield doc_id, curr_key, start, size, status
+                        limit -= 1
+                key_index += 1
+            else:
+                key_index = 0
+                if next_leaf:
+                    leaf_start = next_leaf
+                    nr_of_elements, prev_leaf, next_leaf = self._read_leaf_nr_of_elements_and_neighbours(next_leaf)
+                else:
+                    return
+
+    def _find_first_position_after(self, key, inclusive):
+        """
+        Returns leaf and index of first record with key bigger (or equal when inclusive)
+        than given one. Index equal to number of elements means that the record is
+        at the beginning of next leaf.
+        """
+        if inclusive:
+            # all records in previous leaves are smaller
+            leaf_start = self._find_leaf_with_first_key_occurence(key)
+        else:
+            # all records in next leaves are bigger
+            leaf_start = self._find_leaf_with_last_key_occurence(key)
+        nr_of_elements, prev_leaf, next_leaf, records = self._read_whole_leaf(
+            leaf_start)
+        if inclusive:
+            key_index = bisect_left(records[0::5], key)
+        else:
+            key_index = bisect_right(records[0::5], key)
+        return leaf_start, key_index
+
+    def _range_start(self, start, end, offset, inclusive_start, inclusive_end, reverse):
+        """
+        Returns leaf and index of the record from which range traversal starts
+        and offset that still has to be skipped during traversal.
+        """
+        if reverse:
+            if end is None:
+                leaf_start = self._find_last_leaf()
+                key_index = self._read_leaf_nr_of_elements(leaf_start) - 1
+            else:
+                leaf_start, key_index = self._find_last_position_before(
+                    end, inclusive_end)
+        else:
+            if start is None:
+                if self.root_flag == 'n':
+                    leaf_start = self.data_start + self.node_size
+                else:
+                    leaf_start = self.data_start
+                key_index = 0
+            else:
+                leaf_start, key_index = self._find_first_position_after(
+                    start, inclusive_start)
+        return leaf_start, key_index, offset
+
+    def _cursor_position(self, cursor, reverse):
+        """
+        Returns leaf and index of the record following the one stored in ``cursor``.
+        When the leaf changed since (split, merge, compact...) the record is
+        searched again by its key, if it's gone traversal continues after its key.
+        """
+        key = cursor['key']
+        doc_id = cursor['doc_id']
+        leaf_start = cursor['leaf']
+        key_index = cursor['index']
+        step = -1 if reverse else 1
+        self.buckets.seek(0, 2)
+        if self.root_flag == 'l':
+            valid_leaf = leaf_start == self.data_start
+        else:
+            valid_leaf = leaf_start > self.data_start \
+                and leaf_start + self.leaf_size <= self.buckets.tell()
+        if valid_leaf:
+            nr_of_elements = self._read_leaf_nr_of_elements(leaf_start)
+            if 0 <= key_index < min(nr_of_elements, self.node_capacity):
+                curr_key, curr_doc_id, start, size, status = self._read_single_leaf_record(
+                    leaf_start, key_index)
+                if curr_key == key and curr_doc_id == doc_id and status != 'd':
+                    return leaf_start, key_index + step
+        if reverse:
+            leaf_start, key_index = self._find_last_position_before(key, True)
+        else:
+            leaf_start, key_index = self._find_first_position_after(key, True)
+        nr_of_elements, prev_leaf, next_leaf = self._read_leaf_nr_of_elements_and_neighbours(leaf_start)
+        while True:
+            if 0 <= key_index < nr_of_elements:
+                curr_key, curr_doc_id = self._read_single_leaf_record(
+                    leaf_start, key_index)[:2]
+                if curr_key != key:
+                    break
+                if curr_doc_id == doc_id:
+                    return leaf_start, key_index + step
+                key_index += step
+            elif reverse and prev_leaf:
+                leaf_start = prev_leaf
+                nr_of_elements, prev_leaf, next_leaf = self._read_leaf_nr_of_elements_and_neighbours(leaf_start)
+                key_index = nr_of_elements - 1
+            elif not reverse and next_leaf:
+                leaf_start = next_leaf
+                nr_of_elements, prev_leaf, next_leaf = self._read_leaf_nr_of_elements_and_neighbours(leaf_start)
+                key_index = 0
+            else:
+                break
+        if reverse:
+            return self._find_last_position_before(key, False)
+        return self._find_first_position_after(key, False)
+
+    def _find_key_range(self, start, end, limit, offset, inclusive_start, inclusive_end, reverse, cursor=None):
+        """
+        Returns generator containing all keys withing given interval (in descending
+        order with ``reverse``), ``None`` as ``start`` or ``end`` means that interval
+        is open on that side. Non empty ``cursor`` resumes the traversal after
+        the record stored in it.
+        """
+        if cursor:
+            leaf_start, key_index = self._cursor_position(cursor, reverse)
+        else:
+            leaf_start, key_index, offset = self._range_start(
+                start, end, offset, inclusive_start, inclusive_end, reverse)
+        if reverse:
+            return self._walk_backward(leaf_start, key_index, limit, offset, start, inclusive_start, cursor)
+        return self._walk_forward(leaf_start, key_index, limit, offset, end, inclusive_end, cursor)
+
     def get(self, key):
         return self._find_key(self.make_key(key))
 
-    def get_many(self, key, limit=1, offset=0):
+    def get_multi(self, keys):
+        """
+        Returns records for many keys (the first one for every key, like
+        :py:meth:`get_many` with ``limit=1``) in key order, missing keys are skipped. Keys are sorted and the
+        tree is traversed once for all of them.
+        """
+        return self._find_keys(sorted(set(self.make_key(key) for key in keys)))
+
+    def get_many(self, key, limit=1, offset=0, reverse=False, cursor=None):
+        if reverse or cursor is not None:
+            key = self.make_key(key)
+            return self._find_key_range(key, key, limit, offset, True, True, reverse, cursor)
         return self._find_key_many(self.make_key(key), limit, offset)
 
-    def get_between(self, start, end, limit=1, offset=0, inclusive_start=True, inclusive_end=True):
+    def get_between(self, start, end, limit=1, offset=0, inclusive_start=True, inclusive_end=True, reverse=False, cursor=None):
+        """
+        Returns records with keys between ``start`` and ``end``.
+        With ``reverse`` records are returned in descending key order
+        (queries with ``start`` set to ``None`` are returned that way always).
+        ``cursor`` dict is updated with position of every returned record,
+        passing it again continues the query after that record.
+        """
+        if reverse or cursor is not None:
+            if start is not None:
+                start = self.make_key(start)
+            else:
+                reverse = True
+            if end is not None:
+                end = self.make_key(end)
+            return self._find_key_range(start, end, limit, offset, inclusive_start, inclusive_end, reverse, cursor)
         if start is None:
             end = self.make_key(end)
             if inclusive_end:
@@ -1870,10 +2466,15 @@ class IU_TreeBasedIndex(Index):
             end = self.make_key(end)
             return self._find_key_between(start, end, limit, offset, inclusive_start, inclusive_end)
 
-    def all(self, limit=-1, offset=0):
+    def all(self, limit=-1, offset=0, reverse=False, cursor=None):
         """
         Traverses linked list of all tree leaves and returns generator containing all elements stored in index.
+        With ``reverse`` the list is traversed from the last leaf, ``cursor`` works as in :py:meth:`get_between`.
         """
+        if reverse or cursor is not None:
+            for record in self._find_key_range(None, None, limit, offset, True, True, reverse, cursor):
+                yield record
+            return
         if self.root_flag == 'n':
             leaf_start = self.data_start + self.node_size
         else:
@@ -1910,6 +2511,78 @@ class IU_TreeBasedIndex(Index):
                 else:
                     return
 
+    def min_key(self):
+        """
+        Returns the smallest key in index (``None`` if index is empty),
+        only the first leaf is read.
+        """
+        for record in self.all(limit=1):
+            return record[1]
+        return None
+
+    def max_key(self):
+        """
+        Returns the biggest key in index (``None`` if index is empty).
+        """
+        for record in self.all(limit=1, reverse=True):
+            return record[1]
+        return None
+
+    def _distinct_keys(self, start, end, limit):
+        if start is None:
+            if self.root_flag == 'n':
+                leaf_start = self.data_start + self.node_size
+            else:
+                leaf_start = self.data_start
+            key_index = 0
+        else:
+            leaf_start, key_index = self._find_first_position_after(start, True)
+        curr_leaf = None
+        while limit:
+            if curr_leaf != leaf_start:
+                nr_of_elements, prev_leaf, next_leaf, records = self._read_whole_leaf(leaf_start)
+                keys = records[0::5]
+                curr_leaf = leaf_start
+            if key_index >= nr_of_elements:
+                if not next_leaf:
+                    return
+                leaf_start, key_index = next_leaf, 0
+                continue
+            if records[key_index * 5 + 4] == 'd':
+                key_index += 1
+                continue
+            key = keys[key_index]
+            if end is not None and key > end:
+                return
+            yield key
+            limit -= 1
+            key_index = bisect_right(keys, key, key_index)
+            if key_index == nr_of_elements and next_leaf \
+                    and self._read_single_leaf_record(next_leaf, 0)[0] == key:
+                # duplicates continue in next leaves, skip them using nodes
+                leaf_start, key_index = self._find_first_position_after(key, False)
+
+    def distinct_keys(self, start=None, end=None, limit=-1):
+        """
+        Returns generator of distinct keys (between ``start`` and ``end``, inclusive)
+        in ascending order. Runs of equal keys longer than leaf are skipped
+        by searching the tree for the next bigger key, so duplicates are not read.
+        """
+        if start is not None:
+            start = self.make_key(start)
+        if end is not None:
+            end = self.make_key(end)
+        return self._distinct_keys(start, end, limit)
+
+    def run_min(self, db):
+        return self.min_key()
+
+    def run_max(self, db):
+        return self.max_key()
+
+    def run_distinct(self, db, start=None, end=None, limit=-1):
+        return list(self.distinct_keys(start, end, limit))
+
     def make_key(self, key):
         raise NotImplementedError()
 
@@ -1969,6 +2642,7 @@ class IU_TreeBasedIndex(Index):
         self._count_props()
 
     def _clear_cache(self):
+        self._right_path = None
         self._find_key.clear()
         self._match_doc_id.clear()
 #        self._read_single_leaf_record.clear()
@@ -2033,6 +2707,546 @@ class IU_MultiTreeBasedIndex(IU_TreeBasedIndex):
         raise NotImplementedError()
 
 
+class IU_CountedTreeBasedIndex(IU_TreeBasedIndex):
+
+    """
+    Tree index that knows how many records are stored in each subtree.
+
+    It makes ``offset`` and counting records in range (``run_count``)
+    logarithmic instead of linear. Node counts are kept in memory, updated on
+    insert / delete and stored in ``_cnt`` file when index is closed.
+    """
+
+    custom_header = 'from CodernityDB.tree_index import CountedTreeBasedIndex'
+
+    def __init__(self, *args, **kwargs):
+        super(IU_CountedTreeBasedIndex, self).__init__(*args, **kwargs)
+        self._subtree_counts = {}
+
+    def _counts_file(self):
+        return os.path.join(self.db_path, self.name + '_cnt')
+
+    def create_index(self):
+        super(IU_CountedTreeBasedIndex, self).create_index()
+        self._subtree_counts = {}
+        if os.path.isfile(self._counts_file()):
+            os.unlink(self._counts_file())
+
+    def open_index(self):
+        super(IU_CountedTreeBasedIndex, self).open_index()
+        # file is valid only until index is modified, so it's removed after read
+        if os.path.isfile(self._counts_file()):
+            with io.open(self._counts_file(), 'rb') as f:
+                self._subtree_counts = marshal.loads(f.read())
+            os.unlink(self._counts_file())
+
+    def close_index(self):
+        if self._subtree_counts:
+            with io.open(self._counts_file(), 'wb') as f:
+                f.write(marshal.dumps(self._subtree_counts))
+        super(IU_CountedTreeBasedIndex, self).close_index()
+
+    def destroy(self):
+        super(IU_CountedTreeBasedIndex, self).destroy()
+        if os.path.isfile(self._counts_file()):
+            os.unlink(self._counts_file())
+
+    def compact(self, *args, **kwargs):
+        # counts are not valid for compacted tree
+        self._subtree_counts.clear()
+        return super(IU_CountedTreeBasedIndex, self).compact(*args, **kwargs)
+
+    def _clear_cache(self):
+        super(IU_CountedTreeBasedIndex, self)._clear_cache()
+        self._subtree_counts.clear()
+
+    def _invalidate_node_cache(self, node_start):
+        super(IU_CountedTreeBasedIndex, self)._invalidate_node_cache(
+            node_start)
+        self._subtree_counts.pop(node_start, None)
+
+    def insert(self, doc_id, key, start, size, status='o'):
+        nodes_stack = self._find_leaf_to_insert(key)[0][:-1]
+        self.buckets.seek(0, 2)
+        file_end = self.buckets.tell()
+        super(IU_CountedTreeBasedIndex, self).insert(
+            doc_id, key, start, size, status)
+        self.buckets.seek(0, 2)
+        if self.buckets.tell() != file_end:  # split happened, nodes on path changed
+            for node_start in nodes_stack:
+                self._subtree_counts.pop(node_start, None)
+        else:
+            self._subtree_inserted(nodes_stack, start, size, status)
+
+    def _subtree_inserted(self, nodes_stack, start, size, status):
+        """
+        Updates counts of nodes above leaf with new record.
+        """
+        for node_start in nodes_stack:
+            if node_start in self._subtree_counts:
+                self._subtree_counts[node_start] += 1
+
+    def _subtree_removed(self, nodes_stack, leaf_start, key_index):
+        """
+        Updates counts of nodes above leaf from which record will be removed.
+        """
+        for node_start in nodes_stack:
+            if node_start in self._subtree_counts:
+                self._subtree_counts[node_start] -= 1
+
+    def _remove_element(self, leaf_start, key_index, key):
+        if self.root_flag == 'n' and self._subtree_counts:
+            path = self._find_path_to_leaf(key, leaf_start)
+            if path is None:
+                self._subtree_counts.clear()
+            else:
+                # nodes changed by rebalancing are invalidated when written
+                self._subtree_removed([node_start for node_start, child_index in path],
+                                      leaf_start, key_index)
+        super(IU_CountedTreeBasedIndex, self)._remove_element(
+            leaf_start, key_index, key)
+
+    def _subtree_count(self, node_start):
+        try:
+            return self._subtree_counts[node_start]
+        except KeyError:
+            pass
+        nr_of_elements, children_flag, node_data = self._read_whole_node(
+            node_start)
+        count = 0
+        for pointer in node_data[0::2]:
+            count += self._page_count(pointer, children_flag)
+        self._subtree_counts[node_start] = count
+        return count
+
+    def _page_count(self, page_start, flag):
+        if flag == 'l':
+            return self._read_leaf_nr_of_elements(page_start)
+        return self._subtree_count(page_start)
+
+    def _count_all(self):
+        return self._page_count(self.data_start, self.root_flag)
+
+    def _rank(self, key, inclusive):
+        """
+        Returns number of records with key smaller (or equal when inclusive) than given one.
+        """
+        if inclusive:
+            bisect_fn = bisect_right
+        else:
+            bisect_fn = bisect_left
+        rank = 0
+        curr_pointer = self.data_start
+        children_flag = self.root_flag
+        while children_flag == 'n':
+            nr_of_elements, children_flag, node_data = self._read_whole_node(
+                curr_pointer)
+            child_index = bisect_fn(node_data[1::2], key)
+            for pointer in node_data[0:child_index * 2:2]:
+                rank += self._page_count(pointer, children_flag)
+            curr_pointer = node_data[child_index * 2]
+        records = self._read_whole_leaf(curr_pointer)[3]
+        return rank + bisect_fn(records[0::5], key)
+
+    def _seek(self, rank):
+        """
+        Returns leaf and index of record at given position in index.
+        """
+        curr_pointer = self.data_start
+        children_flag = self.root_flag
+        while children_flag == 'n':
+            nr_of_elements, children_flag, node_data = self._read_whole_node(
+                curr_pointer)
+            for curr_pointer in node_data[0:-1:2]:
+                count = self._page_count(curr_pointer, children_flag)
+                if rank < count:
+                    break
+                rank -= count
+            else:
+                curr_pointer = node_data[-1]
+        return curr_pointer, rank
+
+    def _range_start(self, start, end, offset, inclusive_start, inclusive_end, reverse):
+        if reverse:
+            if end is None:
+                rank = self._count_all()
+            else:
+                rank = self._rank(end, inclusive_end)
+            leaf_start, key_index = self._seek(rank - offset - 1)
+        else:
+            if start is None:
+                rank = 0
+            else:
+                rank = self._rank(start, not inclusive_start)
+            leaf_start, key_index = self._seek(rank + offset)
+        return leaf_start, key_index, 0
+
+    def get_many(self, key, limit=1, offset=0, reverse=False, cursor=None):
+        key = self.make_key(key)
+        return self._find_key_range(key, key, limit, offset, True, True, reverse, cursor)
+
+    def get_between(self, start, end, limit=1, offset=0, inclusive_start=True, inclusive_end=True, reverse=False, cursor=None):
+        if start is not None:
+            start = self.make_key(start)
+        else:
+            reverse = True  # the same order as in TreeBasedIndex
+        if end is not None:
+            end = self.make_key(end)
+        return self._find_key_range(start, end, limit, offset, inclusive_start, inclusive_end, reverse, cursor)
+
+    def all(self, limit=-1, offset=0, reverse=False, cursor=None):
+        return self._find_key_range(None, None, limit, offset, True, True, reverse, cursor)
+
+    def count_between(self, start=None, end=None, inclusive_start=True, inclusive_end=True):
+        """
+        Returns number of records with keys within given interval,
+        ``None`` means that interval is open on that side.
+        """
+        if end is None:
+            upper = self._count_all()
+        else:
+            upper = self._rank(self.make_key(end), inclusive_end)
+        if start is None:
+            lower = 0
+        else:
+            lower = self._rank(self.make_key(start), not inclusive_start)
+        return max(upper - lower, 0)
+
+    def run_count(self, db, start=None, end=None, inclusive_start=True, inclusive_end=True):
+        return self.count_between(start, end, inclusive_start, inclusive_end)
+
+
+class IU_AggregatedTreeBasedIndex(IU_CountedTreeBasedIndex):
+
+    """
+    Counted tree index that keeps also sum, min and max of values in each subtree.
+
+    Aggregated value is ``value_field`` item (``'value'`` by default) of data
+    returned by ``make_key_value``, it has to be a number (or ``None``).
+    Range aggregates (``run_aggregate``, ``run_sum``) use stats of subtrees
+    inside the range and read values only from the boundary leaves.
+    Subtree stats are updated on insert / update / delete and stored in
+    ``_cnt`` file like counts.
+    """
+
+    custom_header = 'from CodernityDB.tree_index import AggregatedTreeBasedIndex'
+
+    def __init__(self, *args, **kwargs):
+        self.value_field = kwargs.pop('value_field', 'value')
+        super(IU_AggregatedTreeBasedIndex, self).__init__(*args, **kwargs)
+        self._leaf_stats_cache = {}
+
+    def create_index(self):
+        super(IU_AggregatedTreeBasedIndex, self).create_index()
+        self._save_params(dict(value_field=self.value_field))
+
+    def _clear_cache(self):
+        super(IU_AggregatedTreeBasedIndex, self)._clear_cache()
+        self._leaf_stats_cache.clear()
+
+    def _record_value(self, start, size, status):
+        if not size or status == 'd':
+            return None
+        data = self.storage.get(start, size, status)
+        try:
+            return data[self.value_field]
+        except (KeyError, TypeError):
+            return None
+
+    def _add_value(self, stats, value, count=1):
+        """
+        Returns ``stats`` (count, sum, min, max) with record with ``value`` added.
+        """
+        records, total, min_value, max_value = stats
+        if value is None:
+            return records + count, total, min_value, max_value
+        if min_value is None or value < min_value:
+            min_value = value
+        if max_value is None or value > max_value:
+            max_value = value
+        return records + count, total + value, min_value, max_value
+
+    def _merge_stats(self, stats, other):
+        records, total, min_value, max_value = stats
+        if other[2] is not None and (min_value is None or other[2] < min_value):
+            min_value = other[2]
+        if other[3] is not None and (max_value is None or other[3] > max_value):
+            max_value = other[3]
+        return records + other[0], total + other[1], min_value, max_value
+
+    def _leaf_stats(self, leaf_start, lower=None, upper=None, inclusive_lower=True, inclusive_upper=True):
+        """
+        Stats of records in leaf with keys between ``lower`` and ``upper``
+        (``None`` means no limit). Stats of whole leaves are cached as long
+        as the leaf content is the same.
+        """
+        whole = lower is None and upper is None
+        if whole:
+            self.buckets.seek(leaf_start)
+            digest = md5(self.buckets.read(self.leaf_size)).digest()
+            try:
+                cached_digest, stats = self._leaf_stats_cache[leaf_start]
+            except KeyError:
+                pass
+            else:
+                if cached_digest == digest:
+                    return stats
+        nr_of_elements, prev_leaf, next_leaf, records = self._read_whole_leaf(
+            leaf_start)
+        keys = records[0::5]
+        first, last = 0, nr_of_elements
+        if lower is not None:
+            if inclusive_lower:
+                first = bisect_left(keys, lower)
+            else:
+                first = bisect_right(keys, lower)
+        if upper is not None:
+            if inclusive_upper:
+                last = bisect_right(keys, upper)
+            else:
+                last = bisect_left(keys, upper)
+        stats = (0, 0, None, None)
+        for key_index in xrange(first, last):
+            start, size, status = records[key_index * 5 + 2:key_index * 5 + 5]
+            stats = self._add_value(stats, self._record_value(start, size, status))
+        if whole:
+            self._leaf_stats_cache[leaf_start] = digest, stats
+        return stats
+
+    def _subtree_stats(self, node_start):
+        try:
+            return self._subtree_counts[node_start]
+        except KeyError:
+            pass
+        nr_of_elements, children_flag, node_data = self._read_whole_node(
+            node_start)
+        stats = (0, 0, None, None)
+        for pointer in node_data[0::2]:
+            stats = self._merge_stats(stats, self._page_stats(pointer, children_flag))
+        self._subtree_counts[node_start] = stats
+        return stats
+
+    def _subtree_count(self, node_start):
+        return self._subtree_stats(node_start)[0]
+
+    def _page_stats(self, page_start, flag, lower=None, upper=None, inclusive_lower=True, inclusive_upper=True):
+        """
+        Stats of records with keys between ``lower`` and ``upper`` in subtree
+        starting at given page. Children fully inside the range use stored stats,
+        only children with range bounds are visited.
+        """
+        if flag == 'l':
+            return self._leaf_stats(page_start, lower, upper, inclusive_lower, inclusive_upper)
+        if lower is None and upper is None:
+            return self._subtree_stats(page_start)
+        nr_of_elements, children_flag, node_data = self._read_whole_node(
+            page_start)
+        separators = node_data[1::2]
+        first, last = 0, nr_of_elements
+        if lower is not None:
+            if inclusive_lower:
+                first = bisect_left(separators, lower)
+            else:
+                first = bisect_right(separators, lower)
+        if upper is not None:
+            if inclusive_upper:
+                last = bisect_right(separators, upper)
+            else:
+                last = bisect_left(separators, upper)
+        stats = (0, 0, None, None)
+        for child_index in xrange(first, last + 1):
+            stats = self._merge_stats(stats, self._page_stats(
+                node_data[child_index * 2], children_flag,
+                lower if child_index == first else None,
+                upper if child_index == last else None,
+                inclusive_lower, inclusive_upper))
+        return stats
+
+    def _subtree_inserted(self, nodes_stack, start, size, status):
+        value = None
+        if any(node_start in self._subtree_counts for node_start in nodes_stack):
+            value = self._record_value(start, size, status)
+        for node_start in nodes_stack:
+            if node_start in self._subtree_counts:
+                self._subtree_counts[node_start] = self._add_value(
+                    self._subtree_counts[node_start], value)
+
+    def _subtree_removed(self, nodes_stack, leaf_start, key_index):
+        start, size, status = self._read_single_leaf_record(
+            leaf_start, key_index)[2:]
+        value = self._record_value(start, size, status)
+        for node_start in nodes_stack:
+            if node_start not in self._subtree_counts:
+                continue
+            records, total, min_value, max_value = self._subtree_counts[node_start]
+            if value is not None and (value <= min_value or value >= max_value):
+                # new min / max is unknown, it will be computed again
+                del self._subtree_counts[node_start]
+            else:
+                self._subtree_counts[node_start] = (
+                    records - 1, total - (value or 0), min_value, max_value)
+
+    def update(self, doc_id, key, u_start=0, u_size=0, u_status='o'):
+        if self.root_flag == 'n' and self._subtree_counts:
+            leaf_start, key_index, old_doc_id, old_key, old_start, old_size, old_status = self._find_key_to_update(key, doc_id)
+            old_value = self._record_value(old_start, old_size, old_status)
+            new_value = self._record_value(u_start or old_start,
+                                           u_size or old_size,
+                                           u_status or old_status)
+            if old_value != new_value:
+                path = self._find_path_to_leaf(key, leaf_start)
+                if path is None:
+                    self._subtree_counts.clear()
+                else:
+                    for node_start, child_index in path:
+                        stats = self._subtree_counts.get(node_start)
+                        if stats is None:
+                            continue
+                        if old_value is not None and (old_value <= stats[2] or old_value >= stats[3]):
+                            del self._subtree_counts[node_start]
+                            continue
+                        if old_value is not None:
+                            stats = stats[0], stats[1] - old_value, stats[2], stats[3]
+                        self._subtree_counts[node_start] = self._add_value(
+                            stats, new_value, count=0)
+        return super(IU_AggregatedTreeBasedIndex, self).update(
+            doc_id, key, u_start, u_size, u_status)
+
+    def aggregate_between(self, start=None, end=None, inclusive_start=True, inclusive_end=True):
+        """
+        Returns dict with ``count`` of records with keys within given interval
+        and ``sum``, ``min`` and ``max`` of their values (``None`` means that
+        interval is open on that side).
+        """
+        if start is not None:
+            start = self.make_key(start)
+        if end is not None:
+            end = self.make_key(end)
+        if start is not None and end is not None and \
+                (start > end or (start == end and not (inclusive_start and inclusive_end))):
+            records, total, min_value, max_value = 0, 0, None, None
+        else:
+            records, total, min_value, max_value = self._page_stats(
+                self.data_start, self.root_flag, start, end, inclusive_start, inclusive_end)
+        return dict(count=records, sum=total, min=min_value, max=max_value)
+
+    def run_aggregate(self, db, start=None, end=None, inclusive_start=True, inclusive_end=True):
+        return self.aggregate_between(start, end, inclusive_start, inclusive_end)
+
+    def run_sum(self, db, start=None, end=None, inclusive_start=True, inclusive_end=True):
+        return self.aggregate_between(start, end, inclusive_start, inclusive_end)['sum']
+
+
+class IU_CompositeTreeBasedIndex(IU_TreeBasedIndex):
+
+    """
+    Tree index with keys made of many values, for example ``(tenant, created_at)``.
+
+    ``key_parts`` is a list of formats of key parts: integers (``bhilqBHILQ``),
+    floats (``f``, ``d``), fixed width strings (``16s``) or registered codec
+    names (``int``, ``uint``, ``float``, ``datetime``, ``date``), ``-`` in front of
+    format means descending order. Tuples are encoded so the tree is ordered
+    like tuples (:py:class:`CodernityDB.key_codecs.CompositeKey`).
+    ``get_many`` and ``get_between`` accept first parts of key as well,
+    so all records of a tenant from a time range are returned by single scan.
+
+    ``key_codec`` may be given instead of ``key_parts``, then keys are single
+    values encoded with that format (for example ``key_codec='datetime'``).
+    """
+
+    custom_header = 'from CodernityDB.tree_index import CompositeTreeBasedIndex'
+
+    def __init__(self, *args, **kwargs):
+        key_parts = kwargs.pop('key_parts', None)
+        key_codec = kwargs.pop('key_codec', None)
+        if key_parts and key_codec:
+            raise IndexPreconditionsException(
+                "Use key_parts or key_codec, not both")
+        if not (key_parts or key_codec):
+            raise IndexPreconditionsException(
+                "key_parts or key_codec is required")
+        self.single_key = bool(key_codec)
+        self._key_codec = CompositeKey(key_codec or key_parts, self.single_key)
+        self.key_parts = self._key_codec.parts
+        kwargs['key_format'] = self._key_codec.key_format
+        super(IU_CompositeTreeBasedIndex, self).__init__(*args, **kwargs)
+
+    def create_index(self):
+        super(IU_CompositeTreeBasedIndex, self).create_index()
+        self._save_params(dict(key_parts=self.key_parts,
+                               single_key=self.single_key))
+
+    def _fix_params(self):
+        super(IU_CompositeTreeBasedIndex, self)._fix_params()
+        self._key_codec = CompositeKey(self.key_parts, self.single_key)
+
+    def _decode_records(self, records):
+        decode = self._key_codec.decode
+        for record in records:
+            yield (record[0], decode(record[1])) + tuple(record[2:])
+
+    def insert(self, doc_id, key, start, size, status='o'):
+        return super(IU_CompositeTreeBasedIndex, self).insert(
+            doc_id, self._key_codec.encode(key), start, size, status)
+
+    def update(self, doc_id, key, u_start=0, u_size=0, u_status='o'):
+        return super(IU_CompositeTreeBasedIndex, self).update(
+            doc_id, self._key_codec.encode(key), u_start, u_size, u_status)
+
+    def delete(self, doc_id, key, start=0, size=0):
+        return super(IU_CompositeTreeBasedIndex, self).delete(
+            doc_id, self._key_codec.encode(key), start, size)
+
+    def get(self, key):
+        doc_id, l_key, start, size, status = self._find_key(
+            self._key_codec.encode(self.make_key(key)))
+        return doc_id, self._key_codec.decode(l_key), start, size, status
+
+    def get_multi(self, keys):
+        encode = self._key_codec.encode
+        keys = sorted(set(encode(self.make_key(key)) for key in keys))
+        return list(self._decode_records(self._find_keys(keys)))
+
+    def get_many(self, key, limit=1, offset=0, reverse=False, cursor=None):
+        """
+        Returns records with key starting with given parts.
+        """
+        key = self.make_key(key)
+        start = self._key_codec.encode_prefix(key)
+        end = self._key_codec.encode_prefix(key, high=True)
+        return self._decode_records(self._find_key_range(start, end, limit, offset, True, True, reverse, cursor))
+
+    def get_between(self, start, end, limit=1, offset=0, inclusive_start=True, inclusive_end=True, reverse=False, cursor=None):
+        """
+        ``start`` and ``end`` may contain only first parts of key, then
+        all keys starting with them are inside (or outside when not inclusive) of interval.
+        """
+        if start is not None:
+            start = self._key_codec.encode_prefix(
+                self.make_key(start), high=not inclusive_start)
+        else:
+            reverse = True  # the same order as in TreeBasedIndex
+        if end is not None:
+            end = self._key_codec.encode_prefix(
+                self.make_key(end), high=inclusive_end)
+        return self._decode_records(self._find_key_range(start, end, limit, offset, inclusive_start, inclusive_end, reverse, cursor))
+
+    def all(self, limit=-1, offset=0, reverse=False, cursor=None):
+        return self._decode_records(super(IU_CompositeTreeBasedIndex, self).all(limit, offset, reverse, cursor))
+
+    def distinct_keys(self, start=None, end=None, limit=-1):
+        if start is not None:
+            start = self._key_codec.encode_prefix(self.make_key(start))
+        if end is not None:
+            end = self._key_codec.encode_prefix(self.make_key(end), high=True)
+        decode = self._key_codec.decode
+        for key in self._distinct_keys(start, end, limit):
+            yield decode(key)
+
+    def make_key(self, key):
+        return key
+
+
 # classes for public use, done in this way because of
 # generation static files with indexes (_index directory)
 
@@ -2048,3 +3262,27 @@ class MultiTreeBasedIndex(IU_MultiTreeBasedIndex):
     That class is designed to be used in custom indexes.
     """
     pass
+
+
+class CountedTreeBasedIndex(IU_CountedTreeBasedIndex):
+
+    """
+    TreeBasedIndex with fast ``offset`` and ``run_count``.
+    """
+    pass
+
+
+class AggregatedTreeBasedIndex(IU_AggregatedTreeBasedIndex):
+
+    """
+    CountedTreeBasedIndex with fast range ``run_sum`` and ``run_aggregate``.
+    """
+    pass
+
+
+class CompositeTreeBasedIndex(IU_CompositeTreeBasedIndex):
+
+    """
+    TreeBasedIndex with tuple keys and prefix queries.
+    """
+    pass
@@ -19,18 +19,20 @@ from CodernityDB.database import Database, RecordDeleted, RecordNotFound
 from CodernityDB.database import DatabaseException, RevConflict, DatabasePathException, DatabaseConflict, PreconditionsException, IndexConflict
 
 from CodernityDB.hash_index import HashIndex, UniqueHashIndex, MultiHashIndex
-from CodernityDB.index import IndexException, TryReindexException, IndexNotFoundException, IndexPreconditionsException
+from CodernityDB.index import IndexException, TryReindexException, IndexNotFoundException, IndexNotReadyException, IndexPreconditionsException
 
 from CodernityDB.tree_index import TreeBasedIndex, MultiTreeBasedIndex
 
 from CodernityDB.debug_stuff import database_step_by_step
+from CodernityDB.background import IndexBuilder
 
-from CodernityDB import rr_cache
+from CodernityDB import rr_cache, lru_cache
 
 import pytest
 import os
 import random
 from hashlib import md5
+from itertools import islice
 
 try:
     from collections import Counter
@@ -124,6 +126,13 @@ class WithAIndex(HashIndex):
         return md5(key).digest()
 
 
+class FieldStorage_IdIndex(UniqueHashIndex):
+
+    def __init__(self, *args, **kwargs):
+        kwargs['storage_class'] = 'FieldStorage'
+        super(FieldStorage_IdIndex, self).__init__(*args, **kwargs)
+
+
 class Simple_TreeIndex(TreeBasedIndex):
 
     def __init__(self, *args, **kwargs):
@@ -141,6 +150,70 @@ class Simple_TreeIndex(TreeBasedIndex):
         return key
 
 
+class Deferred_TreeIndex(TreeBasedIndex):
+
+    deferred = True
+
+    def __init__(self, *args, **kwargs):
+        kwargs['node_capacity'] = 10
+        kwargs['key_format'] = 'I'
+        super(Deferred_TreeIndex, self).__init__(*args, **kwargs)
+
+    def make_key_value(self, data):
+        return data['t'], None
+
+    def make_key(self, key):
+        return key
+
+
+class InputFields_TreeIndex(TreeBasedIndex):
+
+    input_fields = ('t', )
+
+    def __init__(self, *args, **kwargs):
+        kwargs['node_capacity'] = 10
+        kwargs['key_format'] = 'I'
+        super(InputFields_TreeIndex, self).__init__(*args, **kwargs)
+
+    def make_key_value(self, data):
+        t_val = data.get('t')
+        if t_val is not None:
+            return t_val, None
+        return None
+
+    def make_key(self, key):
+        return key
+
+
+class TwoQ_TreeIndex(TreeBasedIndex):
+
+    def __init__(self, *args, **kwargs):
+        kwargs['node_capacity'] = 10
+        kwargs['key_format'] = 'I'
+        kwargs['cache_type'] = '2q'
+        super(TwoQ_TreeIndex, self).__init__(*args, **kwargs)
+
+    def make_key_value(self, data):
+        return data['t'], None
+
+    def make_key(self, key):
+        return key
+
+
+class RR_HashIndex(HashIndex):
+
+    def __init__(self, *args, **kwargs):
+        kwargs['key_format'] = 'I'
+        kwargs['cache_type'] = 'rr'
+        super(RR_HashIndex, self).__init__(*args, **kwargs)
+
+    def make_key_value(self, data):
+        return int(data['test'] > 5), None
+
+    def make_key(self, key):
+        return key
+
+
 class WithRun_Index(HashIndex):
 
     def __init__(self, *args, **kwargs):
@@ -269,6 +342,225 @@ class DB_Tests:
         with pytest.raises(RevConflict):
             db.update(doc2)
 
+    def test_update_delete_without_read(self, tmpdir):
+        db = self._db(os.path.join(str(tmpdir), 'db'))
+        db.set_indexes([UniqueHashIndex(db.path, 'id')])
+        db.create()
+        docs = [dict(a=i, b='x' * 1000) for i in xrange(4)]
+        for doc in docs:
+            db.insert(doc)
+
+        reads = []
+        storage = db.id_ind.storage
+        get = storage.get
+
+        def counting_get(*args):
+            reads.append(args)
+            return get(*args)
+        storage.get = counting_get
+        docs[0]['b'] = 'y'
+        db.update(docs[0])
+        db.delete(docs[1])
+        assert reads == []
+        with pytest.raises(RevConflict):
+            db.update(dict(docs[2], _rev='00000000'))
+        with pytest.raises(RevConflict):
+            db.delete(dict(docs[2], _rev='00000000'))
+        with pytest.raises(RecordDeleted):
+            db.update(docs[1])
+        assert reads == []
+
+        # old version is read when index needs it
+        db.add_index(WithAIndex(db.path, 'with_a'))
+        db.reindex_index('with_a')
+        del reads[:]
+        docs[2]['a'] = 10
+        db.update(docs[2])
+        assert len(reads) == 1
+        db.delete(docs[3])
+        assert len(reads) == 2
+        del storage.get
+        assert db.count(db.all, 'with_a') == 2
+        assert db.get('with_a', 10, with_doc=True)['doc']['b'] == 'x' * 1000
+        assert db.get('id', docs[0]['_id'])['b'] == 'y'
+        db.close()
+
+    def test_patch(self, tmpdir):
+        db = self._db(os.path.join(str(tmpdir), 'db'))
+        db.set_indexes([UniqueHashIndex(db.path, 'id'),
+                        InputFields_TreeIndex(db.path, 't')])
+        db.create()
+        doc = dict(t=1, views=0, big='x' * 3000)
+        db.insert(doc)
+
+        calls = []
+        index = db.indexes_names['t']
+        make_key_value = index.make_key_value
+
+        def counting_make_key_value(data):
+            calls.append(data)
+            return make_key_value(data)
+        index.make_key_value = counting_make_key_value
+        ret = db.patch(doc['_id'], doc['_rev'], {'views': 1})
+        assert calls == []
+        stored = db.get('id', doc['_id'])
+        assert stored['views'] == 1
+        assert stored['big'] == 'x' * 3000
+        assert stored['_rev'] == ret['_rev']
+        with pytest.raises(RevConflict):
+            db.patch(doc['_id'], doc['_rev'], {'views': 2})
+        with pytest.raises(PreconditionsException):
+            db.patch(doc['_id'], ret['_rev'], {}, unset=['_rev'])
+
+        ret = db.patch(doc['_id'], ret['_rev'], {'t': 5}, unset=['views'])
+        assert len(calls) == 2
+        del index.make_key_value
+        assert 'views' not in db.get('id', doc['_id'])
+        assert db.get('t', 5)['_id'] == doc['_id']
+        with pytest.raises(RecordNotFound):
+            db.get('t', 1)
+
+        stor = os.path.join(db.path, 'id_stor')
+        size = os.path.getsize(stor)
+        ret = db.patch(doc['_id'], ret['_rev'], {'t': 6}, in_place=True)
+        assert os.path.getsize(stor) == size
+        stored = db.get('t', 6, with_doc=True)['doc']
+        assert stored['big'] == 'x' * 3000
+        assert stored['_rev'] == ret['_rev']
+        db.patch(doc['_id'], ret['_rev'], {'t': 7})
+        assert os.path.getsize(stor) > size
+        assert db.count(db.all, 't') == 1
+        db.close()
+
+    def test_update_skips_unchanged_indexes(self, tmpdir):
+        db = self._db(os.path.join(str(tmpdir), 'db'))
+        db.set_indexes([UniqueHashIndex(db.path, 'id'),
+                        InputFields_TreeIndex(db.path, 't'),
+                        Simple_TreeIndex(db.path, 'simple')])
+        db.create()
+        doc = dict(t=1, views=0)
+        db.insert(doc)
+
+        calls = Counter()
+        for index in db.indexes[1:]:
+            def counting_make_key_value(data, name=index.name,
+                                        make_key_value=index.make_key_value):
+                calls[name] += 1
+                return make_key_value(data)
+            index.make_key_value = counting_make_key_value
+        doc['views'] = 1
+        db.update(doc)
+        assert calls['t'] == 0
+        assert calls['simple'] == 2
+        doc['t'] = 1.0  # equal, but may give other key
+        db.update(doc)
+        assert calls['t'] == 2
+        doc['t'] = 2
+        db.update(doc)
+        assert calls['t'] == 4
+        del doc['t']
+        db.update(doc)
+        assert calls['t'] == 6
+        for index in db.indexes[1:]:
+            del index.make_key_value
+        assert db.count(db.all, 't') == 0
+        doc['t'] = 3
+        db.update(doc)
+        assert db.get('t', 3)['_id'] == doc['_id']
+        db.close()
+
+    def test_with_doc_batches(self, tmpdir):
+        db = self._db(os.path.join(str(tmpdir), 'db'))
+        db.set_indexes([UniqueHashIndex(db.path, 'id'),
+                        Simple_TreeIndex(db.path, 't')])
+        db.create()
+        ts = range(250)
+        random.shuffle(ts)
+        for t in ts:
+            db.insert(dict(t=t, a=t * 2, b='x' * random.randint(0, 5000)))
+        for curr in db.all('id'):
+            if curr['t'] % 10 == 0:
+                curr['b'] = 'y'
+                db.update(curr)
+        db.doc_batch = 100
+
+        reads = []
+        storage = db.id_ind.storage
+        get_multi = storage.get_multi
+
+        def counting_get_multi(records, fields=None):
+            reads.append(len(records))
+            return get_multi(records, fields)
+        storage.get = None  # documents are read only by get_multi
+        storage.get_multi = counting_get_multi
+        got = list(db.get_many('t', start=20, end=239, with_doc=True))
+        assert reads == [100, 100, 20]
+        assert [curr['key'] for curr in got] == range(20, 240)
+        for curr in got:
+            assert curr['doc']['a'] == curr['key'] * 2
+            assert curr['doc']['_id'] == curr['_id']
+            assert (curr['doc']['b'] == 'y') == (curr['key'] % 10 == 0)
+
+        del reads[:]
+        got = list(db.all('t', with_doc=True, reverse=True))
+        assert reads == [100, 100, 50]
+        assert [curr['doc']['t'] for curr in got] == range(249, -1, -1)
+
+        got = db.get_multi('t', [5, 300, 7], with_doc=True)
+        assert [curr['doc']['a'] for curr in got] == [10, 14]
+
+        part = list(islice(db.get_many('t', start=0, with_doc=True,
+                                       cursor=True), 150))
+        rest = list(db.get_many('t', start=0, with_doc=True,
+                                cursor=part[-1]['_cursor']))
+        assert [curr['doc']['t'] for curr in part + rest] == range(250)
+        del storage.get
+        del storage.get_multi
+        db.close()
+
+    def test_fields(self, tmpdir):
+        for id_class, storage_class in ((UniqueHashIndex, 'IU_Storage'),
+                                        (FieldStorage_IdIndex, 'FieldStorage')):
+            db = self._db(os.path.join(str(tmpdir), storage_class))
+            db.set_indexes([id_class(db.path, 'id'),
+                            Simple_TreeIndex(db.path, 't')])
+            db.create()
+            docs = []
+            for t in xrange(20):
+                doc = dict(('f%d' % i, i * t) for i in xrange(60))
+                doc.update(t=t, name=u'n%d' % t, tags=['a'] * t, x=t * 1.5)
+                db.insert(doc)
+                docs.append(doc)
+            docs[3]['name'] = 'changed'
+            db.update(docs[3])
+            fields = ['name', 'tags', 'missing']
+
+            def project(doc):
+                return dict(_id=doc['_id'], _rev=doc['_rev'],
+                            name=doc['name'], tags=doc['tags'])
+            assert db.get('id', docs[3]['_id']) == docs[3]
+            assert db.get('id', docs[3]['_id'], fields=fields) == project(docs[3])
+            assert db.get('id', docs[4]['_id'], fields=[]) == dict(
+                _id=docs[4]['_id'], _rev=docs[4]['_rev'])
+            curr = db.get('t', 5, with_doc=True, fields=fields)
+            assert curr['doc'] == project(docs[5])
+            got = db.get_many('t', start=2, end=6, with_doc=True,
+                              fields=fields)
+            assert [curr['doc'] for curr in got] == map(project, docs[2:7])
+            got = db.all('t', with_doc=True, fields=['x'])
+            assert [curr['doc']['x'] for curr in got] == [t * 1.5 for t in xrange(20)]
+            got = db.all('id', fields=fields)
+            assert sorted(got) == sorted(map(project, docs))
+            got = db.get_multi('t', [7, 1], with_doc=True, fields=fields)
+            assert [curr['doc'] for curr in got] == map(project, [docs[1], docs[7]])
+            db.compact()
+            db.close()
+            db.open()
+            assert db.id_ind.storage.__class__.__name__ == storage_class
+            assert db.get('id', docs[3]['_id'], fields=fields) == project(docs[3])
+            assert db.get('id', docs[8]['_id']) == docs[8]
+            db.close()
+
     def test_wrong_id(self, tmpdir):
         db = self._db(os.path.join(str(tmpdir), 'db'))
         db.set_indexes([UniqueHashIndex(db.path, 'id')])
@@ -911,6 +1203,197 @@ class DB_Tests:
 
         db.close()
 
+    def test_reindex_single_pass(self, tmpdir):
+        db = self._db(os.path.join(str(tmpdir), 'db'))
+        db.set_indexes([UniqueHashIndex(db.path, 'id')])
+        db.create()
+        for i in xrange(100):
+            db.insert(dict(a=i, test=i % 10))
+        db.add_index(WithAIndex(db.path, 'with_a'))
+        db.add_index(CustomHashIndex(db.path, 'custom'))
+        assert db.count(db.all, 'with_a') == 0
+
+        reads = []
+        storage = db.id_ind.storage
+        get = storage.get
+
+        def counting_get(*args):
+            reads.append(args)
+            return get(*args)
+        storage.get = counting_get
+        db.reindex()
+        assert len(reads) == 100
+        assert db.count(db.all, 'with_a') == 100
+        assert db.count(db.get_many, 'custom', key=1, limit=-1) == 40
+        assert db.get('with_a', 7, with_doc=True)['doc']['a'] == 7
+
+        del reads[:]
+        db.reindex(['custom'])
+        assert len(reads) == 100
+        assert db.count(db.get_many, 'custom', key=0, limit=-1) == 60
+        with pytest.raises(DatabaseException):
+            db.reindex(['id', 'custom'])
+        del storage.get
+        db.close()
+
+    def test_parallel_reindex_compact(self, tmpdir):
+        db = self._db(os.path.join(str(tmpdir), 'db'))
+        db.set_indexes([UniqueHashIndex(db.path, 'id')])
+        db.create()
+        docs = []
+        for i in xrange(200):
+            doc = dict(a=i, test=i % 10, t=i)
+            db.insert(doc)
+            docs.append(doc)
+        db.add_index(WithAIndex(db.path, 'with_a'))
+        db.add_index(CustomHashIndex(db.path, 'custom'))
+        db.add_index(TwoQ_TreeIndex(db.path, 'tree'))
+
+        db.reindex(workers=2)
+        assert not os.path.exists(os.path.join(db.path, '_reindex'))
+        assert db.count(db.all, 'with_a') == 200
+        assert db.count(db.get_many, 'custom', key=1, limit=-1) == 80
+        assert db.count(db.get_many, 'tree', start=50, end=99, limit=-1) == 50
+
+        for doc in docs[:100]:
+            db.delete(doc)
+        for doc in docs[100:150]:
+            doc['a'] += 1000
+            db.update(doc)
+        db.compact(workers=3)
+        assert db.count(db.all, 'id') == 100
+        assert db.count(db.all, 'with_a') == 100
+        assert db.get('with_a', 1120, with_doc=True)['doc']['t'] == 120
+        assert db.count(db.get_many, 'tree', start=50, end=199, limit=-1) == 100
+        db.insert(dict(a=5000, t=5000))
+        assert db.get('with_a', 5000)['_id']
+        db.close()
+
+        db = self._db(os.path.join(str(tmpdir), 'db'))
+        db.open()
+        assert db.count(db.all, 'with_a') == 101
+        db.close()
+
+    def test_build_index(self, tmpdir):
+        db = self._db(os.path.join(str(tmpdir), 'db'))
+        db.set_indexes([UniqueHashIndex(db.path, 'id')])
+        db.create()
+        docs = {}
+        for i in xrange(1000):
+            doc = dict(t=i)
+            db.insert(doc)
+            docs[doc['_id']] = doc
+
+        def write(n):
+            for x in xrange(n):
+                op = random.random()
+                if op < 0.3:
+                    doc = dict(t=random.randint(0, 2000))
+                    db.insert(doc)
+                    docs[doc['_id']] = doc
+                elif op < 0.8:
+                    doc = docs[random.choice(docs.keys())]
+                    doc['t'] = random.randint(0, 2000)
+                    db.update(doc)
+                else:
+                    db.delete(docs.pop(random.choice(docs.keys())))
+
+        def check():
+            expected = sorted((doc['t'], _id) for _id, doc in docs.iteritems())
+            assert sorted((rec['key'], rec['_id'])
+                          for rec in db.all('tree')) == expected
+
+        # writes made before the index is ready go to catch-up log
+        db.add_index(TwoQ_TreeIndex(db.path, 'tree'))
+        builder = IndexBuilder(db, db.indexes_names['tree'])
+        db.index_builders['tree'] = builder
+        with pytest.raises(IndexNotReadyException):
+            db.get('tree', 1)
+        with pytest.raises(IndexNotReadyException):
+            db.count(db.all, 'tree')
+        write(200)
+        assert builder.log
+        builder.start(threaded=False)
+        assert builder.ready
+        assert 'tree' not in db.index_builders
+        check()
+
+        # thread safe databases build in background, next to the writes
+        builder = db.build_index('tree')
+        write(300)
+        assert builder.wait() is True
+        check()
+        with pytest.raises(PreconditionsException):
+            db.build_index('id')
+
+        # interrupted build starts again on open
+        db.indexes_names['tree']._save_params(dict(building=True))
+        db.close()
+        db = self._db(os.path.join(str(tmpdir), 'db'))
+        db.open()
+        if 'tree' in db.index_builders:
+            db.index_builders['tree'].wait()
+        assert not db.indexes_names['tree'].building
+        check()
+        db.close()
+
+    def test_deferred_index(self, tmpdir):
+        db = self._db(os.path.join(str(tmpdir), 'db'))
+        db.set_indexes([UniqueHashIndex(db.path, 'id')])
+        db.create()
+        db.add_index(Deferred_TreeIndex(db.path, 'tree'))
+        assert 'tree' in db.deferred_indexes
+        docs = {}
+        for i in xrange(300):
+            doc = dict(t=i)
+            db.insert(doc)
+            docs[doc['_id']] = doc
+        for _id in docs.keys()[:50]:
+            docs[_id]['t'] += 1000
+            db.update(docs[_id])
+        for _id in docs.keys()[50:100]:
+            db.delete(docs.pop(_id))
+
+        def check():
+            expected = sorted((doc['t'], _id) for _id, doc in docs.iteritems())
+            assert sorted((rec['key'], rec['_id'])
+                          for rec in db.all('tree')) == expected
+
+        lag = db.get_index_lag('tree')
+        assert lag['lag'] >= 0
+        assert lag['pending'] <= 300
+        db.wait_for_index('tree')
+        assert db.get_index_lag('tree') == dict(pending=0, lag=0.0)
+        check()
+        assert db.get_index_lag('id') == dict(pending=0, lag=0.0)
+        with pytest.raises(IndexNotFoundException):
+            db.wait_for_index('none')
+
+        # writes left are applied on close
+        for _id in docs.keys()[:20]:
+            db.delete(docs.pop(_id))
+        db.close()
+        pending = os.path.join(db.path, '_indexes', 'tree.pending')
+        assert not os.path.exists(pending)
+        db = self._db(os.path.join(str(tmpdir), 'db'))
+        db.open()
+        check()
+
+        # index that wasn't closed cleanly is rebuilt on open
+        db.deferred_indexes['tree'].discard()
+        for _id in docs.keys()[:20]:
+            db.delete(docs.pop(_id))
+        db.deferred_indexes['tree'].discard()
+        db.close()
+        open(pending, 'w').close()
+        db = self._db(os.path.join(str(tmpdir), 'db'))
+        db.open()
+        if 'tree' in db.index_builders:
+            db.index_builders['tree'].wait()
+        db.wait_for_index('tree')
+        check()
+        db.close()
+
     def test_add_new_index_update_before_reindex_new_value(self, tmpdir):
         db = self._db(os.path.join(str(tmpdir), 'db'))
         db.create()
@@ -1094,6 +1577,66 @@ x * 10, None
         with pytest.raises(DatabaseException):
             db.revert_index('test_revert', reindex=True)  # second restore
 
+    def test_edit_index_shadow(self, tmpdir):
+        db = self._db(os.path.join(str(tmpdir), 'db'))
+        db.create()
+
+        ok = """name: test_shadow
+type: HashIndex
+key_format: I
+make_key_value:
+x, None
+"""
+
+        ok2 = """name: test_shadow
+type: HashIndex
+key_format: I
+make_key_value:
+x * 10, None
+"""
+        db.add_index(ok)
+        docs = [dict(x=x) for x in xrange(100)]
+        for doc in docs:
+            db.insert(doc)
+
+        def keys():
+            return sorted(curr['key'] for curr in db.all('test_shadow'))
+
+        # current version is used (and written) until the new one is ready
+        db.edit_index(ok2, shadow=True)
+        for x in xrange(100, 120):
+            docs.append(dict(x=x))
+            db.insert(docs[-1])
+        for doc in docs[:10]:
+            doc['x'] += 1000
+            db.update(doc)
+        for doc in docs[10:20]:
+            db.delete(doc)
+        del docs[10:20]
+        if 'test_shadow' in db.shadow_indexes:
+            assert db.shadow_indexes['test_shadow'].wait() is True
+        assert 'x * 10' in db.get_index_code('test_shadow')
+        assert keys() == sorted(doc['x'] * 10 for doc in docs)
+
+        # replaced version is kept up to date, revert swaps it back
+        docs.append(dict(x=5000))
+        db.insert(docs[-1])
+        db.delete(docs.pop(0))
+        db.revert_index('test_shadow')
+        assert 'x * 10' not in db.get_index_code('test_shadow')
+        assert keys() == sorted(doc['x'] for doc in docs)
+        db.revert_index('test_shadow')
+        assert keys() == sorted(doc['x'] * 10 for doc in docs)
+
+        db.close()
+        db = self._db(os.path.join(str(tmpdir), 'db'))
+        db.open()
+        assert not os.path.exists(os.path.join(db.path, '_shadow'))
+        assert keys() == sorted(doc['x'] * 10 for doc in docs)
+        db.revert_index('test_shadow', reindex=True)
+        assert keys() == sorted(doc['x'] for doc in docs)
+        db.close()
+
     def test_index_maj_min(self, tmpdir):
         db = self._db(os.path.join(str(tmpdir), 'db'))
         db.create()
@@ -1111,3 +1654,255 @@ x * 10, None
                     db2.insert({'a': l * x})
 
         db2.count(db2.get_many, 'minor', 'a') == 5
+
+    def test_cursor_hash_index(self, tmpdir):
+        db = self._db(os.path.join(str(tmpdir), 'db'))
+        db.set_indexes([UniqueHashIndex(db.path, 'id'),
+                        CustomHashIndex(db.path, 'custom')])
+        db.create()
+        for x in xrange(30):
+            db.insert(dict(test=x))
+        for index_name in ('id', 'custom'):
+            expected = [x['_id'] for x in db.all(index_name)]
+            page = list(db.all(index_name, limit=4, cursor=True))
+            result = []
+            while page:
+                result.extend(x['_id'] for x in page)
+                page = list(db.all(index_name, limit=4, cursor=page[-1]['_cursor']))
+            assert result == expected
+        expected = [x['_id'] for x in db.get_many('custom', 1, limit=-1)]
+        page = list(db.get_many('custom', 1, limit=5, cursor=True))
+        result = []
+        while page:
+            result.extend(x['_id'] for x in page)
+            page = list(db.get_many('custom', 1, limit=5, cursor=page[-1]['_cursor']))
+        assert result == expected
+        first = list(db.get_many('custom', 1, limit=1, cursor=True, with_doc=True))[0]
+        db.delete(first['doc'])
+        db.compact()
+        cursor = first['_cursor']
+        with pytest.raises(IndexException):
+            db.get_many('custom', 1, cursor=cursor).next()
+        with pytest.raises(PreconditionsException):
+            db.all('custom', cursor='xyz').next()
+
+    def test_get_many_key_ignores_range_arguments(self, tmpdir):
+        db = self._db(os.path.join(str(tmpdir), 'db'))
+        db.set_indexes([UniqueHashIndex(db.path, 'id'),
+                        CustomHashIndex(db.path, 'custom')])
+        db.create()
+        for x in xrange(30):
+            db.insert(dict(test=x))
+        expected = [x['_id'] for x in db.get_many('custom', 1, limit=-1)]
+        assert [x['_id'] for x in db.get_many('custom', 1, limit=-1, inclusive_start=False,
+                                               inclusive_end=False, reverse=False)] == expected
+
+    def test_get_multi(self, tmpdir):
+        db = self._db(os.path.join(str(tmpdir), 'db'))
+        db.set_indexes([UniqueHashIndex(db.path, 'id'),
+                        CustomHashIndex(db.path, 'custom')])
+        db.create()
+        ids = [db.insert(dict(test=x))['_id'] for x in xrange(30)]
+        result = db.get_multi('id', ids[:10] + ['a' * 32])
+        assert [x['_id'] for x in result] == ids[:10]
+        assert all(x['test'] == n for n, x in enumerate(result))
+        result = db.get_multi('custom', [1, 0, 2], with_doc=True)
+        assert [x['doc']['test'] > 5 for x in result] == [True, False]
+
+    def test_cache_policies(self):
+        cache = lru_cache.LRU(3)
+        for x in 'abc':
+            cache.put(x, x.upper())
+        assert cache.get('a') == 'A'
+        assert cache.put('d', 'D') == 'b'
+        with pytest.raises(KeyError):
+            cache.get('b')
+        assert cache.put('a', 'AA') is lru_cache.NOTHING
+        assert cache.discard('c')
+        assert not cache.discard('c')
+        assert len(cache) == 2
+
+        cache = lru_cache.TwoQ(8)
+        for x in xrange(8):
+            cache.put(x, x)
+        for x in xrange(2):
+            cache.put(8 + x, 8 + x)
+            cache.put(x, x)
+        # hot entries survive the scan
+        for x in xrange(100, 200):
+            cache.put(x, x)
+        assert cache.get(0) == 0 and cache.get(1) == 1
+        assert len(cache) == 8
+
+        calls = []
+
+        @lru_cache.cache2lvl(3)
+        def read(a, b):
+            calls.append((a, b))
+            return a + b
+        for args in ((1, 1), (1, 2), (2, 1), (1, 1)):
+            read(*args)
+        assert len(calls) == 3
+        read(3, 3)
+        assert read.delete(1)
+        assert not read.delete(1, 2)
+        assert read.delete(3, 3)
+        read(1, 1)
+        read(2, 1)
+        assert calls[-1] == (1, 1)
+
+    def test_cache_types(self, tmpdir):
+        db = self._db(os.path.join(str(tmpdir), 'db'))
+        db.set_indexes([UniqueHashIndex(db.path, 'id'),
+                        RR_HashIndex(db.path, 'custom'),
+                        TwoQ_TreeIndex(db.path, 'tree')])
+        db.create()
+        for name, policy in (('tree', lru_cache.TwoQ), ('id', lru_cache.LRU)):
+            # thread safe databases use segmented caches
+            cache = db.indexes_names[name]._find_key.cache
+            assert getattr(cache, 'policy', type(cache)) is policy
+        docs = [dict(t=x % 50, test=x) for x in xrange(400)]
+        for doc in docs:
+            db.insert(doc)
+        for doc in docs[::3]:
+            doc['t'] += 100
+            db.update(doc)
+        for doc in docs[1::3]:
+            db.delete(doc)
+        for doc in docs[::3]:
+            assert db.get('id', doc['_id'])['_rev'] == doc['_rev']
+            assert db.get('tree', doc['t'])['key'] == doc['t']
+        assert db.count(db.get_many, 'tree', limit=-1,
+                        start=100, end=150) == len(docs[::3])
+        assert db.count(db.all, 'tree') == len(docs) - len(docs[1::3])
+        assert db.count(db.get_many, 'custom', 0, limit=-1) == 4
+        with pytest.raises(IndexPreconditionsException):
+            UniqueHashIndex(db.path, 'other', cache_type='arc')
+
+    def test_cache_stats(self, tmpdir):
+        db = self._db(os.path.join(str(tmpdir), 'db'))
+        db.set_indexes([UniqueHashIndex(db.path, 'id'),
+                        TwoQ_TreeIndex(db.path, 'tree')])
+        db.create()
+        docs = [dict(t=x) for x in xrange(50)]
+        for doc in docs:
+            db.insert(doc)
+        db.reset_cache_stats()
+        for x in xrange(3):
+            db.get('id', docs[0]['_id'])
+            db.get('tree', 10)
+        stats = db.get_cache_stats()
+        assert sorted(stats) == ['id', 'tree']
+        find_key = stats['id']['_find_key']
+        assert find_key['hits'] == 2 and find_key['misses'] == 1
+        assert find_key['maxsize'] == 100
+        assert stats['tree']['_find_key']['hits'] == 2
+        assert db.get_index_details('tree')['cache_stats'] == stats['tree']
+
+        db.delete(docs[0])
+        db.get('id', docs[1]['_id'])
+        find_key = db.get_cache_stats('id')['id']['_find_key']
+        assert find_key['invalidations'] >= 1
+        db.reset_cache_stats('id')
+        reset = db.get_cache_stats('id')['id']['_find_key']
+        assert reset['hits'] == reset['invalidations'] == 0
+        assert reset['size'] == find_key['size'] > 0
+        assert db.get_cache_stats('tree')['tree']['_find_key']['hits'] == 2
+        with pytest.raises(IndexNotFoundException):
+            db.get_cache_stats('missing')
+
+    def test_cache_sizes(self, tmpdir):
+        db = self._db(os.path.join(str(tmpdir), 'db'))
+        db.create()
+        db.add_index(TwoQ_TreeIndex(db.path, 'tree'),
+                     ind_kwargs=dict(cache_size=500))
+        tree = db.indexes_names['tree']
+        assert tree._find_key.get_stats()['maxsize'] == 500
+        assert tree._find_key_in_leaf.get_stats()['maxsize'] == 750
+        for x in xrange(1000):
+            db.insert(dict(t=x))
+        for x in xrange(1000):
+            db.get('tree', x % 300)
+        assert db.get_cache_stats('tree')['tree']['_find_key']['size'] == 300
+
+        budget = db.set_cache_budget(10 ** 6)
+        assert sorted(budget) == ['id', 'tree']
+        assert budget['tree'] > budget['id']
+        stats = db.get_cache_stats('tree')['tree']['_find_key']
+        assert stats['size'] == stats['maxsize'] < 300
+        db.close()
+
+        db = self._db(os.path.join(str(tmpdir), 'db'))
+        db.open()
+        tree = db.indexes_names['tree']
+        assert tree.cache_memory == budget['tree']
+        assert tree._find_key.get_stats()['maxsize'] == stats['maxsize']
+        tree.set_cache_size(cache_size=50)
+        assert db.get_index_details('tree')['cache_memory'] is None
+        assert tree._find_key.get_stats()['maxsize'] == 50
+
+    def test_doc_cache(self, tmpdir):
+        db = self._db(os.path.join(str(tmpdir), 'db'), doc_cache_size=10)
+        db.set_indexes([UniqueHashIndex(db.path, 'id'),
+                        TwoQ_TreeIndex(db.path, 'tree')])
+        db.create()
+        docs = [dict(t=x, nested={'a': [x]}) for x in xrange(20)]
+        for doc in docs:
+            db.insert(doc)
+        doc = db.get('id', docs[0]['_id'])
+        doc['nested']['a'].append('changed')
+        assert db.get('id', docs[0]['_id']) == docs[0]
+        assert db.get('tree', 0, with_doc=True)['doc'] == docs[0]
+        stats = db.get_cache_stats('id')['id']['documents']
+        assert stats['hits'] == 2 and stats['misses'] == 1
+
+        docs[0]['t'] = 100
+        db.update(docs[0])
+        assert db.get('id', docs[0]['_id'])['t'] == 100
+        db.delete(docs[0])
+        with pytest.raises(RecordDeleted):
+            db.get('id', docs[0]['_id'])
+
+        for doc in docs[1:]:
+            assert db.get('id', doc['_id']) == doc
+        stats = db.get_cache_stats('id')['id']['documents']
+        assert stats['size'] == 10 and stats['evictions'] == 9
+        assert stats['invalidations'] == 2
+        db.close()
+
+    def test_segmented_cache(self):
+        from threading import RLock, Thread
+        from CodernityDB import lru_cache_with_lock
+
+        cache2lvl = lru_cache_with_lock.create_cache2lvl(RLock)
+
+        @cache2lvl(256)
+        def read(a, b):
+            return a * 1000 + b
+        assert len(read.cache.segments) == 8
+
+        errors = []
+
+        def worker(seed):
+            rnd = random.Random(seed)
+            for x in xrange(3000):
+                a, b = rnd.randint(0, 30), rnd.randint(0, 30)
+                if read(a, b) != a * 1000 + b:
+                    errors.append((a, b))
+                if x % 50 == 0:
+                    read.delete(a)
+        threads = [Thread(target=worker, args=(x, )) for x in xrange(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        assert not errors
+        stats = read.get_stats()
+        assert stats['hits'] + stats['misses'] == 8 * 3000
+        assert stats['size'] <= stats['maxsize'] == 256
+        read.resize(64)
+        assert read.get_stats()['size'] <= 64
+        assert sum(len(keys) for segment in read.cache.segments
+                   for keys in segment.inner_keys.itervalues()) == read.get_stats()['size']
+        read.stats.reset()
+        assert read.get_stats()['hits'] == 0
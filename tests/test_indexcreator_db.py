@@ -90,6 +90,69 @@ class TestIndexCreatorWithDatabase:
         db.add_index(s1)
         assert s1 == db.get_index_code('s1', code_switch='S')
 
+    def test_counted_tree(self, db):
+        s = """
+        type = CountedTreeBasedIndex
+        name = s
+        key_format = I
+        make_key_value:
+        a,None
+        make_key:
+        key
+        """
+        db.add_index(s)
+        for i in xrange(100):
+            db.insert(dict(a=i % 10))
+        assert db.run('s', 'count', 3, 5) == 30
+        assert [x['key'] for x in db.get_many('s', start=3, end=5, limit=3, offset=18)] == [4, 4, 5]
+
+    def test_aggregated_tree(self, db):
+        s = """
+        type = AggregatedTreeBasedIndex
+        name = s
+        key_format = I
+        value_field = amount
+        make_key_value:
+        a,{'amount': b}
+        make_key:
+        key
+        """
+        db.add_index(s)
+        for i in xrange(100):
+            db.insert(dict(a=i % 10, b=i))
+        assert db.run('s', 'sum', 3, 4) == sum(i for i in xrange(100) if 3 <= i % 10 <= 4)
+        assert db.run('s', 'aggregate', 9)['min'] == 9
+
+    def test_key_codecs(self, db):
+        s = """
+        type = CompositeTreeBasedIndex
+        name = s
+        key_codec = float
+        make_key_value:
+        a,None
+        make_key:
+        key
+        """
+        db.add_index(s)
+        s2 = """
+        type = CompositeTreeBasedIndex
+        name = s2
+        key_parts = '4s, -int'
+        make_key_value:
+        (b, c), None
+        make_key:
+        key
+        """
+        db.add_index(s2)
+        for i in xrange(20):
+            db.insert(dict(a=i - 10.5, b='x' if i % 2 else 'y', c=i - 10))
+        assert [x['key'] for x in db.get_many('s', start=-2, end=1, limit=-1)] == [-1.5, -0.5, 0.5]
+        assert db.get('s', -10.5)['key'] == -10.5
+        result = db.get_many('s2', ('x', ), limit=3, with_doc=True)
+        assert [x['doc']['c'] for x in result] == [9, 7, 5]
+        result = db.get_many('s2', start=('y', 0), end=('y', -4), limit=-1)
+        assert [x['key'] for x in result] == [('y', 0), ('y', -2), ('y', -4)]
+
 
 class TestMultiIndexCreatorWithInternalImports:
 
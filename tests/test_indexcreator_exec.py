@@ -682,6 +682,31 @@ class TestIndexCreatorRightInput:
              ({'a': 3, 'b': 4}, {'a': 3, 'b': 4})
              ])
 
+    def test_input_fields(self, p):
+        s = """
+        name = s
+        type = HashIndex
+        key_format =     32s
+        make_key_value:
+        b == 1 and c: md5(str(b)),None
+        len(a) > 2: md5(a),None
+        0,None
+        make_key:
+        key > x: md5(key)
+        key
+        """
+        exec p.parse(s, 'InputFields')[1] in globals()
+        assert InputFields.input_fields == ('b', 'c', 'a')
+
+        s2 = """
+        name = s2
+        type = HashIndex
+        make_key_value:
+        data
+        """
+        exec p.parse(s2, 'NoInputFields')[1] in globals()
+        assert NoInputFields.input_fields is None
+
     def test_enclosures(self, p):
 
         s = """
@@ -15,17 +15,18 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-from CodernityDB.database import RecordDeleted, RecordNotFound
+from CodernityDB.database import RecordDeleted, RecordNotFound, PreconditionsException
 
 from CodernityDB.hash_index import UniqueHashIndex
 
-from CodernityDB.tree_index import TreeBasedIndex
+from CodernityDB.tree_index import TreeBasedIndex, CountedTreeBasedIndex, CompositeTreeBasedIndex, AggregatedTreeBasedIndex
 
 from CodernityDB.debug_stuff import database_step_by_step
 
 import pytest
 import os
 import random
+from datetime import datetime, timedelta
 
 
 class SimpleTreeIndex(TreeBasedIndex):
@@ -80,6 +81,69 @@ class EvenCapacityTreeIndex(TreeBasedIndex):
         return key
 
 
+class CountedTreeIndex(CountedTreeBasedIndex):
+
+    def __init__(self, *args, **kwargs):
+        kwargs['node_capacity'] = 8
+        kwargs['key_format'] = 'I'
+        super(CountedTreeIndex, self).__init__(*args, **kwargs)
+
+    def make_key_value(self, data):
+        a_val = data.get('a')
+        if a_val is not None:
+            return a_val, None
+        return None
+
+    def make_key(self, key):
+        return key
+
+
+class AmountTreeIndex(AggregatedTreeBasedIndex):
+
+    def __init__(self, *args, **kwargs):
+        kwargs['node_capacity'] = 8
+        kwargs['key_format'] = 'I'
+        super(AmountTreeIndex, self).__init__(*args, **kwargs)
+
+    def make_key_value(self, data):
+        a_val = data.get('a')
+        if a_val is not None:
+            return a_val, dict(value=data['amount'])
+        return None
+
+    def make_key(self, key):
+        return key
+
+
+class TenantTreeIndex(CompositeTreeBasedIndex):
+
+    def __init__(self, *args, **kwargs):
+        kwargs['node_capacity'] = 8
+        kwargs['key_parts'] = ['8s', 'i', '-d']
+        super(TenantTreeIndex, self).__init__(*args, **kwargs)
+
+    def make_key_value(self, data):
+        if 'tenant' in data:
+            return (data['tenant'], data['created'], data['score']), None
+        return None
+
+
+class EventTreeIndex(CompositeTreeBasedIndex):
+
+    custom_header = """from CodernityDB.tree_index import CompositeTreeBasedIndex
+from datetime import datetime, timedelta"""
+
+    def __init__(self, *args, **kwargs):
+        kwargs['node_capacity'] = 8
+        kwargs['key_codec'] = 'datetime'
+        super(EventTreeIndex, self).__init__(*args, **kwargs)
+
+    def make_key_value(self, data):
+        if 'at' in data:
+            return datetime(1970, 1, 1) + timedelta(seconds=data['at']), None
+        return None
+
+
 def sort_by_key(list):
 
     def _comp(a, b):
@@ -778,6 +842,253 @@ class TreeIndexTests:
         assert db.count(db.all, 'tree') == db.count(db.all, 'id')
         db.close()
 
+    def test_get_all_reverse(self, tmpdir):
+        db = self._db(os.path.join(str(tmpdir), 'db'))
+        id = UniqueHashIndex(db.path, 'id')
+        tree = SimpleTreeIndex(db.path, 'tree')
+        db.set_indexes([id, tree])
+        db.create()
+        key_values = [random.randint(0, 100) for x in xrange(500)]
+        for key in key_values:
+            db.insert(dict(a=key))
+        key_values.sort(reverse=True)
+        assert [x['key'] for x in db.all('tree', reverse=True)] == key_values
+        assert [x['key'] for x in db.all('tree', limit=10, offset=20, reverse=True)] == key_values[20:30]
+        db.close()
+
+    def test_get_between_reverse(self, tmpdir):
+        db = self._db(os.path.join(str(tmpdir), 'db'))
+        id = UniqueHashIndex(db.path, 'id')
+        tree = EvenCapacityTreeIndex(db.path, 'tree')
+        db.set_indexes([id, tree])
+        db.create()
+        key_values = [random.randint(0, 100) for x in xrange(500)]
+        for key in key_values:
+            db.insert(dict(a=key))
+        key_values.sort(reverse=True)
+        result = db.get_many('tree', start=20, end=50, limit=-1, reverse=True)
+        assert [x['key'] for x in result] == filter(lambda k: 20 <= k <= 50, key_values)
+        result = db.get_many('tree', start=20, end=50, limit=-1, reverse=True,
+                             inclusive_start=False, inclusive_end=False)
+        assert [x['key'] for x in result] == filter(lambda k: 20 < k < 50, key_values)
+        result = db.get_many('tree', start=70, limit=5, offset=3, reverse=True)
+        assert [x['key'] for x in result] == filter(lambda k: k >= 70, key_values)[3:8]
+        result = db.get_many('tree', end=30, limit=5, reverse=True)
+        assert [x['key'] for x in result] == filter(lambda k: k <= 30, key_values)[:5]
+        key = key_values[100]
+        assert db.count(db.get_many, 'tree', key, limit=-1, reverse=True) == key_values.count(key)
+        db.close()
+
+    def test_cursor_pagination(self, tmpdir):
+        db = self._db(os.path.join(str(tmpdir), 'db'))
+        id = UniqueHashIndex(db.path, 'id')
+        tree = SimpleTreeIndex(db.path, 'tree')
+        db.set_indexes([id, tree])
+        db.create()
+        for key in xrange(300):
+            db.insert(dict(a=key % 100))
+        for reverse in (False, True):
+            expected = [x['_id'] for x in db.get_many('tree', start=10, end=60, limit=-1, reverse=reverse)]
+            result = []
+            page = list(db.get_many('tree', start=10, end=60, limit=7, reverse=reverse, cursor=True))
+            while page:
+                result.extend(x['_id'] for x in page)
+                page = list(db.get_many('tree', start=10, end=60, limit=7, reverse=reverse,
+                                        cursor=page[-1]['_cursor']))
+            assert result == expected
+        # cursor survives deletes that merge leaves
+        page = list(db.all('tree', limit=150, cursor=True))
+        for doc in list(db.get_many('tree', start=20, end=80, limit=-1, with_doc=True)):
+            db.delete(doc['doc'])
+        rest = [x['key'] for x in db.all('tree', cursor=page[-1]['_cursor'])]
+        assert rest == [k for k in xrange(81, 100) for x in xrange(3)]
+        with pytest.raises(PreconditionsException):
+            db.all('id', cursor=page[-1]['_cursor']).next()
+        db.close()
+
+    def test_get_multi(self, tmpdir):
+        db = self._db(os.path.join(str(tmpdir), 'db'))
+        id = UniqueHashIndex(db.path, 'id')
+        tree = SimpleTreeIndex(db.path, 'tree')
+        db.set_indexes([id, tree])
+        db.create()
+        inserted = []
+        for x in xrange(2000):
+            a = dict(a=random.randint(0, 500))
+            db.insert(a)
+            inserted.append(a)
+        for rec in random.sample(inserted, 800):
+            db.delete(rec)
+        keys = random.sample(xrange(600), 300) + [0, 0, 500]
+        result = db.get_multi('tree', keys)
+        expected = []
+        for key in sorted(set(keys)):
+            try:
+                expected.append(db.get('tree', key)['key'])
+            except RecordNotFound:
+                pass
+        assert [x['key'] for x in result] == expected
+        for record in result:
+            assert record['_id'] == db.get_many('tree', record['key']).next()['_id']
+        assert [x['_id'] for x in db.get_multi('tree', [7, 3], with_doc=True)] == [x['doc']['_id'] for x in db.get_multi('tree', [3, 7], with_doc=True)]
+        assert db.get_multi('tree', [1000, 1001]) == []
+        assert db.get_multi('tree', []) == []
+        db.close()
+
+    def test_min_max_distinct(self, tmpdir):
+        db = self._db(os.path.join(str(tmpdir), 'db'))
+        id = UniqueHashIndex(db.path, 'id')
+        tree = SimpleTreeIndex(db.path, 'tree')
+        db.set_indexes([id, tree])
+        db.create()
+        assert db.run('tree', 'min') is None
+        assert db.run('tree', 'distinct') == []
+        inserted = []
+        for x in xrange(1500):
+            a = dict(a=random.choice([3, 5, 8, 40, 41, 100]) if x % 10 else random.randint(0, 200))
+            db.insert(a)
+            inserted.append(a)
+        for rec in inserted[:500]:
+            db.delete(rec)
+        values = sorted(set(x['a'] for x in inserted[500:]))
+        assert db.run('tree', 'min') == values[0]
+        assert db.run('tree', 'max') == values[-1]
+        assert db.run('tree', 'distinct') == values
+        assert db.run('tree', 'distinct', 5, 100) == [v for v in values if 5 <= v <= 100]
+        assert db.run('tree', 'distinct', 41, limit=2) == [v for v in values if v >= 41][:2]
+        db.close()
+
+    def test_aggregated_tree(self, tmpdir):
+        db = self._db(os.path.join(str(tmpdir), 'db'))
+        id = UniqueHashIndex(db.path, 'id')
+        tree = AmountTreeIndex(db.path, 'tree')
+        db.set_indexes([id, tree])
+        db.create()
+        inserted = []
+        for x in xrange(1000):
+            a = dict(a=random.randint(0, 200), amount=random.randint(-100, 100))
+            db.insert(a)
+            inserted.append(a)
+
+        def check(start, end, **kwargs):
+            amounts = [rec['amount'] for rec in inserted
+                       if start <= rec['a'] <= end]
+            result = db.run('tree', 'aggregate', start, end, **kwargs)
+            # single key ranges may be empty with random data
+            assert result == dict(count=len(amounts), sum=sum(amounts),
+                                  min=min(amounts or [None]),
+                                  max=max(amounts or [None]))
+            assert db.run('tree', 'sum', start, end) == sum(amounts)
+
+        check(0, 200)
+        check(50, 150)
+        for rec in inserted[:300]:
+            db.delete(rec)
+        inserted = inserted[300:]
+        for rec in inserted[:300]:
+            rec['amount'] = random.randint(-200, 200)
+            db.update(rec)
+        check(50, 150)
+        check(17, 17)
+        assert db.run('tree', 'aggregate', 150, 50) == dict(count=0, sum=0, min=None, max=None)
+        db.close()
+        db = self._db(os.path.join(str(tmpdir), 'db'))
+        db.open()
+        check(0, 200)
+        check(30, 170)
+        db.close()
+
+    def test_composite_keys(self, tmpdir):
+        db = self._db(os.path.join(str(tmpdir), 'db'))
+        id = UniqueHashIndex(db.path, 'id')
+        tree = TenantTreeIndex(db.path, 'tree')
+        db.set_indexes([id, tree])
+        db.create()
+        keys = []
+        for x in xrange(300):
+            key = (random.choice(['a', 'b', 'c']), random.randint(-100, 100), random.choice([-1.5, 0.25, 3.0]))
+            keys.append(key)
+            db.insert(dict(tenant=key[0], created=key[1], score=key[2]))
+        keys.sort(key=lambda k: (k[0], k[1], -k[2]))
+        assert [x['key'] for x in db.all('tree')] == keys
+        result = db.get_many('tree', start=('b', -10), end=('b', 50), limit=-1)
+        assert [x['key'] for x in result] == filter(lambda k: k[0] == 'b' and -10 <= k[1] <= 50, keys)
+        result = db.get_many('tree', start=('b', -10), end=('b', 50), limit=-1,
+                             inclusive_start=False, inclusive_end=False)
+        assert [x['key'] for x in result] == filter(lambda k: k[0] == 'b' and -10 < k[1] < 50, keys)
+        result = db.get_many('tree', ('c', ), limit=-1, with_doc=True)
+        assert [x['doc']['created'] for x in result] == [k[1] for k in keys if k[0] == 'c']
+        result = db.get_many('tree', start=('a', ), end=('b', ), limit=-1, inclusive_end=False)
+        assert len(list(result)) == len([k for k in keys if k[0] == 'a'])
+        assert db.get('tree', keys[0])['key'] == keys[0]
+        assert db.run('tree', 'min') == keys[0]
+        assert db.run('tree', 'distinct', ('b', ), ('b', )) == sorted(set(k for k in keys if k[0] == 'b'), key=lambda k: (k[1], -k[2]))
+        db.compact()
+        db.close()
+        db = self._db(os.path.join(str(tmpdir), 'db'))
+        db.open()
+        assert [x['key'] for x in db.all('tree')] == keys
+        db.close()
+
+    def test_datetime_keys(self, tmpdir):
+        db = self._db(os.path.join(str(tmpdir), 'db'))
+        id = UniqueHashIndex(db.path, 'id')
+        tree = EventTreeIndex(db.path, 'tree')
+        db.set_indexes([id, tree])
+        db.create()
+        seconds = [random.uniform(-10 ** 9, 10 ** 9) for x in xrange(200)]
+        for at in seconds:
+            db.insert(dict(at=at))
+        keys = sorted(datetime(1970, 1, 1) + timedelta(seconds=at) for at in seconds)
+        assert [x['key'] for x in db.all('tree')] == keys
+        start, end = datetime(1960, 1, 1), datetime(1980, 1, 1)
+        result = db.get_many('tree', start=start, end=end, limit=-1)
+        assert [x['key'] for x in result] == [k for k in keys if start <= k <= end]
+        assert db.get('tree', keys[10])['key'] == keys[10]
+        db.close()
+        db = self._db(os.path.join(str(tmpdir), 'db'))
+        db.open()
+        result = db.get_many('tree', end=end, limit=3)
+        assert [x['key'] for x in result] == [k for k in keys if k <= end][::-1][:3]
+        db.close()
+
+    def test_counted_tree_offset_and_count(self, tmpdir):
+        db = self._db(os.path.join(str(tmpdir), 'db'))
+        id = UniqueHashIndex(db.path, 'id')
+        tree = CountedTreeIndex(db.path, 'tree')
+        db.set_indexes([id, tree])
+        db.create()
+        inserted = []
+        for x in xrange(1000):
+            a = dict(a=random.randint(0, 200))
+            db.insert(a)
+            inserted.append(a)
+        for rec in inserted[:300]:
+            db.delete(rec)
+        key_values = sorted(x['a'] for x in inserted[300:])
+
+        def check():
+            assert db.run('tree', 'count') == len(key_values)
+            assert db.run('tree', 'count', 50, 150) == len(filter(lambda k: 50 <= k <= 150, key_values))
+            assert db.run('tree', 'count', 50, 150, inclusive_start=False, inclusive_end=False) == len(filter(lambda k: 50 < k < 150, key_values))
+            key = key_values[200]
+            assert db.run('tree', 'count', key, key) == key_values.count(key)
+            result = db.all('tree', limit=10, offset=500)
+            assert [x['key'] for x in result] == key_values[500:510]
+            result = db.get_many('tree', start=50, end=150, limit=10, offset=100)
+            assert [x['key'] for x in result] == filter(lambda k: 50 <= k <= 150, key_values)[100:110]
+            result = db.get_many('tree', start=50, end=150, limit=10, offset=100, reverse=True)
+            assert [x['key'] for x in result] == filter(lambda k: 50 <= k <= 150, key_values[::-1])[100:110]
+            result = db.get_many('tree', end=150, limit=10, offset=5)
+            assert [x['key'] for x in result] == filter(lambda k: k <= 150, key_values[::-1])[5:15]
+
+        check()
+        db.close()
+        db = self._db(os.path.join(str(tmpdir), 'db'))
+        db.open()
+        check()
+        db.close()
+
     def test_delete_with_math_doc_id_case(self, tmpdir):
         db = self._db(os.path.join(str(tmpdir), 'db'))
         id = UniqueHashIndex(db.path, 'id')
@@ -822,6 +1133,34 @@ class TreeIndexTests:
         assert db.count(db.all, 'tree') == len(inserted)
         db.close()
 
+    def test_ranges_from_before_first_key(self, tmpdir):
+        db = self._db(os.path.join(str(tmpdir), 'db'))
+        id = UniqueHashIndex(db.path, 'id')
+        tree = SimpleTreeIndex(db.path, 'tree')
+        db.set_indexes([id, tree])
+        db.create()
+        inserted = []
+        for key in xrange(200):
+            a = dict(a=key)
+            db.insert(a)
+            inserted.append(a)
+        for rec in inserted[:100]:
+            db.delete(rec)
+        for start in (0, 50, 99, 100):
+            assert db.count(db.get_many, 'tree', start=start, end=199,
+                            limit=-1) == 100
+            assert db.count(db.get_many, 'tree', start=start, end=None,
+                            limit=-1) == 100
+            assert db.count(db.get_many, 'tree', start=start, end=199,
+                            limit=-1, inclusive_start=False) == 100 - (start == 100)
+        assert db.count(db.get_many, 'tree', start=None, end=99,
+                        limit=-1) == 0
+        assert db.count(db.get_many, 'tree', start=None, end=100,
+                        limit=-1, inclusive_end=False) == 0
+        assert db.count(db.get_many, 'tree', start=None, end=110,
+                        limit=-1) == 11
+        db.close()
+
     def test_insert_delete_half_update_half(self, tmpdir):
         db = self._db(os.path.join(str(tmpdir), 'db'))
         id = UniqueHashIndex(db.path, 'id')
@@ -869,6 +1208,113 @@ class TreeIndexTests:
         assert db.count(db.all, 'tree') == len(inserted) - deleted
         db.close()
 
+    def test_delete_merges_leaves(self, tmpdir):
+        db = self._db(os.path.join(str(tmpdir), 'db'))
+        id = UniqueHashIndex(db.path, 'id')
+        tree = SimpleTreeIndex(db.path, 'tree')
+        db.set_indexes([id, tree])
+        db.create()
+        tree = db.indexes_names['tree']
+
+        def count_leaves():
+            leaf_start = tree.data_start + tree.node_size
+            leaves = 0
+            while leaf_start:
+                leaves += 1
+                leaf_start = tree._read_leaf_neighbours(leaf_start)[1]
+            return leaves
+
+        inserted = []
+        for key in xrange(1000):
+            a = dict(a=key)
+            db.insert(a)
+            inserted.append(a)
+        leaves_before = count_leaves()
+        for rec in inserted[100:900]:
+            db.delete(rec)
+        assert count_leaves() < leaves_before / 3
+        left = inserted[:100] + inserted[900:]
+        assert [x['key'] for x in db.all('tree')] == [x['a'] for x in left]
+        for rec in left:
+            assert db.get('tree', rec['a'])['_id'] == rec['_id']
+        for key in xrange(100, 900):
+            with pytest.raises(RecordNotFound):
+                db.get('tree', key)
+        assert db.count(db.get_many, 'tree', start=50, end=950, limit=-1) == 101
+        db.close()
+
+    def test_delete_equal_keys_after_merges(self, tmpdir):
+        db = self._db(os.path.join(str(tmpdir), 'db'))
+        id = UniqueHashIndex(db.path, 'id')
+        tree = SimpleTreeIndex(db.path, 'tree')
+        db.set_indexes([id, tree])
+        db.create()
+        tree = db.indexes_names['tree']
+
+        def ids(key):
+            return sorted(x['_id'] for x in db.get_many('tree', key, limit=-1))
+
+        inserted = []
+        for key in xrange(90):
+            a = dict(a=key % 3)
+            db.insert(a)
+            inserted.append(a)
+        for rec in inserted:
+            # positions of records with equal keys are cached by doc_id
+            tree._find_key_to_update(rec['a'], rec['_id'])
+        left = list(inserted)
+        random.shuffle(left)
+        while left:
+            db.delete(left.pop())
+            for key in xrange(3):
+                assert ids(key) == sorted(x['_id'] for x in left if x['a'] == key)
+        db.close()
+
+    def test_ascending_inserts_pack_leaves(self, tmpdir):
+        db = self._db(os.path.join(str(tmpdir), 'db'))
+        id = UniqueHashIndex(db.path, 'id')
+        tree = SimpleTreeIndex(db.path, 'tree')
+        db.set_indexes([id, tree])
+        db.create()
+        tree = db.indexes_names['tree']
+        for key in xrange(1000):
+            db.insert(dict(a=key / 3))
+        leaf_start = tree.data_start + tree.node_size
+        sizes = []
+        while leaf_start:
+            nr_of_elements, prev_leaf, leaf_start = tree._read_leaf_nr_of_elements_and_neighbours(leaf_start)
+            sizes.append(nr_of_elements)
+        # only leaves from root split and the last one are not full
+        assert sizes[1:-1] == [tree.node_capacity] * (len(sizes) - 2)
+        db.insert(dict(a=5))
+        assert [x['key'] for x in db.all('tree')] == sorted([x / 3 for x in xrange(1000)] + [5])
+        assert db.count(db.get_many, 'tree', 333, limit=-1) == 1
+        assert db.count(db.get_many, 'tree', 5, limit=-1) == 4
+        db.close()
+
+    def test_delete_all_collapses_root(self, tmpdir):
+        db = self._db(os.path.join(str(tmpdir), 'db'))
+        id = UniqueHashIndex(db.path, 'id')
+        tree = EvenCapacityTreeIndex(db.path, 'tree')
+        db.set_indexes([id, tree])
+        db.create()
+        tree = db.indexes_names['tree']
+        inserted = []
+        for key in xrange(300):
+            a = dict(a=key % 20)
+            db.insert(a)
+            inserted.append(a)
+        assert tree.root_flag == 'n'
+        random.shuffle(inserted)
+        while inserted:
+            db.delete(inserted.pop())
+            assert db.count(db.all, 'tree') == len(inserted)
+        assert tree.root_flag == 'l'
+        for key in xrange(100):
+            db.insert(dict(a=key))
+        assert [x['key'] for x in db.all('tree')] == range(100)
+        db.close()
+
     def test_tree_real_life_example_random(self, tmpdir, operations):
         db = self._db(os.path.join(str(tmpdir), 'db'))
         id = UniqueHashIndex(db.path, 'id')